@@ -0,0 +1,199 @@
+"""
+Arrow backend of the tokens and sessions.
+
+ArrowStore is a TokenStore whose tokens are moved into Arrow record batches
+once they are tokenized. The ip addresses, urls, methods and extensions stay
+dictionary encoded: the batches hold their int32 codes and the dictionaries
+are shared by every batch. Filtering runs pyarrow.compute kernels batch by
+batch, and sessionization reads the columns of the batches as NumPy arrays
+without copying them.
+
+The tokens, the sessions and their urls can be written to Parquet files with
+dictionary encoded string columns, to be read by other tools instead of the
+SQLite database.
+
+pyarrow and NumPy are optional, the backend is only available when both are
+installed.
+"""
+
+import os
+import logging
+from store import TokenStore, SIZE_MISSING
+
+try:
+    import numpy
+    import pyarrow
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    numpy = pyarrow = pc = pq = None
+
+# Columns of the record batches, in the order of TokenStore.columns(). The
+# string columns are dictionary codes.
+COLUMN_NAMES = ("ip_address", "date_time", "method", "url", "request_ext",
+                "status_code", "size")
+# Columns dictionary encoded in tables() and Parquet files, with the name of
+# their Dictionary in the store
+DICTIONARY_COLUMNS = (("ip_address", "ips"), ("method", "methods"),
+                      ("url", "urls"), ("request_ext", "extensions"))
+# Files written by ArrowStore.write()
+TOKENS_FILE = "tokens.parquet"
+SESSIONS_FILE = "sessions.parquet"
+URLS_FILE = "urls.parquet"
+
+
+def available():
+    """ True if pyarrow and NumPy are installed """
+    return pyarrow is not None
+
+
+class ArrowStore(TokenStore):
+    """ Tokens of a log file stored in Arrow record batches """
+
+    def __init__(self, file_type):
+        if pyarrow is None:
+            raise ImportError("The Arrow backend needs pyarrow and NumPy")
+        super(ArrowStore, self).__init__(file_type)
+        self.schema = pyarrow.schema([
+            (name, pyarrow.from_numpy_dtype(numpy.dtype(column.typecode)))
+            for name, column in zip(COLUMN_NAMES, self.columns())])
+        self.batches = []
+
+    def __len__(self):
+        return sum(batch.num_rows for batch in self.batches) + \
+            len(self.date_time)
+
+    def record_batches(self):
+        """
+        Record batches of the tokens. The tokens appended since the last
+        call are moved from the column arrays into a new batch.
+        :return: List of pyarrow.RecordBatch with the columns of COLUMN_NAMES
+        """
+        if len(self.date_time):
+            # The batch shares the memory of the arrays, new arrays are
+            # created for the next tokens
+            self.batches.append(pyarrow.RecordBatch.from_arrays(
+                [pyarrow.array(numpy.frombuffer(column, dtype=column.typecode))
+                 for column in self.columns()], schema=self.schema))
+            self._init_columns()
+        return self.batches
+
+    def column(self, name):
+        """ Column of every record batch as a pyarrow.ChunkedArray """
+        return pyarrow.chunked_array(
+            [batch.column(name) for batch in self.record_batches()],
+            type=self.schema.field(name).type)
+
+    def code_arrays(self):
+        return tuple(self.column(name).to_numpy()
+                     for name in ("ip_address", "date_time", "url"))
+
+    def filter(self, ignore_list, criteria):
+        """
+        Remove tokens matching the ignore criteria with the same rules as
+        TokenStore.filter(), one record batch at a time.
+        :param ignore_list: File extensions to remove
+        :param criteria:    apache_ignore_criteria or squid_ignore_criteria
+        :return:            Number of tokens removed
+        """
+        methods = pyarrow.array(
+            [self.methods.codes[m] for m in criteria['method']
+             if m in self.methods.codes], pyarrow.int32())
+        extensions = pyarrow.array(
+            [self.extensions.codes[e] for e in ignore_list
+             if e in self.extensions.codes], pyarrow.int32())
+        count = len(self)
+        batches = []
+        for batch in self.record_batches():
+            size = batch.column("size")
+            keep = pc.and_(
+                pc.and_(pc.equal(batch.column("status_code"),
+                                 criteria['status_code']),
+                        pc.is_in(batch.column("method"), value_set=methods)),
+                pc.and_(pc.invert(pc.is_in(batch.column("request_ext"),
+                                           value_set=extensions)),
+                        pc.or_(pc.equal(size, SIZE_MISSING),
+                               pc.greater(size,
+                                          criteria['size_of_object']))))
+            batches.append(batch.filter(keep))
+        self.batches = batches
+        return count - len(self)
+
+    def sessions(self, session_timer, vectorized=True):
+        """ TokenStore.sessions(), always with NumPy array operations """
+        return super(ArrowStore, self).sessions(session_timer, True)
+
+    def dictionary(self, name):
+        """ Values of a Dictionary of the store as an Arrow string array """
+        return pyarrow.array(getattr(self, name).values, pyarrow.string())
+
+    def table(self):
+        """
+        The tokens as a pyarrow.Table. String columns are dictionary encoded,
+        date_time is a timestamp and a missing size is null.
+        """
+        table = pyarrow.Table.from_batches(self.record_batches(),
+                                           schema=self.schema)
+        for name, dictionary in DICTIONARY_COLUMNS:
+            values = self.dictionary(dictionary)
+            index = table.schema.get_field_index(name)
+            table = table.set_column(index, name, pyarrow.chunked_array(
+                [pyarrow.DictionaryArray.from_arrays(chunk, values)
+                 for chunk in table.column(index).chunks],
+                type=pyarrow.dictionary(pyarrow.int32(), pyarrow.string())))
+        index = table.schema.get_field_index("date_time")
+        table = table.set_column(index, "date_time", table.column(
+            index).cast(pyarrow.timestamp("s")))
+        index = table.schema.get_field_index("size")
+        size = table.column(index)
+        return table.set_column(index, "size", pc.if_else(
+            pc.equal(size, SIZE_MISSING), None, size))
+
+    def session_table(self, sessions):
+        """
+        Sessions as a pyarrow.Table.
+        :param sessions:    List of (id, ip address, session time, url
+                            ids), as in Sessionizer.results
+        """
+        ids, ips, times, url_ids = zip(*sessions) if sessions else \
+            ((), (), (), ())
+        return pyarrow.table([
+            pyarrow.array(ids, pyarrow.int64()),
+            pyarrow.array(ips, pyarrow.string()).dictionary_encode(),
+            pyarrow.array(times, pyarrow.duration("s")),
+            pyarrow.array(url_ids, pyarrow.list_(pyarrow.int32())),
+        ], names=["id", "ip", "session_time", "url_ids"])
+
+    def url_table(self, url_codes):
+        """
+        Urls of the sessions as a pyarrow.Table.
+        :param url_codes:   Url code of every url id, from 1 upwards, as in
+                            Sessionizer.url_codes
+        """
+        return pyarrow.table([
+            pyarrow.array(range(1, len(url_codes) + 1), pyarrow.int64()),
+            self.dictionary("urls").take(
+                pyarrow.array(url_codes, pyarrow.int32())),
+        ], names=["id", "url"])
+
+    def write(self, directory, sessions=None, url_codes=None):
+        """
+        Write the tokens, and the sessions and their urls if given, to
+        Parquet files in a directory.
+        :param directory:   Output directory, created if it doesn't exist
+        :param sessions:    Optional sessions, as for session_table()
+        :param url_codes:   Url codes of the sessions, as for url_table()
+        :return:            Paths of the files written
+        """
+        os.makedirs(directory, exist_ok=True)
+        tables = [(TOKENS_FILE, self.table())]
+        if sessions is not None:
+            tables.append((SESSIONS_FILE, self.session_table(sessions)))
+            tables.append((URLS_FILE, self.url_table(url_codes or [])))
+        paths = []
+        for file_name, table in tables:
+            path = os.path.join(directory, file_name)
+            pq.write_table(table, path, use_dictionary=True)
+            logging.info("%d rows written to %s" % (table.num_rows, path))
+            paths.append(path)
+        return paths
@@ -0,0 +1,1073 @@
+"""
+Benchmarks of the YAST pipeline. Every benchmark works on a real log file and
+prints its results to stdout.
+
+Usage:
+    python src/bench.py tokenize access.log --workers 1,2,4,8
+    python src/bench.py ingest access.log
+    python src/bench.py memory access.log
+    python src/bench.py compressed access.log.gz
+    python src/bench.py parser --lines 1000000
+    python src/bench.py mapped access.log
+    python src/bench.py sessionize access.log --workers 1,2,4
+    python src/bench.py sweep access.log --timeouts 5,10,15,30,60
+    python src/bench.py incremental access.log --steps 10
+    python src/bench.py vectorized --tokens 10000000
+    python src/bench.py inserts access.log
+    python src/bench.py export access.log
+    python src/bench.py clickpath access.log
+    python src/bench.py extsort access.log --sort-memory 4
+    python src/bench.py bulkload access.log
+    python src/bench.py cache access.log
+    python src/bench.py indexes access.log
+    python src/bench.py arrow access.log
+    python src/bench.py profiles access.log
+"""
+
+import os
+import sys
+import time
+import random
+import datetime
+import shutil
+import argparse
+import logging
+import tempfile
+import tracemalloc
+from sqlalchemy import select, func, case, distinct, or_, bindparam
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.exc import OperationalError
+import settings
+import pipeline
+import parsers
+import clickpath
+import queryplan
+import store
+import arrowstore
+from store import TokenStore
+from arrowstore import ArrowStore
+from extsort import TokenSorter
+from tokencache import TokenCache
+from models import Session, Uurl
+from verify import generate_apache_lines, table_contents, store_contents, \
+    session_contents
+
+
+def int_list(value):
+    return [int(x) for x in value.split(",")]
+
+
+def bench_tokenize(args):
+    """ Tokenization throughput for every number of worker processes """
+    base = None
+    for workers in args.workers:
+        pipeline.init_database()
+        stats = pipeline.Tokenizer(args.log_file, workers=workers).run()
+        base = base or stats.throughput
+        print("{0:>3} workers: {1:>10.0f} lines/sec  {2:>5.2f}x  ({3})".format(
+            workers, stats.throughput, stats.throughput / base, stats))
+
+
+def bench_ingest(args):
+    """ ORM objects compared with Core executemany for inserting tokens """
+    results = {}
+    for name, core_insert in (("orm", False), ("core", True)):
+        pipeline.init_database()
+        tokenizer = pipeline.Tokenizer(args.log_file, core_insert=core_insert)
+        stats = tokenizer.run()
+        results[name] = table_contents(tokenizer.token_model)
+        print("{0:>5}: {1:>10.0f} lines/sec  ({2})".format(
+            name, stats.throughput, stats))
+    if results["orm"] != results["core"]:
+        print("Table contents differ!")
+        return 1
+    print("Table contents identical")
+
+
+def traced_memory(build):
+    """ Memory still allocated after build() returns, and its result """
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, result
+
+
+def bench_memory(args):
+    """ Memory per token of ORM objects compared with the columnar store """
+    tokenizer = pipeline.Tokenizer(args.log_file)
+    groups = [g for _, g, _ in tokenizer.tokens(pipeline.Stats("read"))]
+    model = tokenizer.token_model
+
+    def orm_objects():
+        return [model(g) for g in groups]
+
+    def token_store():
+        store = TokenStore(tokenizer.file_type)
+        for g in groups:
+            store.append(model.values(g))
+        return store
+
+    base = None
+    line = "{0:>5}: {1:>12} bytes  {2:>8.1f} bytes/token  {3:>6.1f}x"
+    for name, build in (("orm", orm_objects), ("store", token_store)):
+        size, _ = traced_memory(build)
+        base = base or size
+        print(line.format(name, size, size / max(len(groups), 1),
+                          base / max(size, 1)))
+
+
+def bench_compressed(args):
+    """ Reading a compressed log directly compared with decompressing it """
+    pipeline.init_database()
+    stats = pipeline.Tokenizer(args.log_file).run()
+    print("   direct: {0:>7.2f} secs  ({1})".format(stats.elapsed, stats))
+
+    pipeline.init_database()
+    start = time.time()
+    handle, path = tempfile.mkstemp(suffix=".log")
+    try:
+        raw, stream = pipeline.open_log(args.log_file)
+        with raw, stream, os.fdopen(handle, "wb") as out:
+            shutil.copyfileobj(stream, out)
+        decompress_time = time.time() - start
+        stats = pipeline.Tokenizer(path).run()
+        print("two steps: {0:>7.2f} secs  (decompress: {1:.2f} secs, {2})"
+              .format(time.time() - start, decompress_time, stats))
+        print("disk used: {0} bytes compressed, {1} bytes decompressed"
+              .format(os.stat(args.log_file).st_size, os.stat(path).st_size))
+    finally:
+        os.remove(path)
+
+
+def bench_parser(args):
+    """
+    Throughput of the regex and of the hand written Apache parser, and their
+    time on the worst case of the regex. Their results are compared by
+    tests/test_parsers.py.
+    """
+    for name, f_type in (("common", settings.APACHE_COMMON),
+                         ("combined", settings.APACHE_COMBINED)):
+        if args.log_file:
+            with open(args.log_file, "r", encoding="latin-1") as f:
+                lines = f.readlines()
+        else:
+            lines = list(generate_apache_lines(
+                args.lines, f_type == settings.APACHE_COMBINED, args.seed))
+        print("{0}: {1} lines".format(name, len(lines)))
+        for parser_name, fast in (("regex", False), ("hand written", True)):
+            parse = parsers.line_parser(f_type, fast=fast)
+            start = time.time()
+            for line in lines:
+                parse(line)
+            elapsed = time.time() - start
+            print("  {0:>12}: {1:>10.0f} lines/sec".format(
+                parser_name, len(lines) / elapsed if elapsed else 0))
+
+    # Combined lines with a long tail the regex can't match, which makes its
+    # (\".*\") (\".*\") groups backtrack over every '" "' of the tail
+    line = '127.0.0.1 - - [01/Mar/2017:00:00:00 +0530] "GET / HTTP/1.1" ' \
+        '200 1 "' + '" "' * args.tail_quotes + '-\n'
+    for parser_name, parse in (
+            ("regex", parsers.regex_parser(settings.APACHE_COMBINED)),
+            ("quote check", parsers.line_parser(settings.APACHE_COMBINED,
+                                                fast=False)),
+            ("hand written", parsers.line_parser(settings.APACHE_COMBINED,
+                                                 fast=True))):
+        start = time.time()
+        for _ in range(10):
+            parse(line)
+        print("  {0:>12}: {1:>10.3f} msecs per line with {2} quotes in the "
+              "tail".format(parser_name, (time.time() - start) * 100,
+                            args.tail_quotes))
+
+
+def bench_mapped(args):
+    """
+    Filling the token store from the text reader compared with the memory
+    mapped reader which decodes only the stored fields
+    """
+    results = {}
+    for name, mapped in (("text", False), ("mapped", True)):
+        tokenizer = pipeline.Tokenizer(args.log_file, mapped=mapped)
+        tokenizer.store = TokenStore(tokenizer.file_type)
+        cpu = os.times()
+        stats = tokenizer.run()
+        cpu = [after - before for before, after in zip(cpu, os.times())]
+        results[name] = store_contents(tokenizer.store)
+        if mapped:
+            decoded = sum(len(value) for d in (
+                tokenizer.store.ips, tokenizer.store.urls,
+                tokenizer.store.methods, tokenizer.store.extensions)
+                for value in d.raw_codes)
+        else:
+            decoded = tokenizer.bytes_total
+        print("{0:>6}: {1:>10.0f} lines/sec  user {2:.2f} secs, system {3:.2f}"
+              " secs, {4} bytes decoded  ({5})".format(
+                  name, stats.throughput, cpu[0], cpu[1], decoded, stats))
+    if results["text"] != results["mapped"]:
+        print("Token stores differ!")
+        return 1
+    print("Token stores identical")
+
+
+def session_tables():
+    """ Rows of the sessionization tables in insertion order """
+    return [settings.engine.execute(
+        "SELECT rowid, * FROM %s ORDER BY rowid" % table).fetchall()
+        for table in ("session_master", "uurl", "association")]
+
+
+def bench_sessionize(args):
+    """ Sessionization throughput for every number of worker processes """
+    pipeline.init_database()
+    print(pipeline.Tokenizer(args.log_file).run())
+    base = reference = None
+    line = "{0:>3} workers: {1:>10.0f} tokens/sec  {2:>5.2f}x  ({3})"
+    for workers in args.workers:
+        stats = pipeline.Sessionizer(args.log_file, args.timeout,
+                                     workers=workers).run()
+        base = base or stats.throughput
+        print(line.format(workers, stats.throughput,
+                          stats.throughput / base, stats))
+        tables = session_tables()
+        reference = reference or tables
+        if tables != reference:
+            print("Sessions differ from the first run!")
+            return 1
+    print("Sessions identical for every number of workers")
+
+
+def read_file(path):
+    with open(path) as f:
+        return f.read()
+
+
+def bench_sweep(args):
+    """ One sweep over every session timeout compared with a separate
+    sessionization per timeout. The CSV files of both must be identical. """
+    pipeline.init_database()
+    print(pipeline.Tokenizer(args.log_file).run())
+    out_dir = tempfile.mkdtemp(prefix="yast-sweep-")
+    try:
+        sweep = pipeline.SessionSweep(args.log_file, args.timeouts,
+                                      out_dir=out_dir)
+        sweep_stats = sweep.run()
+        print("sweep:    {0:>8.2f}s  ({1})".format(sweep_stats.elapsed,
+                                                  sweep_stats))
+        for timer_stats in sweep.timer_stats:
+            print("  %s" % timer_stats)
+
+        duration = 0
+        for timeout in args.timeouts:
+            stats = pipeline.Sessionizer(args.log_file, timeout).run()
+            duration += stats.elapsed
+            path = os.path.join(out_dir, "separate.csv")
+            pipeline.export_sessions(path)
+            if read_file(path) != read_file(
+                    os.path.join(out_dir, "sessions_%s.csv" % timeout)):
+                print("Sessions of timeout %d differ from the sweep!"
+                      % timeout)
+                return 1
+        print("separate: {0:>8.2f}s  {1:>5.2f}x the sweep".format(
+            duration, duration / sweep_stats.elapsed))
+        print("Sessions identical for every timeout")
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def bench_incremental(args):
+    """ Time of the incremental sessionization of a log growing in steps
+    compared with sessionizing all its tokens again. The sessions of both
+    are compared by tests/test_sessionizer.py. """
+    with open(args.log_file, "rb") as f:
+        lines = f.readlines()
+    directory = tempfile.mkdtemp(prefix="yast-incremental-")
+    path = os.path.join(directory, os.path.basename(args.log_file))
+    pipeline.init_database()
+    try:
+        step = -(-len(lines) // args.steps)
+        for i in range(0, len(lines), step):
+            with open(path, "ab") as log:
+                log.writelines(lines[i:i + step])
+            pipeline.Tokenizer(path, incremental=True).run()
+            sessionizer = pipeline.Sessionizer(path, args.timeout,
+                                               incremental=True,
+                                               url_storage=args.url_storage)
+            stats = sessionizer.run()
+            print("{0:>10} lines: {1:>8} new tokens {2:>7.2f} secs, "
+                  "{3} sessions created, {4} extended, {5} ip addresses "
+                  "sessionized again".format(
+                      min(i + step, len(lines)), stats.rows_in,
+                      stats.elapsed, stats.rows_out,
+                      sessionizer.extended_count,
+                      sessionizer.rebuilt_count))
+        stats = pipeline.Sessionizer(path, args.timeout,
+                                     url_storage=args.url_storage).run()
+        print("full rebuild: {0:>8} tokens {1:>7.2f} secs, {2} "
+              "sessions".format(stats.rows_in, stats.elapsed, stats.rows_out))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def generated_store(tokens, ips, urls, days, seed=0):
+    """
+    Token store of Apache Common tokens with random ip addresses and urls,
+    a few of which make most of the requests, spread over a number of days.
+    """
+    numpy = store.numpy
+    random_state = numpy.random.RandomState(seed)
+    token_store = TokenStore(settings.APACHE_COMMON)
+    for i in range(ips):
+        token_store.ips.encode("10.%d.%d.%d" % (i >> 16, (i >> 8) & 255,
+                                                i & 255))
+    for i in range(urls):
+        token_store.urls.encode("/page/%d.html" % i)
+    ip_codes = (random_state.random_sample(tokens) ** 3 * ips).astype(
+        numpy.int32)
+    url_codes = (random_state.random_sample(tokens) ** 2 * urls).astype(
+        numpy.int32)
+    start = store.to_epoch(datetime.datetime(2017, 3, 1))
+    times = numpy.sort(random_state.randint(
+        start, start + days * 86400, tokens).astype(numpy.int64))
+    token_store.ip_address.frombytes(ip_codes.tobytes())
+    token_store.url.frombytes(url_codes.tobytes())
+    token_store.date_time.frombytes(times.tobytes())
+    return token_store
+
+
+def bench_vectorized(args):
+    """ NumPy sessionization of the token store compared with the loop """
+    if store.numpy is None:
+        print("NumPy is not installed")
+        return 1
+    token_store = generated_store(args.tokens, args.ips, args.urls, args.days,
+                                  args.seed)
+    timer = args.timeout * 60
+    print("{0} tokens, {1} ip addresses, {2} urls over {3} days".format(
+        len(token_store), args.ips, args.urls, args.days))
+
+    start = time.time()
+    loop = list(token_store.sessions(timer, vectorized=False))
+    loop_time = time.time() - start
+    print("     loop: {0:>8.2f} secs  {1:>10.0f} tokens/sec  {2} "
+          "sessions".format(loop_time, len(token_store) / loop_time,
+                            len(loop)))
+
+    start = time.time()
+    token_store.session_arrays(timer)
+    arrays_time = time.time() - start
+    line = "   arrays: {0:>8.2f} secs  {1:>10.0f} tokens/sec  {2:>6.1f}x"
+    print(line.format(arrays_time, len(token_store) / arrays_time,
+                      loop_time / arrays_time))
+
+    start = time.time()
+    vectorized = list(token_store.sessions(timer, vectorized=True))
+    vectorized_time = time.time() - start
+    print("sessions(): {0:>6.2f} secs  {1:>10.0f} tokens/sec  {2:>6.1f}x  "
+          "(arrays and the lists of sessions() together)".format(
+              vectorized_time, len(token_store) / vectorized_time,
+              loop_time / vectorized_time))
+    if loop != vectorized:
+        print("Sessions differ from the loop!")
+        return 1
+    print("Sessions identical")
+
+
+def orm_insert_sessions(sessions, url_ids):
+    """ Insert sessions the way SessionThread did, with a Session object per
+    session and its urls appended to the session_urls relationship """
+    session = settings.Session()
+    urls = {}
+    for url, url_id in url_ids.items():
+        urls[url] = Uurl(id=url_id, url=url)
+        session.add(urls[url])
+    for i in range(0, len(sessions), settings.SESSION_BATCH_SIZE):
+        for session_id, (ip, start, end, session_urls, clicks,
+                         size) in enumerate(
+                sessions[i:i + settings.SESSION_BATCH_SIZE], i + 1):
+            session_obj = Session(
+                id=session_id, ip=ip, session_time=end - start,
+                start_time=start, end_time=end, page_count=len(clicks),
+                url_count=len(session_urls), total_bytes=size,
+                first_url_id=url_ids[session_urls[0]],
+                last_url_id=url_ids[clicks[-1]])
+            for url in session_urls:
+                session_obj.session_urls.append(urls[url])
+            session.add(session_obj)
+        session.flush()
+    session.commit()
+    settings.Session.remove()
+
+
+def core_insert_sessions(sessions, url_ids):
+    """ Insert sessions with pipeline.SessionInserter """
+    session = settings.Session()
+    session.execute(Uurl.__table__.insert(), [
+        {"id": url_id, "url": url} for url, url_id in url_ids.items()])
+    inserter = pipeline.SessionInserter(session)
+    for i in range(0, len(sessions), settings.SESSION_BATCH_SIZE):
+        inserter.insert(sessions[i:i + settings.SESSION_BATCH_SIZE],
+                        url_ids.__getitem__)
+    session.commit()
+    settings.Session.remove()
+
+
+def bench_inserts(args):
+    """ Sessions/sec written with ORM objects and with Core executemany """
+    pipeline.init_database()
+    print(pipeline.Tokenizer(args.log_file).run())
+    sessionizer = pipeline.Sessionizer(args.log_file, args.timeout)
+    sessions = list(pipeline.split_sessions(
+        sessionizer.ordered_tokens(pipeline.Stats("read")),
+        sessionizer.session_timer))
+    url_ids = {}
+    for session in sessions:
+        for url in session[3]:
+            url_ids.setdefault(url, len(url_ids) + 1)
+    associations = sum(len(session[3]) for session in sessions)
+    print("{0} sessions, {1} urls".format(len(sessions), associations))
+
+    base = reference = None
+    for name, insert in (("orm", orm_insert_sessions),
+                         ("core", core_insert_sessions)):
+        sessionizer.init_tables()
+        start = time.time()
+        insert(sessions, url_ids)
+        elapsed = time.time() - start
+        base = base or elapsed
+        print("{0:>5}: {1:>8.2f} secs  {2:>10.0f} sessions/sec  "
+              "{3:>6.1f}x".format(name, elapsed, len(sessions) / elapsed,
+                                  base / elapsed))
+        # The unit of work doesn't write the association rows of a session
+        # in the order its urls were appended, so only the sets are compared
+        contents = [row[:4] + (sorted(row[4]),) + row[5:]
+                    for row in session_contents()]
+        reference = reference or contents
+        if contents != reference:
+            print("Sessions differ from the ORM insert!")
+            return 1
+    print("Sessions identical")
+
+
+def orm_export_sessions(path):
+    """ Write the sessions to a CSV file the way SessionThread read them,
+    loading the session_urls of every session """
+    session = settings.Session()
+    count = pipeline.write_sessions(path, (
+        (s.id, s.ip, s.session_time, [u.id for u in s.session_urls])
+        for s in session.query(Session).order_by(Session.id)))
+    settings.Session.remove()
+    return count
+
+
+# Queries returning the sessions whose aggregates differ from the
+# association and token tables, and the number of tokens sessionized
+AGGREGATE_CHECKS = (
+    ("url_count", "SELECT COUNT(*) FROM session_master s WHERE url_count != "
+     "(SELECT COUNT(*) FROM association a WHERE a.session_id = s.id)"),
+    ("first_url_id", "SELECT COUNT(*) FROM session_master s WHERE "
+     "first_url_id != (SELECT uurl_id FROM association a WHERE a.session_id "
+     "= s.id ORDER BY a.rowid LIMIT 1)"),
+    ("last_url_id", "SELECT COUNT(*) FROM session_master s WHERE "
+     "last_url_id NOT IN (SELECT uurl_id FROM association a WHERE "
+     "a.session_id = s.id)"),
+)
+
+
+def bench_export(args):
+    """ Export of the sessions with a relationship load per session
+    compared with pipeline.session_rows() """
+    pipeline.init_database()
+    tokenizer = pipeline.Tokenizer(args.log_file)
+    print(tokenizer.run())
+    print(pipeline.Sessionizer(args.log_file, args.timeout).run())
+
+    for name, query in AGGREGATE_CHECKS:
+        wrong = settings.engine.execute(query).scalar()
+        if wrong:
+            print("%s wrong in %d sessions!" % (name, wrong))
+            return 1
+    model = tokenizer.token_model
+    _, _, _, size = pipeline.token_columns(tokenizer.file_type)
+    tokens, total_bytes = settings.engine.execute(select([
+        func.count(), func.sum(case([(func.typeof(size) == "integer", size)],
+                                    else_=0))]).select_from(model)).first()
+    pages, session_bytes = settings.engine.execute(select([
+        func.sum(Session.page_count), func.sum(Session.total_bytes)])).first()
+    if (pages, session_bytes) != (tokens, total_bytes):
+        print("Sessions hold {0} requests and {1} bytes, the tokens {2} and "
+              "{3}!".format(pages, session_bytes, tokens, total_bytes))
+        return 1
+    print("Aggregates match the association and token tables")
+
+    directory = tempfile.mkdtemp(prefix="yast-export-")
+    try:
+        files = []
+        for name, export in (("orm", orm_export_sessions),
+                             ("set-based", pipeline.export_sessions)):
+            path = os.path.join(directory, name + ".csv")
+            start = time.time()
+            count = export(path)
+            elapsed = time.time() - start
+            print("{0:>9}: {1:>8.2f} secs  {2:>10.0f} sessions/sec".format(
+                name, elapsed, count / elapsed))
+            files.append(read_file(path))
+        if files[0] != files[1]:
+            print("Exported files differ!")
+            return 1
+        print("Exported files identical")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def table_bytes(table):
+    """ Bytes of the pages of a table and its indexes, None if SQLite was
+    built without the dbstat virtual table """
+    try:
+        return settings.engine.execute(
+            "SELECT SUM(s.pgsize) FROM dbstat s JOIN sqlite_master m "
+            "ON s.name = m.name WHERE m.tbl_name = ?", table).scalar() or 0
+    except OperationalError:
+        return None
+
+
+def bench_clickpath(args):
+    """ Session urls stored in the association table compared with a packed
+    click path per session """
+    pipeline.init_database()
+    tokenizer = pipeline.Tokenizer(args.log_file)
+    print(tokenizer.run())
+    model = tokenizer.token_model
+    tokens = settings.engine.execute(
+        select([func.count()]).select_from(model)).scalar()
+
+    reference = None
+    for storage in (settings.URLS_ASSOCIATION, settings.URLS_CLICK_PATH):
+        sessionizer = pipeline.Sessionizer(args.log_file, args.timeout,
+                                           url_storage=storage)
+        stats = sessionizer.run()
+        settings.engine.execute("VACUUM")
+        sizes = [table_bytes(table) for table in ("session_master",
+                                                  "association")]
+        if None in sizes:
+            print("SQLite has no dbstat table, sizes are not available")
+            sizes = [0, 0]
+        start = time.time()
+        rows = list(pipeline.session_rows())
+        read = time.time() - start
+        settings.Session.remove()
+        print("{0:>11}: sessionize {1:>6.2f}s  session_master {2:>6.2f} MB  "
+              "association {3:>6.2f} MB  total {4:>6.2f} MB  read "
+              "{5:>6.2f}s".format(storage, stats.elapsed,
+                                  sizes[0] / 1048576.0, sizes[1] / 1048576.0,
+                                  sum(sizes) / 1048576.0, read))
+        reference = reference or rows
+        if rows != reference:
+            print("Session urls differ between the storages!")
+            return 1
+
+    blob_bytes = clicks = wrong = 0
+    for pages, last_url_id, click_path in settings.engine.execute(select([
+            Session.page_count, Session.last_url_id, Session.click_path])):
+        click_ids = clickpath.decode(click_path)
+        blob_bytes += len(click_path)
+        clicks += len(click_ids)
+        if len(click_ids) != pages or click_ids[-1] != last_url_id:
+            wrong += 1
+    if wrong or clicks != tokens:
+        print("{0} click paths don't match their session, {1} clicks for "
+              "{2} tokens!".format(wrong, clicks, tokens))
+        return 1
+    print("{0} clicks in {1:.2f} MB of click paths, {2:.2f} bytes per "
+          "click".format(clicks, blob_bytes / 1048576.0,
+                         blob_bytes / float(clicks)))
+    print("Session urls identical")
+
+
+def bench_extsort(args):
+    """ Sessionization of the token table compared with the external sort,
+    and peak memory of the sort with and without a memory budget. The
+    sessions of both are compared by tests/test_extsort.py. """
+    budget = int(args.sort_memory * 1024 * 1024)
+    pipeline.init_database()
+    tokenizer = pipeline.Tokenizer(args.log_file)
+    tokenize_stats = tokenizer.run()
+    stats = pipeline.Sessionizer(args.log_file, args.timeout).run()
+    print("token table: {0:>7.2f} secs  {1} tokens, {2} sessions".format(
+        tokenize_stats.elapsed + stats.elapsed, stats.rows_in,
+        stats.rows_out))
+
+    # The sort alone, fed with the tokens of the table in log order
+    query = select(pipeline.token_columns(tokenizer.file_type)).order_by(
+        tokenizer.token_model.token_id)
+    for name, memory_budget in (("in memory", None), ("external", budget)):
+        sorter = TokenSorter(memory_budget)
+        tracemalloc.start()
+        start = time.time()
+        for row in settings.engine.execute(query):
+            sorter.add(*row)
+        count = sum(1 for _ in sorter.sorted_tokens())
+        elapsed = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        sorter.close()
+        print("{0:>11}: {1:>7.2f} secs  peak {2:>8.2f} MB  {3} tokens, {4} "
+              "run files".format(name, elapsed, peak / 1048576.0, count,
+                                 sorter.run_count))
+
+    pipeline.init_database()
+    sorter = TokenSorter(budget)
+    tokenize_stats = pipeline.Tokenizer(args.log_file, sorter=sorter).run()
+    stats = pipeline.Sessionizer(args.log_file, args.timeout,
+                                 sorter=sorter).run()
+    print("   external: {0:>7.2f} secs  {1} tokens, {2} sessions, {3} run "
+          "files for a {4:.2f} MB budget".format(
+              tokenize_stats.elapsed + stats.elapsed, stats.rows_in,
+              stats.rows_out, sorter.run_count, args.sort_memory))
+    sorter.close()
+
+
+def bench_bulkload(args):
+    """ Tokenization, filtering and sessionization with and without the
+    bulk load mode """
+    ignore_list = [x.strip() for x in args.ignore.split(",") if x.strip()]
+    reference = None
+    for bulk_load in (False, True):
+        pipeline.init_database()
+        tokenize = pipeline.Tokenizer(args.log_file,
+                                      bulk_load=bulk_load).run()
+        filtering = pipeline.Filter(args.log_file, ignore_list,
+                                    bulk_load=bulk_load).run()
+        sessionize = pipeline.Sessionizer(args.log_file, args.timeout,
+                                          bulk_load=bulk_load).run()
+        total = tokenize.elapsed + filtering.elapsed + sessionize.elapsed
+        print("bulk load {0:<3}: tokenize {1:>7.2f}s  filter {2:>7.2f}s  "
+              "sessionize {3:>7.2f}s  total {4:>7.2f}s  ({5:.0f} "
+              "lines/sec)".format("on" if bulk_load else "off",
+                                  tokenize.elapsed, filtering.elapsed,
+                                  sessionize.elapsed, total,
+                                  tokenize.rows_in / total))
+        model = pipeline.TOKEN_MODELS[pipeline.LogFile(
+            args.log_file).file_type]
+        indexes = sorted(row[0] for row in settings.engine.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"))
+        contents = (table_contents(model), session_contents(), indexes)
+        reference = reference or contents
+        if contents != reference:
+            print("Tables differ between the two loads!")
+            return 1
+    print("Tokens, sessions and indexes identical")
+
+
+def bench_cache(args):
+    """ Tokenization of a log compared with loading its tokens from the
+    token cache """
+    directory = tempfile.mkdtemp(prefix="yast-cache-")
+    settings.TOKEN_CACHE_DIR = os.path.join(directory, "cache")
+    path = os.path.join(directory, os.path.basename(args.log_file))
+    shutil.copy(args.log_file, path)
+    try:
+        reference = None
+        for run in ("parse", "cached", "touched"):
+            if run == "touched":
+                # A new modification time invalidates the cached tokens
+                os.utime(path, None)
+            pipeline.init_database()
+            tokenizer = pipeline.Tokenizer(path, cache=True)
+            stats = tokenizer.run()
+            print("{0:>8}: {1:>8.2f} secs  {2} tokens, {3}".format(
+                run, stats.elapsed, stats.rows_out,
+                "from the cache" if tokenizer.from_cache else "parsed"))
+            if tokenizer.from_cache != (run == "cached"):
+                print("The cache was%s used!" % (
+                    "" if tokenizer.from_cache else " not"))
+                return 1
+            contents = table_contents(tokenizer.token_model)
+            reference = reference or contents
+            if contents != reference:
+                print("Tokens differ from the parsed log!")
+                return 1
+        token_cache = TokenCache()
+        print("cache size: {0:.2f} MB for a {1:.2f} MB log".format(
+            token_cache.size() / 1048576.0,
+            os.path.getsize(path) / 1048576.0))
+        # A budget below the size of the cached tokens evicts them
+        token_cache.budget = token_cache.size() - 1
+        token_cache.evict()
+        if token_cache.lookup(path, tokenizer.file_type) is not None:
+            print("Cached tokens not evicted!")
+            return 1
+        token_cache.close()
+        print("Tokens identical, cache invalidated and evicted")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def token_index_layouts(model, size):
+    """ CREATE INDEX statements of the single column indexes the token
+    tables had before the composite ones, and of the composite indexes """
+    table = model.__table__.name
+    single = ['CREATE INDEX "bench_{0}_{1}" ON "{0}" ({1})'.format(
+        table, column.key) for column in (
+        model.ip_address, model.method, model.request_ext,
+        model.status_code, size)]
+    composite = [str(CreateIndex(index).compile(
+        dialect=settings.engine.dialect))
+        for index in model.__table__.indexes
+        if index.name.endswith("_session")]
+    return (("single", single), ("composite", composite))
+
+
+def bench_indexes(args):
+    """ Build and query time of the single column and composite token
+    indexes """
+    pipeline.init_database()
+    tokenizer = pipeline.Tokenizer(args.log_file, bulk_load=True)
+    print(tokenizer.run())
+    model = tokenizer.token_model
+    columns = pipeline.token_columns(tokenizer.file_type)
+    criteria = pipeline.ignore_criteria(tokenizer.file_type)
+    ips = [row[0] for row in settings.engine.execute(
+        select([distinct(model.ip_address)]))]
+    ips = random.Random(0).sample(ips, min(args.ips, len(ips)))
+    last_token_id = settings.engine.execute(
+        select([func.max(model.token_id)])).scalar()
+    queries = (
+        ("sessionize", select(columns).order_by(
+            *pipeline.session_order(model))),
+        ("ip counts", select([model.ip_address, func.count()]).group_by(
+            model.ip_address).order_by(model.ip_address)),
+        ("filter", select([model.token_id]).where(or_(
+            model.status_code != criteria['status_code'],
+            ~model.method.in_(criteria['method']),
+            model.request_ext.in_(["css", "png", "jpg", "js"]),
+            columns[3] <= criteria['size_of_object']))),
+    )
+    per_ip = select(columns).where(model.ip_address == bindparam("ip")).where(
+        model.token_id <= bindparam("last")).order_by(
+        *pipeline.session_order(model))
+
+    layouts = token_index_layouts(model, columns[3])
+    reference = None
+    for name, statements in layouts:
+        for index in settings.engine.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND "
+                "tbl_name = ? AND name != ?", model.__table__.name,
+                "ix_%s_resource_requested" % model.__table__.name).fetchall():
+            settings.engine.execute('DROP INDEX "%s"' % index[0])
+        start = time.time()
+        for statement in statements:
+            settings.engine.execute(statement)
+        build = time.time() - start
+        times = []
+        results = []
+        for query_name, query in queries:
+            start = time.time()
+            rows = settings.engine.execute(query).fetchall()
+            times.append(time.time() - start)
+            results.append(rows if query_name != "filter" else sorted(rows))
+        start = time.time()
+        for ip in ips:
+            results.append(settings.engine.execute(
+                per_ip, ip=ip, last=last_token_id).fetchall())
+        times.append(time.time() - start)
+        sorts = len([step for step in queryplan.query_plan(queries[0][1])
+                     if "TEMP B-TREE" in step])
+        print("{0:>9}: build {1:>6.2f}s  sessionize {2:>6.2f}s  ip counts "
+              "{3:>6.2f}s  filter {4:>6.2f}s  {5} ip addresses {6:>6.2f}s"
+              "  {7}".format(name, build, times[0], times[1], times[2],
+                             len(ips), times[3], "sorted" if sorts
+                             else "no sort"))
+        reference = reference or results
+        if results != reference:
+            print("Query results differ between the index layouts!")
+            return 1
+    print("Query results identical")
+
+
+def directory_size(directory):
+    """ Bytes of the files in a directory """
+    return sum(os.path.getsize(os.path.join(directory, name))
+               for name in os.listdir(directory))
+
+
+def bench_arrow(args):
+    """ Tokenization, filtering and sessionization with the SQLite and the
+    Arrow backend, and the size of the tokens and sessions they write """
+    if not arrowstore.available():
+        print("The Arrow backend needs pyarrow and NumPy")
+        return 1
+    ignore_list = [x.strip() for x in args.ignore.split(",") if x.strip()]
+    directory = tempfile.mkdtemp(prefix="yast-arrow-")
+    try:
+        results = {}
+        for backend in (settings.STORAGE_SQLITE, settings.STORAGE_ARROW):
+            pipeline.init_database()
+            tokenizer = pipeline.Tokenizer(args.log_file)
+            token_store = None
+            if backend == settings.STORAGE_ARROW:
+                token_store = tokenizer.store = ArrowStore(
+                    tokenizer.file_type)
+            steps = [tokenizer.run(),
+                     pipeline.Filter(args.log_file, ignore_list,
+                                     store=token_store).run()]
+            sessionizer = pipeline.Sessionizer(args.log_file, args.timeout,
+                                               store=token_store)
+            steps.append(sessionizer.run())
+            start = time.time()
+            if token_store is None:
+                results[backend] = list(pipeline.session_rows())
+                # Tokens and sessions, without the free pages of the
+                # previous runs
+                sizes = [table_bytes(name) for name in (
+                    tokenizer.token_model.__tablename__, "session_master",
+                    "uurl", "association")]
+                size = None if None in sizes else sum(sizes)
+            else:
+                results[backend] = sessionizer.results
+                token_store.write(directory, sessionizer.results,
+                                  sessionizer.url_codes)
+                size = directory_size(directory)
+            elapsed = time.time() - start
+            print("{0:>6}: {1:>7.2f} secs  tokenize {2:.2f}, filter {3:.2f}, "
+                  "sessionize {4:.2f}, {5} {6:.2f} secs, {7} on "
+                  "disk".format(
+                      backend, sum(s.elapsed for s in steps) + elapsed,
+                      steps[0].elapsed, steps[1].elapsed, steps[2].elapsed,
+                      "read" if token_store is None else "write Parquet",
+                      elapsed, "?" if size is None
+                      else "%.2f MB" % (size / 1048576.0)))
+        if results[settings.STORAGE_SQLITE] != \
+                results[settings.STORAGE_ARROW]:
+            print("Sessions of the backends differ!")
+            return 1
+        print("Sessions identical, %d sessions"
+              % len(results[settings.STORAGE_ARROW]))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def bench_profiles(args):
+    """ Sessionizing another filter profile of the tokens in the database
+    compared with tokenizing, filtering and sessionizing the log again """
+    ignore_lists = [[x for x in ignore.split(",") if x]
+                    for ignore in args.ignore_lists.split(";")]
+    pipeline.init_database()
+    stats = pipeline.Tokenizer(args.log_file).run()
+    print("tokenize once: {0:.2f} secs  {1} tokens".format(
+        stats.elapsed, stats.rows_out))
+    profiles = []
+    for index, ignore_list in enumerate(ignore_lists):
+        name = "profile%d" % index
+        start = time.time()
+        pipeline.Filter(args.log_file, ignore_list, profile=name).run()
+        stats = pipeline.Sessionizer(args.log_file, args.timeout,
+                                     profile=name).run()
+        elapsed = time.time() - start
+        profiles.append((elapsed, stats.rows_in, stats.rows_out,
+                         session_contents()))
+    for ignore_list, (elapsed, tokens, sessions, contents) in zip(
+            ignore_lists, profiles):
+        pipeline.init_database()
+        steps = [pipeline.Tokenizer(args.log_file).run(),
+                 pipeline.Filter(args.log_file, ignore_list).run(),
+                 pipeline.Sessionizer(args.log_file, args.timeout).run()]
+        print("ignore {0:<16} profile {1:>6.2f} secs  again {2:>6.2f} secs  "
+              "{3} tokens, {4} sessions".format(
+                  ",".join(ignore_list) or "-", elapsed,
+                  sum(step.elapsed for step in steps), tokens, sessions))
+        if session_contents() != contents:
+            print("Sessions of the profile differ from filtering the tokens!")
+            return 1
+    print("Sessions identical")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="bench", description="Benchmarks of the YAST pipeline")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    tokenize_parser = subparsers.add_parser(
+        "tokenize", help="Tokenization scaling with worker processes")
+    tokenize_parser.add_argument("log_file")
+    tokenize_parser.add_argument("--workers", type=int_list, default=[1, 2, 4],
+                                 help="Comma separated worker counts")
+    tokenize_parser.set_defaults(func=bench_tokenize)
+
+    ingest_parser = subparsers.add_parser(
+        "ingest", help="ORM compared with Core bulk insert of tokens")
+    ingest_parser.add_argument("log_file")
+    ingest_parser.set_defaults(func=bench_ingest)
+
+    memory_parser = subparsers.add_parser(
+        "memory", help="Memory per token of ORM objects and TokenStore")
+    memory_parser.add_argument("log_file")
+    memory_parser.set_defaults(func=bench_memory)
+
+    compressed_parser = subparsers.add_parser(
+        "compressed", help="Compressed log read directly or decompressed "
+        "to disk first")
+    compressed_parser.add_argument("log_file")
+    compressed_parser.set_defaults(func=bench_compressed)
+
+    parser_parser = subparsers.add_parser(
+        "parser", help="Throughput of the hand written Apache parser and "
+        "the regex")
+    parser_parser.add_argument("--log-file",
+                               help="Use the lines of a log file instead of "
+                               "a generated corpus")
+    parser_parser.add_argument("--lines", type=int, default=200000,
+                               help="Number of lines to generate")
+    parser_parser.add_argument("--seed", type=int, default=0)
+    parser_parser.add_argument("--tail-quotes", type=int, default=2000,
+                               help="Quotes in the tail of the line used to "
+                               "time the worst case of the regex")
+    parser_parser.set_defaults(func=bench_parser)
+
+    mapped_parser = subparsers.add_parser(
+        "mapped", help="Text reader compared with the memory mapped reader "
+        "filling the token store")
+    mapped_parser.add_argument("log_file")
+    mapped_parser.set_defaults(func=bench_mapped)
+
+    sessionize_parser = subparsers.add_parser(
+        "sessionize", help="Sessionization scaling with worker processes")
+    sessionize_parser.add_argument("log_file")
+    sessionize_parser.add_argument("--workers", type=int_list,
+                                   default=[1, 2, 4],
+                                   help="Comma separated worker counts")
+    sessionize_parser.add_argument("--timeout", type=int, default=30,
+                                   help="Session time in minutes")
+    sessionize_parser.set_defaults(func=bench_sessionize)
+
+    sweep_parser = subparsers.add_parser(
+        "sweep", help="Single pass over several session timeouts compared "
+        "with one sessionization per timeout")
+    sweep_parser.add_argument("log_file")
+    sweep_parser.add_argument("--timeouts", type=int_list,
+                              default=[5, 10, 15, 30, 60],
+                              help="Comma separated session times in minutes")
+    sweep_parser.set_defaults(func=bench_sweep)
+
+    incremental_parser = subparsers.add_parser(
+        "incremental", help="Incremental sessionization of a growing log "
+        "compared with a full rebuild")
+    incremental_parser.add_argument("log_file")
+    incremental_parser.add_argument("--steps", type=int, default=10,
+                                    help="Number of parts the log is "
+                                    "appended in")
+    incremental_parser.add_argument("--timeout", type=int, default=30,
+                                    help="Session time in minutes")
+    incremental_parser.add_argument("--url-storage",
+                                    choices=[settings.URLS_ASSOCIATION,
+                                             settings.URLS_CLICK_PATH])
+    incremental_parser.set_defaults(func=bench_incremental)
+
+    vectorized_parser = subparsers.add_parser(
+        "vectorized", help="NumPy sessionization of the token store compared "
+        "with the loop, on generated tokens")
+    vectorized_parser.add_argument("--tokens", type=int, default=10000000)
+    vectorized_parser.add_argument("--ips", type=int, default=200000)
+    vectorized_parser.add_argument("--urls", type=int, default=50000)
+    vectorized_parser.add_argument("--days", type=int, default=30)
+    vectorized_parser.add_argument("--timeout", type=int, default=30,
+                                   help="Session time in minutes")
+    vectorized_parser.add_argument("--seed", type=int, default=0)
+    vectorized_parser.set_defaults(func=bench_vectorized)
+
+    inserts_parser = subparsers.add_parser(
+        "inserts", help="Sessions written with ORM objects compared with "
+        "Core executemany")
+    inserts_parser.add_argument("log_file")
+    inserts_parser.add_argument("--timeout", type=int, default=30,
+                                help="Session time in minutes")
+    inserts_parser.set_defaults(func=bench_inserts)
+
+    export_parser = subparsers.add_parser(
+        "export", help="Export of the sessions with a query per session "
+        "compared with set-based queries")
+    export_parser.add_argument("log_file")
+    export_parser.add_argument("--timeout", type=int, default=30,
+                               help="Session time in minutes")
+    export_parser.set_defaults(func=bench_export)
+
+    clickpath_parser = subparsers.add_parser(
+        "clickpath", help="Storage size and read time of the session urls "
+        "as association rows and as packed click paths")
+    clickpath_parser.add_argument("log_file")
+    clickpath_parser.add_argument("--timeout", type=int, default=30,
+                                  help="Session time in minutes")
+    clickpath_parser.set_defaults(func=bench_clickpath)
+
+    extsort_parser = subparsers.add_parser(
+        "extsort", help="Sessionization with an external sort of the tokens "
+        "compared with the token table")
+    extsort_parser.add_argument("log_file")
+    extsort_parser.add_argument("--sort-memory", type=float, default=4,
+                                help="Memory budget of the sort in megabytes")
+    extsort_parser.add_argument("--timeout", type=int, default=30,
+                                help="Session time in minutes")
+    extsort_parser.set_defaults(func=bench_extsort)
+
+    bulkload_parser = subparsers.add_parser(
+        "bulkload", help="Loads with and without the bulk load pragmas and "
+        "deferred index creation")
+    bulkload_parser.add_argument("log_file")
+    bulkload_parser.add_argument("--ignore", default="css,png,jpg,js",
+                                 help="Comma separated file extensions to "
+                                 "remove while filtering")
+    bulkload_parser.add_argument("--timeout", type=int, default=30,
+                                 help="Session time in minutes")
+    bulkload_parser.set_defaults(func=bench_bulkload)
+
+    cache_parser = subparsers.add_parser(
+        "cache", help="Tokenization compared with loading the tokens from "
+        "the token cache")
+    cache_parser.add_argument("log_file")
+    cache_parser.set_defaults(func=bench_cache)
+
+    indexes_parser = subparsers.add_parser(
+        "indexes", help="Build and query time of the single column and "
+        "composite token indexes")
+    indexes_parser.add_argument("log_file")
+    indexes_parser.add_argument("--ips", type=int, default=1000,
+                                help="Number of ip addresses queried one by "
+                                "one")
+    indexes_parser.set_defaults(func=bench_indexes)
+
+    arrow_parser = subparsers.add_parser(
+        "arrow", help="Pipeline with the SQLite and the Arrow backend")
+    arrow_parser.add_argument("log_file")
+    arrow_parser.add_argument("--ignore", default="css,png,jpg,js",
+                              help="Comma separated file extensions to "
+                              "remove while filtering")
+    arrow_parser.add_argument("--timeout", type=int, default=30,
+                              help="Session time in minutes")
+    arrow_parser.set_defaults(func=bench_arrow)
+
+    profiles_parser = subparsers.add_parser(
+        "profiles", help="Filter profiles compared with tokenizing and "
+        "filtering the log again")
+    profiles_parser.add_argument("log_file")
+    profiles_parser.add_argument("--ignore-lists", default="css,png,jpg,js;"
+                                 "css,js;;gif,jpg,png",
+                                 help="Semicolon separated ignore lists, one "
+                                 "filter profile each")
+    profiles_parser.add_argument("--timeout", type=int, default=30,
+                                 help="Session time in minutes")
+    profiles_parser.set_defaults(func=bench_profiles)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.CRITICAL)
+    # The benchmarks measure tokenization, which the cache would skip
+    settings.TOKEN_CACHE = False
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,412 @@
+"""
+Command line interface of YAST. Runs the pipeline without PyQt so that logs
+can be sessionized on servers with no display.
+
+Usage:
+    python src/cli.py run access.log --format combined --timeout 30 \
+        --out sessions.csv
+    python src/cli.py run access.log --backend arrow --parquet-dir parquet/
+    python src/cli.py sweep access.log --timeouts 5,10,15,30,60 \
+        --out-dir sweep/
+    python src/cli.py run access.log --ignore css,js --profile pages
+    python src/cli.py profile access.log --ignore css,js,png --profile \
+        no_images --out sessions.csv
+"""
+
+import os
+import sys
+import atexit
+import argparse
+import logging
+import settings
+import pipeline
+import arrowstore
+from store import TokenStore
+from arrowstore import ArrowStore
+from extsort import TokenSorter
+
+
+def db_delete():
+    if os.path.exists(settings.DATABASE_NAME):
+        os.remove(settings.DATABASE_NAME)
+
+
+def ignore_list(args):
+    """ File extensions of --ignore """
+    return [x.replace(".", "").strip() for x in (args.ignore or "").split(",")
+            if x.strip()]
+
+
+def profile_criteria(args, file_type):
+    """ Ignore criteria saved to the filter profile, None for the default
+    criteria of the log format """
+    if args.min_size is None:
+        return None
+    return dict(pipeline.ignore_criteria(file_type),
+                size_of_object=args.min_size)
+
+
+def load(args, store_type=None, sorter=None):
+    """
+    Tokenize and filter a log file.
+    :param store_type:  TokenStore or ArrowStore to keep the tokens in
+                        instead of the database
+    :param sorter:      Optional TokenSorter given the tokens instead of the
+                        database. They are filtered while tokenizing.
+    :return:            Tuple (tokenizer, store), None if the log file can't
+                        be tokenized
+    """
+    f_type = settings.LOG_FORMATS[args.format] if args.format else None
+    ignored = ignore_list(args)
+    filter_early = args.filter_early or sorter is not None
+    if args.profile and (filter_early or store_type is not None):
+        print("--profile keeps the ignored tokens in the database and can't "
+              "be used with --filter-early, --in-memory, --backend %s or "
+              "--sort-memory" % settings.STORAGE_ARROW, file=sys.stderr)
+        return None
+    if args.min_size is not None and not args.profile:
+        print("--min-size needs --profile", file=sys.stderr)
+        return None
+
+    pipeline.init_database(drop=not args.incremental)
+    try:
+        tokenizer = pipeline.Tokenizer(
+            args.log_file, f_type, workers=args.workers,
+            incremental=args.incremental,
+            ignore_list=ignored if filter_early else None,
+            sorter=sorter, bulk_load=args.bulk_load,
+            cache=args.cache)
+    except TypeError:
+        print("Log file doesn't match the selected log format (%s)"
+              % args.format, file=sys.stderr)
+        return None
+    except (OSError, IOError, ValueError) as e:
+        print(str(e), file=sys.stderr)
+        return None
+
+    store = None
+    if store_type is not None:
+        store = store_type(tokenizer.file_type)
+        tokenizer.store = store
+
+    try:
+        print(tokenizer.run())
+    except (OSError, IOError) as e:
+        print(str(e), file=sys.stderr)
+        return None
+    if tokenizer.from_cache:
+        print("tokens loaded from the token cache in %s"
+              % settings.TOKEN_CACHE_DIR)
+    if filter_early:
+        print("filter while tokenizing: %s" % tokenizer.ignore_rules)
+    else:
+        print(pipeline.Filter(
+            args.log_file, ignored, store=store, bulk_load=args.bulk_load,
+            profile=args.profile,
+            criteria=profile_criteria(args, tokenizer.file_type)).run())
+    return tokenizer, store
+
+
+def url_memory(args):
+    """ Memory budget of the distinct urls in bytes """
+    if args.url_memory is None:
+        return None
+    return args.url_memory * 1024 * 1024
+
+
+def run(args):
+    """ Tokenize, filter and sessionize a log file """
+    arrow = args.backend == settings.STORAGE_ARROW
+    if arrow and not arrowstore.available():
+        print("--backend %s needs pyarrow and NumPy"
+              % settings.STORAGE_ARROW, file=sys.stderr)
+        return 1
+    if args.parquet_dir and not arrow:
+        print("--parquet-dir needs --backend %s" % settings.STORAGE_ARROW,
+              file=sys.stderr)
+        return 1
+    in_memory = args.in_memory or arrow
+    if args.incremental and in_memory:
+        print("--incremental needs the tokens of the previous runs in the "
+              "database and can't be used with --in-memory or --backend %s"
+              % settings.STORAGE_ARROW, file=sys.stderr)
+        return 1
+    if in_memory and (args.click_path_out or args.url_storage):
+        print("--url-storage and --click-path-out apply to the sessions in "
+              "the database and can't be used with --in-memory or --backend "
+              "%s" % settings.STORAGE_ARROW, file=sys.stderr)
+        return 1
+    if args.sort_memory is not None and (in_memory or args.incremental):
+        print("--sort-memory sessionizes the tokens without storing them "
+              "and can't be used with --in-memory, --backend %s or "
+              "--incremental" % settings.STORAGE_ARROW, file=sys.stderr)
+        return 1
+    if args.click_path_out and \
+            args.url_storage != settings.URLS_CLICK_PATH:
+        print("--click-path-out needs --url-storage %s"
+              % settings.URLS_CLICK_PATH, file=sys.stderr)
+        return 1
+
+    sorter = None
+    if args.sort_memory is not None:
+        sorter = TokenSorter(int(args.sort_memory * 1024 * 1024))
+    store_type = None
+    if arrow:
+        store_type = ArrowStore
+    elif args.in_memory:
+        store_type = TokenStore
+    loaded = load(args, store_type, sorter)
+    if loaded is None:
+        return 1
+    tokenizer, store = loaded
+    rules = None
+    if not (args.profile or args.filter_early or sorter is not None):
+        # The Filter deleted the ignored tokens
+        rules = pipeline.filter_rules(tokenizer.file_type, ignore_list(args))
+    sessionizer = pipeline.Sessionizer(args.log_file, args.timeout,
+                                       store=store,
+                                       url_memory=url_memory(args),
+                                       workers=args.session_workers,
+                                       incremental=args.incremental,
+                                       url_storage=args.url_storage,
+                                       sorter=sorter,
+                                       bulk_load=args.bulk_load,
+                                       profile=args.profile,
+                                       filter_rules=rules)
+    print(sessionizer.run())
+    if sessionizer.inserter is not None:
+        print(sessionizer.inserter)
+    if args.out:
+        if store is not None:
+            count = pipeline.write_sessions(args.out, sessionizer.results)
+        else:
+            count = pipeline.export_sessions(args.out)
+        print("%d sessions written to %s" % (count, args.out))
+    if args.parquet_dir:
+        for path in store.write(args.parquet_dir, sessionizer.results,
+                                sessionizer.url_codes):
+            print("Written %s" % path)
+    if args.click_path_out:
+        count = pipeline.export_click_paths(args.click_path_out)
+        print("%d click paths written to %s" % (count, args.click_path_out))
+    return 0
+
+
+def sweep(args):
+    """ Tokenize and filter a log file, then sessionize it with every
+    session timeout in a single pass """
+    if load(args) is None:
+        return 1
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+    sessionizer = pipeline.SessionSweep(args.log_file, args.timeouts,
+                                        out_dir=args.out_dir,
+                                        url_memory=url_memory(args),
+                                        profile=args.profile)
+    print(sessionizer.run())
+    for timer_stats in sessionizer.timer_stats:
+        print(timer_stats)
+    if args.out_dir:
+        print("Sessions written to %s" % args.out_dir)
+    return 0
+
+
+def profile(args):
+    """ Sessionize the tokens kept in the database by an earlier run with a
+    filter profile, without tokenizing the log again """
+    pipeline.init_database(drop=False)
+    try:
+        log_file = pipeline.LogFile(args.log_file)
+        if log_file.session.query(
+                log_file.token_model.token_id).first() is None:
+            print("No tokens of %s in %s. Tokenize the log keeping every "
+                  "token first: yast run %s --profile %s"
+                  % (args.log_file, settings.DATABASE_NAME, args.log_file,
+                     args.profile), file=sys.stderr)
+            return 1
+        if args.ignore is not None or args.min_size is not None:
+            filtering = pipeline.Filter(args.log_file, ignore_list(args),
+                                        profile=args.profile)
+            filtering.criteria = profile_criteria(args, filtering.file_type)
+            print(filtering.run())
+        sessionizer = pipeline.Sessionizer(args.log_file, args.timeout,
+                                           url_memory=url_memory(args),
+                                           workers=args.session_workers,
+                                           bulk_load=args.bulk_load,
+                                           profile=args.profile)
+        stats = sessionizer.run()
+    except (OSError, IOError, ValueError) as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    print(stats)
+    if args.out:
+        count = pipeline.export_sessions(args.out)
+        print("%d sessions written to %s" % (count, args.out))
+    return 0
+
+
+def int_list(value):
+    return [int(x) for x in value.split(",")]
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="yast", description="YAST - Yet Another Sessionization Tool")
+    parser.add_argument("--log", default="yast.log",
+                        help="File to write the log messages to")
+    parser.add_argument("--keep-db", action="store_true",
+                        help="Do not delete %s on exit"
+                        % settings.DATABASE_NAME)
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    # Options of the tokenization and filtering steps
+    log_parser = argparse.ArgumentParser(add_help=False)
+    log_parser.add_argument("log_file")
+    log_parser.add_argument("--format", choices=sorted(settings.LOG_FORMATS),
+                            help="Log file format. Detected if omitted")
+    log_parser.add_argument("--ignore", default="",
+                            help="Comma separated file extensions to remove "
+                            "while filtering")
+    log_parser.add_argument("--workers", type=int,
+                            default=settings.TOKENIZER_WORKERS,
+                            help="Number of tokenizer processes")
+    log_parser.add_argument("--filter-early", action="store_true",
+                            help="Drop ignored lines while tokenizing instead "
+                            "of deleting them from the database afterwards")
+    log_parser.add_argument("--incremental", action="store_true",
+                            help="Only tokenize and sessionize the lines "
+                            "appended since the last incremental run. "
+                            "Implies --keep-db")
+    log_parser.add_argument("--cache", action="store_true",
+                            default=settings.TOKEN_CACHE,
+                            help="Copy the tokens of an unchanged log from "
+                            "the token cache instead of parsing it, and "
+                            "cache the tokens of the other logs. The cache "
+                            "is in %s (YAST_CACHE_DIR) and holds up to %d "
+                            "MB" % (settings.TOKEN_CACHE_DIR,
+                                    settings.TOKEN_CACHE_BUDGET // 1048576))
+    log_parser.add_argument("--bulk-load", action="store_true",
+                            default=settings.BULK_LOAD,
+                            help="Load the database with WAL, relaxed "
+                            "synchronous and a large cache, and build the "
+                            "secondary indexes after the load")
+    log_parser.add_argument("--profile",
+                            help="Save the ignore criteria as a filter "
+                            "profile of this name instead of deleting the "
+                            "ignored tokens, and sessionize the tokens it "
+                            "keeps. Implies --keep-db")
+    log_parser.add_argument("--min-size", type=int,
+                            help="Ignore responses of at most this many "
+                            "bytes in the filter profile. Defaults to %d"
+                            % settings.apache_ignore_criteria[
+                                'size_of_object'])
+    log_parser.add_argument("--url-memory", type=float,
+                            help="Megabytes of distinct urls kept in memory "
+                            "while sessionizing before they are moved to a "
+                            "temporary file. Defaults to %d"
+                            % (settings.URL_MEMORY_BUDGET // (1024 * 1024)))
+
+    run_parser = subparsers.add_parser(
+        "run", parents=[log_parser],
+        help="Tokenize, filter and sessionize a log file")
+    run_parser.add_argument("--timeout", type=int, default=30,
+                            help="Session time in minutes")
+    run_parser.add_argument("--session-workers", type=int,
+                            default=settings.SESSIONIZER_WORKERS,
+                            help="Number of sessionizer processes")
+    run_parser.add_argument("--in-memory", action="store_true",
+                            help="Keep the tokens in a columnar in-memory "
+                            "store instead of the database")
+    run_parser.add_argument("--backend",
+                            choices=[settings.STORAGE_SQLITE,
+                                     settings.STORAGE_ARROW],
+                            default=settings.STORAGE_BACKEND,
+                            help="Keep the tokens in the SQLite database or "
+                            "in Arrow record batches. Defaults to %s"
+                            % settings.STORAGE_BACKEND)
+    run_parser.add_argument("--parquet-dir",
+                            help="Directory to write the tokens, sessions and "
+                            "urls to as Parquet files. Needs --backend %s"
+                            % settings.STORAGE_ARROW)
+    run_parser.add_argument("--sort-memory", type=float,
+                            help="Sessionize without storing the tokens in "
+                            "the database: they are sorted with at most this "
+                            "many megabytes in memory, in sorted runs on disk "
+                            "beyond it. Ignored lines are dropped while "
+                            "tokenizing")
+    run_parser.add_argument("--out", help="CSV file to save the sessions to")
+    run_parser.add_argument("--url-storage",
+                            choices=[settings.URLS_ASSOCIATION,
+                                     settings.URLS_CLICK_PATH],
+                            help="Store the distinct urls of a session as "
+                            "association rows, or the url of every request "
+                            "as a packed click path. Defaults to %s"
+                            % settings.SESSION_URL_STORAGE)
+    run_parser.add_argument("--click-path-out",
+                            help="CSV file to save the click path of every "
+                            "session to. Needs --url-storage %s"
+                            % settings.URLS_CLICK_PATH)
+    run_parser.set_defaults(func=run)
+
+    sweep_parser = subparsers.add_parser(
+        "sweep", parents=[log_parser],
+        help="Sessionize a log file with several session timeouts in a "
+        "single pass")
+    sweep_parser.add_argument("--timeouts", type=int_list,
+                              default=[5, 10, 15, 30, 60],
+                              help="Comma separated session times in minutes")
+    sweep_parser.add_argument("--out-dir",
+                              help="Directory to save urls.csv and a "
+                              "sessions_<timeout>.csv file per timeout to")
+    sweep_parser.set_defaults(func=sweep)
+
+    profile_parser = subparsers.add_parser(
+        "profile", help="Sessionize the tokens kept in the database with a "
+        "filter profile, without tokenizing the log again. Implies --keep-db")
+    profile_parser.add_argument("log_file")
+    profile_parser.add_argument("--profile", required=True,
+                                help="Name of the filter profile")
+    profile_parser.add_argument("--ignore",
+                                help="Comma separated file extensions the "
+                                "profile ignores. With --ignore or --min-size "
+                                "the profile is created or replaced, "
+                                "otherwise the saved one is used")
+    profile_parser.add_argument("--min-size", type=int,
+                                help="Ignore responses of at most this many "
+                                "bytes. Defaults to %d"
+                                % settings.apache_ignore_criteria[
+                                    'size_of_object'])
+    profile_parser.add_argument("--timeout", type=int, default=30,
+                                help="Session time in minutes")
+    profile_parser.add_argument("--session-workers", type=int,
+                                default=settings.SESSIONIZER_WORKERS,
+                                help="Number of sessionizer processes")
+    profile_parser.add_argument("--bulk-load", action="store_true",
+                                default=settings.BULK_LOAD,
+                                help="Write the sessions with the bulk load "
+                                "pragmas and deferred index creation")
+    profile_parser.add_argument("--url-memory", type=float,
+                                help="Megabytes of distinct urls kept in "
+                                "memory while sessionizing")
+    profile_parser.add_argument("--out",
+                                help="CSV file to save the sessions to")
+    profile_parser.set_defaults(func=profile)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if not (args.keep_db or getattr(args, "incremental", False) or
+            args.profile):
+        atexit.register(db_delete)
+    logging.basicConfig(
+        filename=args.log, level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p')
+    logging.info('Started YAST command line interface')
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+"""
+Packed click paths.
+
+The click path of a session is the url id of every request, in the order
+they were made. It is stored in a single blob next to the session instead of
+a row per url in the association table. Every id is written as a varint:
+7 bits per byte, least significant group first, with the high bit set on
+every byte but the last. Ids below 128 take one byte, below 16384 two.
+
+Blobs can be concatenated, so a session is extended by appending the
+encoding of its new clicks.
+"""
+
+
+def encode(url_ids):
+    """
+    Pack url ids into a varint blob.
+    :param url_ids: Iterable of non negative integers
+    :return:        bytes
+    """
+    out = bytearray()
+    append = out.append
+    for value in url_ids:
+        while value > 0x7f:
+            append(value & 0x7f | 0x80)
+            value >>= 7
+        append(value)
+    return bytes(out)
+
+
+def decode(blob):
+    """
+    Unpack a varint blob.
+    :param blob:    bytes returned by encode()
+    :return:        List of url ids
+    """
+    url_ids = []
+    append = url_ids.append
+    value = shift = 0
+    for byte in blob:
+        if byte < 0x80:
+            append(value | byte << shift)
+            value = shift = 0
+        else:
+            value |= (byte & 0x7f) << shift
+            shift += 7
+    if shift:
+        raise ValueError("Click path ends in the middle of a url id")
+    return url_ids
+
+
+def distinct(url_ids):
+    """ Url ids of a click path without repetitions, in the order they were
+    first requested. This is what the association table stores. """
+    seen = set()
+    add = seen.add
+    return [url_id for url_id in url_ids
+            if not (url_id in seen or add(url_id))]
@@ -0,0 +1,146 @@
+"""
+External sort of the tokens sessionized without the token table.
+
+Tokens are added in log order and kept in memory until they exceed a memory
+budget. They are then sorted by ip address, time and position in the log and
+written to a run file in a temporary directory. Reading the sorted tokens
+merges all runs. When there are more runs than MERGE_FAN_IN they are first
+merged into longer runs, so that at most MERGE_FAN_IN blocks of tokens are
+in memory during a merge.
+"""
+
+import os
+import sys
+import heapq
+import pickle
+import shutil
+import logging
+import tempfile
+from itertools import islice
+
+# Estimated memory used by a token tuple, its time, position and size, on
+# top of the ip address and url
+ENTRY_SIZE = 200
+# Largest number of runs merged at a time
+MERGE_FAN_IN = 64
+# Number of tokens pickled together in a run file when there is no budget
+BLOCK_SIZE = 1000
+
+
+def read_run(path):
+    """ Yields the tokens of a run file in order """
+    with open(path, "rb") as run:
+        while True:
+            try:
+                block = pickle.load(run)
+            except EOFError:
+                return
+            for token in block:
+                yield token
+
+
+class TokenSorter(object):
+    """
+    Sorts (ip address, time, url, size) tokens by ip address and time.
+    Tokens with the same ip address and time stay in the order they were
+    added, as they do when the token table is ordered by token_id.
+    """
+
+    def __init__(self, memory_budget=None):
+        """
+        :param memory_budget:   Estimated number of bytes the tokens may use
+                                in memory before they are written to a run
+                                file. None keeps every token in memory.
+        """
+        super(TokenSorter, self).__init__()
+        self.memory_budget = memory_budget
+        # Tokens added since the last spill, as (ip address, time, position,
+        # url, size)
+        self.tokens = []
+        self.memory = 0
+        self.count = 0
+        # Temporary directory and paths of the sorted runs
+        self.directory = None
+        self.runs = []
+        self.run_count = 0
+        # Tokens per pickled block, set by the first spill
+        self.block_size = BLOCK_SIZE
+
+    def __len__(self):
+        return self.count
+
+    def add(self, ip, date_time, url, size):
+        """ Add a token. Tokens are numbered in the order they are added. """
+        self.tokens.append((ip, date_time, self.count, url, size))
+        self.count += 1
+        self.memory += sys.getsizeof(ip) + sys.getsizeof(url) + ENTRY_SIZE
+        if self.memory_budget is not None and \
+                self.memory > self.memory_budget:
+            self.spill()
+
+    def spill(self):
+        """ Sort the tokens kept in memory and write them to a new run """
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix="yast-sort-")
+            # A block of every run being merged fits into the budget
+            token_size = self.memory / float(len(self.tokens))
+            self.block_size = max(1, int(
+                self.memory_budget / (MERGE_FAN_IN * token_size)))
+            logging.info("Token memory budget exceeded, writing sorted runs "
+                         "to %s" % self.directory)
+        self.tokens.sort()
+        self.runs.append(self.write_run(self.tokens))
+        self.tokens = []
+        self.memory = 0
+
+    def write_run(self, tokens):
+        """
+        Write sorted tokens to a new run file.
+        :param tokens:  Iterable of sorted tokens
+        :return:        Path of the run file
+        """
+        path = os.path.join(self.directory, "run%d" % self.run_count)
+        self.run_count += 1
+        tokens = iter(tokens)
+        with open(path, "wb") as run:
+            while True:
+                block = list(islice(tokens, self.block_size))
+                if not block:
+                    break
+                pickle.dump(block, run, pickle.HIGHEST_PROTOCOL)
+        return path
+
+    def merge_runs(self):
+        """ Merge the oldest runs until at most MERGE_FAN_IN are left """
+        while len(self.runs) > MERGE_FAN_IN:
+            paths = self.runs[:MERGE_FAN_IN]
+            merged = self.write_run(
+                heapq.merge(*[read_run(path) for path in paths]))
+            for path in paths:
+                os.remove(path)
+            self.runs = self.runs[MERGE_FAN_IN:] + [merged]
+
+    def sorted_tokens(self):
+        """ Yields (ip address, time, url, size) of every token ordered by
+        ip address and time """
+        if self.runs:
+            if self.tokens:
+                self.spill()
+            self.merge_runs()
+            logging.info("Merging %d sorted runs of %d tokens"
+                         % (len(self.runs), self.count))
+            tokens = heapq.merge(*[read_run(path) for path in self.runs])
+        else:
+            self.tokens.sort()
+            tokens = self.tokens
+        for ip, date_time, _, url, size in tokens:
+            yield ip, date_time, url, size
+
+    def close(self):
+        """ Drop the tokens and delete the run files """
+        self.tokens = []
+        self.memory = 0
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+            self.runs = []
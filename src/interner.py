@@ -0,0 +1,98 @@
+"""
+Url interning table used by the sessionizer.
+
+Urls get their ids in memory, in the order they are first requested, so that
+no query is needed to find the id of a url. The table is written to the uurl
+table in a single bulk insert once sessionization is done.
+
+When the urls kept in memory exceed a memory budget they are moved to a
+temporary SQLite file, and only the urls interned since then stay in memory.
+"""
+
+import os
+import sys
+import shutil
+import sqlite3
+import logging
+import tempfile
+
+# Estimated memory used by a dict entry and its int id, on top of the url
+ENTRY_SIZE = 100
+
+
+class UrlInterner(object):
+    """ Assigns ids 1, 2, 3, ... to urls in the order they are first seen """
+
+    def __init__(self, memory_budget=None):
+        """
+        :param memory_budget:   Estimated number of bytes the urls may use
+                                in memory before they are moved to disk. None
+                                keeps every url in memory.
+        """
+        super(UrlInterner, self).__init__()
+        self.memory_budget = memory_budget
+        # Urls interned since the last spill and their ids
+        self.ids = {}
+        self.memory = 0
+        self.count = 0
+        # Temporary directory and database holding the spilled urls
+        self.directory = None
+        self.spilled = None
+
+    def __len__(self):
+        return self.count
+
+    def intern(self, url):
+        """ Id of a url. A new id is assigned the first time it is seen. """
+        url_id = self.ids.get(url)
+        if url_id is not None:
+            return url_id
+        if self.spilled is not None:
+            row = self.spilled.execute(
+                "SELECT id FROM urls WHERE url = ?", (url,)).fetchone()
+            if row is not None:
+                return row[0]
+        self.count += 1
+        self.ids[url] = self.count
+        self.memory += sys.getsizeof(url) + ENTRY_SIZE
+        if self.memory_budget is not None and \
+                self.memory > self.memory_budget:
+            self.spill()
+        return self.count
+
+    def spill(self):
+        """ Move the urls kept in memory to the temporary database """
+        if self.spilled is None:
+            self.directory = tempfile.mkdtemp(prefix="yast-urls-")
+            self.spilled = sqlite3.connect(
+                os.path.join(self.directory, "urls.db"))
+            self.spilled.execute("PRAGMA journal_mode = OFF")
+            self.spilled.execute("PRAGMA synchronous = OFF")
+            self.spilled.execute("CREATE TABLE urls (id INTEGER PRIMARY KEY, "
+                                 "url TEXT UNIQUE)")
+            logging.info("Url memory budget exceeded, moving urls to %s"
+                         % self.directory)
+        self.spilled.executemany(
+            "INSERT INTO urls (id, url) VALUES (?, ?)",
+            sorted(((url_id, url) for url, url_id in self.ids.items())))
+        self.spilled.commit()
+        self.ids = {}
+        self.memory = 0
+
+    def items(self):
+        """ Yields (id, url) of every url ordered by id """
+        if self.spilled is not None:
+            for row in self.spilled.execute(
+                    "SELECT id, url FROM urls ORDER BY id"):
+                yield row
+        for url_id, url in sorted(
+                (url_id, url) for url, url_id in self.ids.items()):
+            yield url_id, url
+
+    def close(self):
+        """ Delete the temporary database """
+        if self.spilled is not None:
+            self.spilled.close()
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.spilled = None
+            self.directory = None
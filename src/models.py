@@ -1,55 +1,79 @@
 from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, \
-    Table, Interval
+    Table, Interval, LargeBinary, Index
 from sqlalchemy.orm import relationship
 import datetime
 import settings
 
 
-def get_or_create(session, model, **kwargs):
-    # Get the last item inserted
-    instance = session.query(model).filter_by(
-        **kwargs).order_by(model.id.desc()).first()
-    if instance:
-        return instance
-    else:
-        instance = model(**kwargs)
-        session.add(instance)
-        session.commit()
-        return instance
+def token_indexes(table_name, url, size):
+    """
+    Composite index of a token table. The session index holds the columns
+    read by the sessionizer in the order it reads them, so the tokens of an
+    ip address are read in time order from the index alone, without a sort.
+    token_id comes before the url and size so that tokens with the same time
+    stay in insertion order. The columns tested by the filtering step come
+    last, so the tokens of a filter profile are read from the index alone
+    too. The filtering step's condition is a disjunction of inequalities
+    which no index can search, Filter deletes in a scan of the table.
+    :param table_name:  Name of the token table, the indexes are named
+                        after it
+    :param url:         Name of the url column
+    :param size:        Name of the response size column
+    :return:            Tuple of Index objects for __table_args__
+    """
+    return (
+        Index("ix_%s_session" % table_name, "ip_address", "date_time",
+              "token_id", url, size, "status_code", "method", "request_ext"),
+    )
+
+
+def split_list(value):
+    """ Items of a comma separated string """
+    return value.split(",") if value else []
 
 
 class TokenCommon(settings.Base):
     __tablename__ = 'Token_common'
+    __table_args__ = token_indexes(__tablename__, "resource_requested",
+                                   "size_of_object")
+
+    # Columns filled from a log line, in the order returned by values()
+    COLUMNS = ('ip_address', 'user_identifier', 'user_id', 'date_time',
+               'time_zone', 'method', 'resource_requested', 'request_ext',
+               'protocol', 'status_code', 'size_of_object')
 
     def __init__(self, values):
         super(TokenCommon, self).__init__()
-        self.ip_address = values[0]
-        self.user_identifier = values[1]
-        self.user_id = values[2]
-        self.date_time = datetime.datetime.strptime(
-            values[3], settings.DATETIME_FORMAT)
-        self.time_zone = values[4]
-        self.method = values[5]
-        self.resource_requested = values[6].split("?")[0] if values[
-            6] else ""
-        self.request_ext = self.resource_requested.split(
-            ".")[-1] if values[6] else ""
-        self.protocol = values[7]
-        self.status_code = values[8]
-        self.size_of_object = values[9]
+        for column, value in zip(self.COLUMNS, self.values(values)):
+            setattr(self, column, value)
+
+    @staticmethod
+    def values(groups):
+        """
+        Convert the regex groups of a log line into a tuple of column values
+        :param groups: Groups matched by APACHE_COMMON_LOG_RE
+        :return: Tuple of values in the order of COLUMNS
+        """
+        resource_requested = groups[6].split("?")[0] if groups[6] else ""
+        request_ext = resource_requested.split(".")[-1] if groups[6] else ""
+        return (groups[0], groups[1], groups[2],
+                datetime.datetime.strptime(
+                    groups[3], settings.DATETIME_FORMAT),
+                groups[4], groups[5], resource_requested, request_ext,
+                groups[7], groups[8], groups[9])
 
     token_id = Column(Integer, primary_key=True)
-    ip_address = Column(String(50), index=True)
+    ip_address = Column(String(50))
     user_identifier = Column(String(50))
     user_id = Column(String(50))
     date_time = Column(DateTime)
     time_zone = Column(String(50))
-    method = Column(String(10), index=True)
+    method = Column(String(10))
     resource_requested = Column(String(100), index=True)
-    request_ext = Column(String(50), index=True)
+    request_ext = Column(String(50))
     protocol = Column(String(50))
-    status_code = Column(Integer, index=True)
-    size_of_object = Column(Integer, index=True)
+    status_code = Column(Integer)
+    size_of_object = Column(Integer)
 
     def __str__(self):
         return settings.APACHE_COMMON_OUTPUT_FORMAT.format(
@@ -61,81 +85,108 @@ class TokenCommon(settings.Base):
 
 class TokenCombined(settings.Base):
     __tablename__ = 'Token_combined'
+    __table_args__ = token_indexes(__tablename__, "resource_requested",
+                                   "size_of_object")
+
+    COLUMNS = TokenCommon.COLUMNS + ('referrer', 'user_agent')
 
     def __init__(self, values):
         super(TokenCombined, self).__init__()
-        self.ip_address = values[0]
-        self.user_identifier = values[1]
-        self.user_id = values[2]
-        self.date_time = datetime.datetime.strptime(
-            values[3], settings.DATETIME_FORMAT)
-        self.time_zone = values[4]
-        self.method = values[5]
-        self.resource_requested = values[6].split("?")[0] if values[
-            6] else ""
-        self.request_ext = self.resource_requested.split(
-            ".")[-1] if values[6] else ""
-        self.protocol = values[7]
-        self.status_code = values[8]
-        self.size_of_object = values[9]
-        self.referrer = values[10]
-        self.user_agent = values[11]
+        for column, value in zip(self.COLUMNS, self.values(values)):
+            setattr(self, column, value)
+
+    @staticmethod
+    def values(groups):
+        """
+        Convert the regex groups of a log line into a tuple of column values
+        :param groups: Groups matched by APACHE_COMBINED_LOG_RE
+        :return: Tuple of values in the order of COLUMNS
+        """
+        return TokenCommon.values(groups) + (groups[10], groups[11])
 
     token_id = Column(Integer, primary_key=True)
-    ip_address = Column(String(50), index=True)
+    ip_address = Column(String(50))
     user_identifier = Column(String(50))
     user_id = Column(String(50))
     date_time = Column(DateTime)
     time_zone = Column(String(50))
-    method = Column(String(10), index=True)
+    method = Column(String(10))
     resource_requested = Column(String(100), index=True)
-    request_ext = Column(String(50), index=True)
+    request_ext = Column(String(50))
     protocol = Column(String(50))
-    status_code = Column(Integer, index=True)
-    size_of_object = Column(Integer, index=True)
+    status_code = Column(Integer)
+    size_of_object = Column(Integer)
     referrer = Column(String(300))
     user_agent = Column(String(200))
 
 
 class TokenSquid(settings.Base):
     __tablename__ = 'Token_squid'
+    __table_args__ = token_indexes(__tablename__, "url", "bytes_delivered")
+
+    COLUMNS = ('date_time', 'duration', 'ip_address', 'status_code',
+               'bytes_delivered', 'method', 'url', 'user', 'hierarchy_code',
+               'type_content', 'request_ext')
 
     def __init__(self, values):
         super(TokenSquid, self).__init__()
+        for column, value in zip(self.COLUMNS, self.values(values)):
+            setattr(self, column, value)
+
+    @staticmethod
+    def values(groups):
+        """
+        Convert the regex groups of a log line into a tuple of column values
+        :param groups: Groups matched by SQUID_LOG_RE
+        :return: Tuple of values in the order of COLUMNS
+        """
+        url = groups[6].split("?")[0]
         # The timestamp string contains milliseconds which cannot be
         # directly removed. So the string is converted to float and
         # then to an int
-        self.date_time = datetime.datetime.fromtimestamp(int(float(values[0])))
-        self.duration = int(values[1])
-        self.ip_address = values[2]
-        self.status_code = int(values[3].split("/")[-1])
-        self.bytes_delivered = int(values[4])
-        self.method = values[5]
-        self.url = values[6].split("?")[0]
-        self.user = values[7]
-        self.hierarchy_code = values[8]
-        self.type_content = values[9]
-        self.request_ext = self.url.split(".")[-1]
+        return (datetime.datetime.fromtimestamp(int(float(groups[0]))),
+                int(groups[1]), groups[2], int(groups[3].split("/")[-1]),
+                int(groups[4]), groups[5], url, groups[7], groups[8],
+                groups[9], url.split(".")[-1])
 
     token_id = Column(Integer, primary_key=True)
     date_time = Column(DateTime)
     duration = Column(Integer)
-    ip_address = Column(String(50), index=True)
-    status_code = Column(Integer, index=True)
-    bytes_delivered = Column(Integer, index=True)
-    method = Column(String(10), index=True)
+    ip_address = Column(String(50))
+    status_code = Column(Integer)
+    bytes_delivered = Column(Integer)
+    method = Column(String(10))
     url = Column(String(50), index=True)
     user = Column(String(100))  # User Identity (RFC931)
     hierarchy_code = Column(String(50))
     type_content = Column(String(50))
-    request_ext = Column(String(20), index=True)
+    request_ext = Column(String(20))
+
+
+class SourceFile(settings.Base):
+    """
+    Tokenization state of a log file. Used to tokenize only the lines
+    appended since the last run.
+    """
+    __tablename__ = 'source_file'
+
+    id = Column(Integer, primary_key=True)
+    path = Column(String(500), unique=True)
+    # Fingerprint of the file at the last run. A different inode, a smaller
+    # size or a different head means that the log has been rotated.
+    inode = Column(Integer)
+    size = Column(Integer)
+    head_digest = Column(String(40))
+    # Number of bytes tokenized so far. Always the end of a complete line.
+    offset = Column(Integer)
+    last_run = Column(DateTime)
 
 
 # Defines many to many relationship between Uurl and Session Table
 association_table = Table('association', settings.Base.metadata,
                           Column('uurl_id', Integer, ForeignKey('uurl.id')),
                           Column('session_id', Integer,
-                                 ForeignKey('session_master.id'))
+                                 ForeignKey('session_master.id'), index=True)
                           )
 
 
@@ -144,7 +195,7 @@ class Uurl(settings.Base):
     __tablename__ = 'uurl'
 
     id = Column(Integer, primary_key=True)
-    url = Column(String(300))
+    url = Column(String(300), index=True)
     sessions = relationship(
         "Session", secondary=association_table, back_populates="session_urls")
 
@@ -161,6 +212,16 @@ class Session(settings.Base):
     ip = Column(String(20), index=True)
     start_time = Column(DateTime)
     end_time = Column(DateTime)
+    # Aggregates computed when the session is written, so that they can be
+    # read without joining the association and token tables
+    page_count = Column(Integer)  # Number of requests
+    url_count = Column(Integer)  # Number of distinct urls
+    total_bytes = Column(Integer)  # Sum of the sizes of the responses
+    first_url_id = Column(Integer)  # Url of the first request
+    last_url_id = Column(Integer)  # Url of the last request
+    # Url id of every request in order, packed by clickpath.encode(). Only
+    # stored instead of association rows with settings.URLS_CLICK_PATH.
+    click_path = Column(LargeBinary)
     session_urls = relationship(
         "Uurl", secondary=association_table, back_populates="sessions")
 
@@ -168,3 +229,65 @@ class Session(settings.Base):
         url = [int(x.id) for x in self.session_urls]
         return settings.SESSION_OUTPUT_FORMAT.format(
             self.id, self.ip, str(self.session_time), str(url))
+
+
+class SessionWatermark(settings.Base):
+    """
+    Last session of an ip address. Used to extend or close it when new
+    tokens of the ip address are sessionized.
+    """
+    __tablename__ = 'session_watermark'
+
+    ip = Column(String(50), primary_key=True)
+    # Time of the last token sessionized, i.e. the end of the session
+    last_time = Column(DateTime)
+    session_id = Column(Integer)
+
+
+class SessionizerState(settings.Base):
+    """
+    Tokens covered by the sessions in the database. Used to sessionize only
+    the tokens inserted since the last run.
+    """
+    __tablename__ = 'sessionizer_state'
+
+    id = Column(Integer, primary_key=True)
+    token_table = Column(String(50))
+    # Session timer in seconds
+    session_timer = Column(Integer)
+    # settings.SESSION_URL_STORAGE of the sessions
+    url_storage = Column(String(20))
+    # Name of the FilterProfile of the sessionized tokens, None for all
+    # tokens
+    filter_profile = Column(String(50))
+    # Ignore criteria of the Filter which deleted the ignored tokens, as in
+    # FilterProfile. None if the tokens weren't deleted by a Filter.
+    ignore_list = Column(String)
+    methods = Column(String)
+    status_code = Column(Integer)
+    size_of_object = Column(Integer)
+    last_token_id = Column(Integer)
+
+
+class FilterProfile(settings.Base):
+    """
+    Named ignore criteria of the filtering step. The tokens they ignore are
+    left in the token table and skipped when the profile is sessionized, so
+    several profiles can be tried on the same tokens.
+    """
+    __tablename__ = 'filter_profile'
+
+    name = Column(String(50), primary_key=True)
+    token_table = Column(String(50))
+    # Comma separated file extensions and request methods
+    ignore_list = Column(String)
+    methods = Column(String)
+    status_code = Column(Integer)
+    size_of_object = Column(Integer)
+
+    def rules(self):
+        """ Tuple (ignore list, criteria) as given to Filter """
+        return (split_list(self.ignore_list), {
+            'status_code': self.status_code,
+            'method': split_list(self.methods),
+            'size_of_object': self.size_of_object})
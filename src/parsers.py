@@ -0,0 +1,228 @@
+"""
+Parsers that split a log line into the same groups as the log format regexes
+in settings.
+
+The lines are matched by the regexes. The trailing (\".*\") (\".*\") groups
+of the Apache Combined regex take quadratic time in the number of quotes to
+reject a line which doesn't end with a quote, so such lines are rejected
+before running the regex, as RawParser does.
+
+Apache Common and Combined lines can also be split by a hand written parser
+in a single forward pass (settings.FAST_APACHE_PARSER). It only accepts
+lines for which it is certain to return exactly the groups of the regex,
+every other line falls back to the regex.
+
+RawParser matches the lines of a memory mapped log without decoding them and
+returns the groups as bytes.
+"""
+
+import re
+import settings
+
+LOG_REGEXES = {
+    settings.APACHE_COMMON: settings.APACHE_COMMON_LOG_RE,
+    settings.APACHE_COMBINED: settings.APACHE_COMBINED_LOG_RE,
+    settings.SQUID: settings.SQUID_LOG_RE,
+}
+
+
+# Returned by the hand written parsers for lines the regex doesn't match
+NO_MATCH = False
+
+
+def parse_apache(line, combined=False):
+    """
+    Split an Apache Common or Combined log line.
+    :param line:        Line of the log file
+    :param combined:    True for the Apache Combined format
+    :return:            Tuple of the groups APACHE_COMMON_LOG_RE or
+                        APACHE_COMBINED_LOG_RE would match, NO_MATCH if the
+                        regex can't match the line either, None if the line
+                        has to be handled by the regex
+    """
+    if line[-1:] == "\n":
+        line = line[:-1]
+    parts = line.split(" ", 10)
+    if combined:
+        if len(parts) != 11:
+            return None
+        tail = parts.pop()
+    elif len(parts) != 10:
+        return None
+
+    # Every separator of the regex is a single \s. The checks below use
+    # isalnum() and isdecimal() which are the definitions of \w and \d, and
+    # none of them accepts white space. So a line separated by anything else
+    # than single spaces is always left to the regex.
+    ip, ident, user, date_time, time_zone, method, url, protocol, status, \
+        size = parts
+    # ([0-9\.]+)
+    if not ip or ip.strip("0123456789."):
+        return None
+    # ((?:\w+|-))
+    if ident != "-" and not ident.replace("_", "a").isalnum():
+        return None
+    # ([\w\d_-]*) or ([\w\d_\-\"\"]*)
+    if user:
+        user_chars = user.replace("_", "a").replace("-", "a")
+        if combined:
+            user_chars = user_chars.replace('"', "a")
+        if not user_chars.isalnum():
+            return None
+    # \[([\d\/\w:]*)
+    if date_time[:1] != "[" or (
+            len(date_time) > 1 and not date_time[1:].replace(
+                "/", "a").replace(":", "a").replace("_", "a").isalnum()):
+        return None
+    # ((?:\-|\+)\d+)\]
+    if (time_zone[-1:] != "]" or time_zone[:1] not in ("+", "-") or
+            not time_zone[1:-1].isdecimal()):
+        return None
+    # \"(\w+)
+    if method[:1] != '"' or not method[1:].replace("_", "a").isalnum():
+        return None
+    # (\S+)
+    if not url or not url.isprintable():
+        return None
+    # ([\w\d\/\.]*)\"
+    if protocol[-1:] != '"' or (
+            len(protocol) > 1 and not protocol[:-1].replace(
+                "/", "a").replace(".", "a").replace("_", "a").isalnum()):
+        return None
+    # (\d{3})
+    if len(status) != 3 or not status.isdecimal():
+        return None
+    # ((?:\d+|\-))
+    if size != "-" and not size.isdecimal():
+        return None
+    groups = (ip, ident, user, date_time[1:], time_zone[:-1], method[1:],
+              url, protocol[:-1], status, size)
+    if not combined:
+        return groups
+
+    # (\".*\") (\".*\")$ : the greedy first group ends at the last '" "'
+    # which leaves a quoted second group. The head is split at the only
+    # positions the regex could split it, so a tail which doesn't match here
+    # can't match the regex either. Returning NO_MATCH keeps such lines away
+    # from the regex, which takes quadratic time to reject them.
+    if len(tail) < 5 or tail[0] != '"' or tail[-1] != '"' or "\n" in tail:
+        return NO_MATCH
+    split = tail.rfind('" "', 1, len(tail) - 1)
+    if split == -1:
+        return NO_MATCH
+    return groups + (tail[:split + 1], tail[split + 2:])
+
+
+def parse_apache_combined(line):
+    return parse_apache(line, True)
+
+
+# Hand written parsers of every format
+FAST_PARSERS = {
+    settings.APACHE_COMMON: parse_apache,
+    settings.APACHE_COMBINED: parse_apache_combined,
+}
+
+
+def regex_parser(file_type):
+    """ Parser using only the regex of the log format """
+    match = re.compile(LOG_REGEXES[file_type]).match
+
+    def parse(line):
+        item = match(line)
+        return item.groups() if item else None
+    return parse
+
+
+def combined_parser():
+    """ Parser of Apache Combined lines using the regex, only for the lines
+    ending with a quote """
+    regex_parse = regex_parser(settings.APACHE_COMBINED)
+
+    def parse(line):
+        # $ also matches before a trailing newline
+        end = len(line) - 1 if line[-1:] == "\n" else len(line)
+        if end < 1 or line[end - 1] != '"':
+            return None
+        return regex_parse(line)
+    return parse
+
+
+def line_parser(file_type, fast=None):
+    """
+    Parser of a log format.
+    :param file_type:   One of APACHE_COMMON, APACHE_COMBINED or SQUID
+    :param fast:        Try the hand written parser on every line before the
+                        regex, if the format has one. Defaults to
+                        settings.FAST_APACHE_PARSER
+    :return:            Callable returning the groups of a line, or None if
+                        the line can't be tokenized
+    """
+    if fast is None:
+        fast = settings.FAST_APACHE_PARSER
+    fast_parse = FAST_PARSERS.get(file_type) if fast else None
+    if fast_parse is None:
+        if file_type == settings.APACHE_COMBINED:
+            return combined_parser()
+        return regex_parser(file_type)
+    regex_parse = regex_parser(file_type)
+
+    def parse(line):
+        groups = fast_parse(line)
+        if groups is None:
+            return regex_parse(line)
+        return groups or None
+    return parse
+
+
+# Bytes for which \s, \S or \w give a different result in a bytes pattern
+# than in a str pattern matching the latin-1 decoded line
+NOT_ASCII_SAFE = re.compile(b"[\x1c-\x1f\x80-\xff]")
+
+
+class RawParser(object):
+    """
+    Matches the bytes version of a log format regex directly on a buffer,
+    e.g. a memory mapped log file, between the offsets of a line. The line is
+    neither copied nor decoded and the groups are returned as latin-1 bytes.
+
+    Bytes patterns only know ASCII, so lines containing a byte of
+    NOT_ASCII_SAFE are decoded and handled by the str parser instead, and
+    its groups are encoded back.
+    """
+
+    def __init__(self, file_type, buffer):
+        super(RawParser, self).__init__()
+        # Lines are matched at their offset in the buffer, where ^ only
+        # matches in multiline mode
+        self.match = re.compile(LOG_REGEXES[file_type].encode("latin-1"),
+                                re.MULTILINE).match
+        self.parse_text = line_parser(file_type)
+        self.buffer = buffer
+        # The Combined regex only matches lines ending with a quote. Checking
+        # it first keeps the other lines away from the backtracking of
+        # (\".*\") (\".*\")$, like the hand written parser does.
+        self.closing_quote = file_type == settings.APACHE_COMBINED
+        # Offset of the next byte of NOT_ASCII_SAFE, searched only once the
+        # previous one has been passed
+        self.next_unsafe = -1
+
+    def __call__(self, start, end):
+        """
+        Parse the line buffer[start:end], without its line ending.
+        :return: Tuple of bytes groups, None if the line doesn't match
+        """
+        if self.next_unsafe < start:
+            found = NOT_ASCII_SAFE.search(self.buffer, start)
+            self.next_unsafe = found.start() if found else len(self.buffer)
+        if self.next_unsafe < end:
+            groups = self.parse_text(self.buffer[start:end].decode("latin-1"))
+            if groups is None:
+                return None
+            return tuple(None if g is None else g.encode("latin-1")
+                         for g in groups)
+        if self.closing_quote and (end == start or
+                                   self.buffer[end - 1] != ord('"')):
+            return None
+        item = self.match(self.buffer, start, end)
+        return item.groups() if item else None
@@ -0,0 +1,2020 @@
+"""
+GUI independent core of YAST.
+
+Every stage (tokenization, filtering and sessionization) is implemented here
+without any dependency on PyQt so that it can be driven both by the Qt
+threads in yast.py and by the command line interface in cli.py. The core
+never builds display strings, it only keeps row counts and timings.
+"""
+
+import io
+import os
+import re
+import bz2
+import csv
+import gzip
+import lzma
+import mmap
+import time
+import hashlib
+import logging
+import datetime
+import multiprocessing
+from array import array
+from datetime import timedelta
+from itertools import groupby, islice
+from operator import itemgetter
+from sqlalchemy import or_, and_, not_, func, distinct, select, \
+    create_engine, bindparam, text
+from models import TokenCommon, TokenCombined, TokenSquid, Uurl, \
+    Session, SourceFile, SessionWatermark, SessionizerState, FilterProfile, \
+    association_table
+from parsers import line_parser, RawParser
+from interner import UrlInterner
+from tokencache import TokenCache
+import clickpath
+import settings
+
+
+# Token model used for every supported log format
+TOKEN_MODELS = {
+    settings.APACHE_COMMON: TokenCommon,
+    settings.APACHE_COMBINED: TokenCombined,
+    settings.SQUID: TokenSquid,
+}
+
+
+# Magic bytes and stream class of the supported compressed formats
+COMPRESSIONS = (
+    (b"\x1f\x8b", gzip.GzipFile),
+    (b"BZh", bz2.BZ2File),
+    (b"\xfd7zXZ\x00", lzma.LZMAFile),
+)
+
+
+def open_log(path):
+    """
+    Open a log file for binary reading. gzip, bz2 and xz files are detected
+    by their magic bytes and decompressed while they are read.
+    :param path:    Path of the log file
+    :return:        Tuple (raw file, stream). The position of the raw file is
+                    the number of bytes of the file on disk consumed so far,
+                    lines are read from the stream. Both are the same object
+                    for uncompressed files.
+    """
+    raw = open(path, "rb")
+    magic = raw.peek(6)[:6]
+    for prefix, stream_class in COMPRESSIONS:
+        if magic.startswith(prefix):
+            return raw, stream_class(fileobj=raw) \
+                if stream_class is gzip.GzipFile else stream_class(raw)
+    return raw, raw
+
+
+class MappedLog(object):
+    """
+    Byte range of an uncompressed log file mapped into memory. The lines are
+    returned as offsets into the mapping instead of being copied.
+    """
+
+    def __init__(self, path, start=0, end=None):
+        super(MappedLog, self).__init__()
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        self.start = start
+        self.end = size if end is None else min(end, size)
+        # Empty files can't be mapped
+        self.buffer = b""
+        if size:
+            self.buffer = mmap.mmap(self.file.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+            if hasattr(self.buffer, "madvise"):
+                self.buffer.madvise(mmap.MADV_SEQUENTIAL)
+
+    def lines(self):
+        """
+        Yields (start, end, next) for every line of the range. The line
+        without its "\n" or "\r\n" ending is buffer[start:end], the next
+        line starts at offset next.
+        """
+        find = self.buffer.find
+        buffer = self.buffer
+        position = self.start
+        end_of_range = self.end
+        while position < end_of_range:
+            newline = find(b"\n", position, end_of_range)
+            if newline == -1:
+                end = next_line = end_of_range
+            else:
+                end = newline
+                next_line = newline + 1
+                if end > position and buffer[end - 1] == 13:
+                    end -= 1
+            yield position, end, next_line
+            position = next_line
+
+    def close(self):
+        if self.buffer:
+            self.buffer.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def chunk_offsets(path, number_of_chunks, start=0, end=None):
+    """
+    Split a file into newline aligned byte ranges.
+    :param path:                Path of the file
+    :param number_of_chunks:    Maximum number of ranges to create
+    :param start:               Offset of the first byte to split
+    :param end:                 Offset after the last byte to split. Defaults
+                                to the size of the file
+    :return:                    List of (start, end) byte offsets
+    """
+    if end is None:
+        end = os.stat(path).st_size
+    size = end - start
+    boundaries = [start]
+    with open(path, "rb") as f:
+        for i in range(1, number_of_chunks):
+            f.seek(start + size * i // number_of_chunks)
+            # Move to the start of the next line
+            f.readline()
+            position = min(f.tell(), end)
+            if position > boundaries[-1]:
+                boundaries.append(position)
+    if boundaries[-1] < end:
+        boundaries.append(end)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def complete_lines_end(path, size):
+    """
+    Offset after the last newline of a file. A line that is still being
+    written by the web server is not tokenized by incremental runs.
+    """
+    block = 64 * 1024
+    with open(path, "rb") as f:
+        position = size
+        while position > 0:
+            start = max(position - block, 0)
+            f.seek(start)
+            data = f.read(position - start)
+            index = data.rfind(b"\n")
+            if index != -1:
+                return start + index + 1
+            position = start
+    return 0
+
+
+def head_digest(path, length):
+    """ SHA1 of the first length bytes of a file """
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read(length)).hexdigest()
+
+
+def decode_line(raw):
+    """
+    Decode a line read in binary mode the same way text mode reading of the
+    log file does, including the translation of "\r\n" line endings.
+    """
+    line = raw.decode("latin-1")
+    if line.endswith("\r\n"):
+        line = line[:-2] + "\n"
+    return line
+
+
+def decode_groups(groups):
+    """ Decode the bytes groups returned by RawParser """
+    return tuple(None if g is None else g.decode("latin-1") for g in groups)
+
+
+def tokenize_chunk(args):
+    """
+    Tokenize a byte range of a log file. Used by the worker processes of
+    Tokenizer, which also convert the groups into the column values of the
+    token model so that the parent process only inserts them.
+    :param args:    Tuple (path, file type, start offset, end offset, return
+                    the groups, return the column values)
+    :return:        Tuple (number of lines read, list of (line index within
+                    the chunk, groups or None, column values or None))
+    """
+    path, file_type, start, end, with_groups, with_values = args
+    parse = line_parser(file_type)
+    values = TOKEN_MODELS[file_type].values
+    tokens = []
+    i = 0
+    with open(path, "rb") as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            raw = f.readline()
+            if not raw:
+                break
+            position += len(raw)
+            line = decode_line(raw)
+            groups = parse(line)
+            if groups is not None:
+                tokens.append((i, groups if with_groups else None,
+                               values(groups) if with_values else None))
+            else:
+                logging.error("Couldn't tokenize the following line\n" + line)
+            i += 1
+    return i, tokens
+
+
+def init_database(drop=True):
+    """
+    Create all tables
+    :param drop:    Drop all existing tables first. Incremental runs keep
+                    the existing tables and only create missing ones.
+    """
+    if drop:
+        settings.Base.metadata.drop_all(settings.engine)
+    settings.Base.metadata.create_all(settings.engine)
+    settings.session.commit()
+    logging.info("All tables created")
+
+
+def ignore_criteria(file_type):
+    """ Ignore criteria of the filtering step for a log format """
+    if file_type == settings.SQUID:
+        return settings.squid_ignore_criteria
+    return settings.apache_ignore_criteria
+
+
+class IgnoreRules(object):
+    """
+    The ignore criteria of the filtering step evaluated on the regex groups
+    of a line, so that rejected lines are dropped during tokenization and
+    never reach the database. Keeps the number of lines dropped by each rule.
+    The groups can be str or, as returned by RawParser, latin-1 bytes.
+    """
+
+    # Rules in the order they are evaluated. A line is counted only for the
+    # first rule that rejects it.
+    RULES = ('status_code', 'method', 'request_ext', 'size_of_object')
+
+    # Regex group of status code, method, url and size of every format
+    GROUPS = {
+        settings.APACHE_COMMON: (8, 5, 6, 9),
+        settings.APACHE_COMBINED: (8, 5, 6, 9),
+        settings.SQUID: (3, 5, 6, 4),
+    }
+
+    def __init__(self, file_type, ignore_list):
+        super(IgnoreRules, self).__init__()
+        self.squid = file_type == settings.SQUID
+        self.groups = self.GROUPS[file_type]
+        criteria = ignore_criteria(file_type)
+        self.status_code = criteria['status_code']
+        self.methods = set(criteria['method'])
+        self.min_size = criteria['size_of_object']
+        self.ignore_list = set(x.strip(' ') for x in ignore_list)
+        # Values compared with the groups, for str and bytes groups. An
+        # extension never contains "?", so it can replace the characters
+        # latin-1 can't encode.
+        self.constants = {
+            str: (self.methods, self.ignore_list, "/", "?", ".", "-", ""),
+            bytes: (set(m.encode("latin-1") for m in self.methods),
+                    set(e.encode("latin-1", "replace")
+                        for e in self.ignore_list),
+                    b"/", b"?", b".", b"-", b""),
+        }
+        self.kept = 0
+        self.dropped = dict.fromkeys(self.RULES, 0)
+
+    def rule(self, groups):
+        """ Name of the first rule rejecting the line, None if it is kept """
+        status, method, url, size = (groups[i] for i in self.groups)
+        methods, ignore_list, slash, question_mark, dot, dash, empty = \
+            self.constants[type(status)]
+        if self.squid:
+            status = status.split(slash)[-1]
+        if int(status) != self.status_code:
+            return 'status_code'
+        if method not in methods:
+            return 'method'
+        # Same extension as stored in request_ext by the token models
+        if url or self.squid:
+            ext = url.split(question_mark)[0].split(dot)[-1]
+        else:
+            ext = empty
+        if ext in ignore_list:
+            return 'request_ext'
+        # "-" is stored as text, which SQLite never considers <= a number
+        if size != dash and int(size) <= self.min_size:
+            return 'size_of_object'
+        return None
+
+    def rejects(self, groups):
+        """ True if the line has to be dropped. Updates the counters. """
+        rule = self.rule(groups)
+        if rule is None:
+            self.kept += 1
+            return False
+        self.dropped[rule] += 1
+        return True
+
+    def __str__(self):
+        read = self.kept + sum(self.dropped.values())
+        return "read {0}, kept {1}, dropped {2}".format(
+            read, self.kept, ", ".join(
+                "{0}: {1}".format(rule, self.dropped[rule])
+                for rule in self.RULES))
+
+
+class Stats(object):
+    """ Row counts and throughput of a single pipeline stage """
+
+    def __init__(self, stage):
+        super(Stats, self).__init__()
+        self.stage = stage
+        self.rows_in = 0
+        self.rows_out = 0
+        self.start_time = time.time()
+        self.elapsed = 0.0
+
+    def stop(self):
+        self.elapsed = time.time() - self.start_time
+        logging.info(str(self))
+        return self
+
+    @property
+    def throughput(self):
+        """ Input rows processed per second """
+        if not self.elapsed:
+            return 0.0
+        return self.rows_in / self.elapsed
+
+    def __str__(self):
+        return "{0}: {1} rows in, {2} rows out, {3:.2f} secs " \
+            "({4:.0f} rows/sec)".format(self.stage, self.rows_in,
+                                        self.rows_out, self.elapsed,
+                                        self.throughput)
+
+
+class LogFile(object):
+    """ Represents the input log file """
+
+    def __init__(self, file_path):
+        super(LogFile, self).__init__()
+
+        self.path = file_path
+        try:
+            raw, stream = open_log(file_path)
+        except (OSError, IOError):
+            raise
+        self.compressed = stream is not raw
+        self.file = io.TextIOWrapper(stream, encoding="latin-1")
+        try:
+            self.file_type = self.get_file_type()
+        except EOFError as e:
+            # Raised by the decompressors for truncated archives
+            raise IOError(str(e))
+        self.session = settings.Session()
+
+    def get_file_type(self):
+        """
+        Returns log file type.
+        :return: File type. Possible values APACHE_COMMON and SQUID
+        """
+        # Save original position
+        orig = self.file.tell()
+        line = self.file.readline()
+        regex_squid = re.compile(settings.SQUID_LOG_RE)
+        regex_common = re.compile(settings.APACHE_COMMON_LOG_RE)
+        regex_combined = re.compile(settings.APACHE_COMBINED_LOG_RE)
+        if regex_squid.match(line):
+            # Move cursor back to original
+            self.file.seek(orig)
+            logging.info("File type SQUID detected")
+            return settings.SQUID
+        elif regex_common.match(line):
+            self.file.seek(orig)
+            logging.info("File type APACHE COMMON detected")
+            return settings.APACHE_COMMON
+        elif regex_combined.match(line):
+            self.file.seek(orig)
+            logging.info("File type APACHE COMBINED detected")
+            return settings.APACHE_COMBINED
+        else:
+            raise ValueError("Unrecognized file format.\nWe currently support "
+                             "only Apache Web Server Log file and Squid Proxy "
+                             "Server Log file.")
+
+    @property
+    def token_model(self):
+        return TOKEN_MODELS[self.file_type]
+
+
+class Tokenizer(LogFile):
+    """ Breaks the log file into tokens and inserts them into the database """
+
+    def __init__(self, file_path, f_type=None, workers=None,
+                 core_insert=None, store=None, incremental=False,
+                 ignore_list=None, mapped=None, sorter=None,
+                 bulk_load=None, cache=None):
+        super(Tokenizer, self).__init__(file_path)
+        # Optional TokenStore filled instead of the database
+        self.store = store
+        # Optional TokenSorter given the sessionized columns of every token
+        # instead of the database
+        self.sorter = sorter
+        # Lines matching the ignore criteria are dropped while tokenizing
+        # when an ignore list is given, instead of being deleted by Filter
+        self.ignore_rules = None
+        if ignore_list is not None:
+            self.ignore_rules = IgnoreRules(self.file_type, ignore_list)
+        self.workers = workers or settings.TOKENIZER_WORKERS
+        if core_insert is None:
+            core_insert = settings.TOKENIZER_CORE_INSERT
+        self.core_insert = core_insert
+        if mapped is None:
+            mapped = settings.MAPPED_READER
+        self.mapped = mapped
+        if bulk_load is None:
+            bulk_load = settings.BULK_LOAD
+        self.bulk_load = bulk_load
+        # Copy the tokens of an unchanged log from the token cache instead
+        # of parsing it. Only the complete token table of a log is cached.
+        if cache is None:
+            cache = settings.TOKEN_CACHE
+        self.cache = cache and not incremental and ignore_list is None
+        # Whether the last run loaded the tokens from the cache
+        self.from_cache = False
+        if f_type is not None and self.file_type != f_type:
+            logging.error("Incorrect file type. Detected type: %d, selected "
+                          "type: %d" % (self.file_type, f_type))
+            raise TypeError
+        self.file_size = os.stat(file_path).st_size
+        # Only tokenize the lines appended since the last run
+        self.incremental = incremental
+        # Byte range of the file to tokenize
+        self.start_offset = 0
+        self.end_offset = self.file_size
+        # SourceFile of this log, loaded by incremental runs
+        self.state = None
+        if incremental:
+            self.start_offset, self.end_offset = self.resume_range()
+        # Number of bytes of the range consumed so far
+        self.bytes_read = 0
+
+    @property
+    def bytes_total(self):
+        """ Number of bytes to tokenize """
+        return self.end_offset - self.start_offset
+
+    def resume_range(self):
+        """
+        Byte range appended to the file since the last incremental run.
+        The whole file is tokenized again if it has been rotated.
+        :return: Tuple (start offset, end offset)
+        :raises ValueError: A compressed log changed since the last run
+        """
+        self.state = self.session.query(SourceFile).filter_by(
+            path=os.path.abspath(self.path)).first()
+        end = self.file_size
+        if not self.compressed:
+            end = complete_lines_end(self.path, self.file_size)
+        if self.state is None:
+            return 0, end
+
+        inode = os.stat(self.path).st_ino
+        head_length = min(self.state.offset, settings.HEAD_DIGEST_SIZE)
+        rotated = (inode != self.state.inode or
+                   self.file_size < self.state.offset or
+                   head_digest(self.path, head_length) !=
+                   self.state.head_digest)
+        if self.compressed:
+            # Compressed archives can't be resumed, they are only skipped
+            # when they didn't change. The tokens don't record the file they
+            # come from, so those of a changed archive can't be replaced.
+            if rotated or self.file_size != self.state.size:
+                raise ValueError(
+                    "%s changed since the last incremental run and its "
+                    "tokens are already in the database. Compressed logs "
+                    "can't be tokenized again incrementally, run without "
+                    "--incremental to rebuild the database." % self.path)
+            return end, end
+        if rotated:
+            logging.info("Log rotation detected, tokenizing %s from the start"
+                         % self.path)
+            return 0, end
+        logging.info("Resuming tokenization of %s at byte %d"
+                     % (self.path, self.state.offset))
+        return self.state.offset, end
+
+    def save_state(self):
+        """ Store the offset reached by this run for the next one """
+        state = self.state
+        if state is None:
+            state = SourceFile(path=os.path.abspath(self.path))
+            self.session.add(state)
+        state.inode = os.stat(self.path).st_ino
+        state.size = self.file_size
+        state.offset = self.end_offset
+        state.head_digest = head_digest(
+            self.path, min(self.end_offset, settings.HEAD_DIGEST_SIZE))
+        state.last_run = datetime.datetime.now()
+
+    def run(self, on_token=None, on_progress=None):
+        """
+        Tokenize the whole file.
+        :param on_token:    Optional callable invoked as on_token(i, groups)
+                            for every line that could be tokenized
+        :param on_progress: Optional callable invoked with the number of
+                            bytes consumed every time another percent of the
+                            file is tokenized
+        :return:            Stats of the tokenization
+        """
+        stats = Stats("tokenize")
+        token_cache = None
+        # The store and the sorter may be set after the tokenizer is created
+        if self.cache and self.store is None and self.sorter is None:
+            token_cache = TokenCache()
+            cache_file = token_cache.lookup(self.path, self.file_type)
+            if cache_file is not None:
+                self.load_cached(token_cache, cache_file, stats)
+                token_cache.close()
+                if on_progress is not None:
+                    on_progress(self.bytes_read)
+                return stats.stop()
+        logging.info("Tokenizing %d bytes of %d" % (self.bytes_total,
+                                                    self.file_size))
+        if self.workers > 1 and self.compressed:
+            logging.info("Compressed files can't be split into byte ranges, "
+                         "tokenizing in a single process")
+        # The store is the only destination which doesn't need every field
+        # decoded, it is filled from the bytes groups of the mapped file
+        raw = (self.mapped and self.store is not None and
+               not self.compressed and self.workers == 1)
+        rules = self.ignore_rules
+        if raw:
+            tokens = self.mapped_tokens(stats)
+        elif self.workers > 1 and not self.compressed:
+            tokens = self.parallel_tokens(
+                stats, rules is not None or on_token is not None,
+                self.store is not None or self.sorter is not None or
+                self.core_insert)
+        else:
+            tokens = self.tokens(stats)
+        one_percentage = max(self.bytes_total // 100, 1)
+        next_progress = one_percentage
+        # Every destination but the raw store and the ORM is given the column
+        # values of the token model, computed by the worker processes in
+        # parallel mode
+        rows = not raw and (self.store is not None or
+                            self.sorter is not None or self.core_insert)
+        values = self.token_model.values
+        if raw:
+            insert_batch = self.store_raw_insert_batch
+        elif self.store is not None:
+            insert_batch = self.store_insert_batch
+        elif self.sorter is not None:
+            insert_batch = self.sorter_insert_batch
+        elif self.core_insert:
+            insert_batch = self.core_insert_batch
+        else:
+            insert_batch = self.orm_insert_batch
+        bulk_load = None
+        if self.bulk_load and self.store is None and self.sorter is None:
+            # An incremental run only appends to the indexed tokens
+            bulk_load = BulkLoad(self.session, [self.token_model.__table__],
+                                 drop_indexes=not self.incremental)
+            bulk_load.start()
+        batch = []
+        try:
+            for i, groups, row in tokens:
+                if on_progress is not None and \
+                        self.bytes_read >= next_progress:
+                    on_progress(self.bytes_read)
+                    next_progress = self.bytes_read + one_percentage
+                if rules is not None and rules.rejects(groups):
+                    continue
+                if rows:
+                    batch.append(values(groups) if row is None else row)
+                else:
+                    batch.append(groups)
+                stats.rows_out += 1
+                if on_token is not None:
+                    on_token(i, decode_groups(groups) if raw else groups)
+                if len(batch) >= settings.TOKEN_BATCH_SIZE:
+                    insert_batch(batch)
+                    batch = []
+
+            insert_batch(batch)
+            if bulk_load is not None:
+                bulk_load.create_indexes()
+            if self.incremental:
+                self.save_state()
+            # Both insert paths use the session's transaction, so the whole
+            # file is loaded in a single transaction
+            self.session.commit()
+        except Exception:
+            # Nothing is kept of a load which fails partway, e.g. on a log
+            # which can't be read to the end
+            if bulk_load is not None:
+                bulk_load.abort()
+            else:
+                self.session.rollback()
+            settings.Session.remove()
+            raise
+        if bulk_load is not None:
+            bulk_load.restore_pragmas()
+        logging.info("All tokens inserted into database")
+        if token_cache is not None:
+            token_cache.store(self.path, self.file_type,
+                              self.token_model.__table__)
+            token_cache.close()
+        settings.Session.remove()
+        return stats.stop()
+
+    def load_cached(self, token_cache, cache_file, stats):
+        """ Copy the tokens of the log from the token cache into the token
+        table instead of parsing the log """
+        # The whole table is copied, so its indexes are always built
+        # afterwards. The pragmas are only set in bulk load mode.
+        bulk_load = BulkLoad(self.session, [self.token_model.__table__],
+                             pragmas=None if self.bulk_load else ())
+        bulk_load.start()
+        try:
+            stats.rows_in = stats.rows_out = token_cache.load(
+                cache_file, self.token_model.__table__)
+            bulk_load.create_indexes()
+            self.session.commit()
+        except Exception:
+            bulk_load.abort()
+            raise
+        bulk_load.restore_pragmas()
+        self.bytes_read = self.bytes_total
+        self.from_cache = True
+        settings.Session.remove()
+
+    def orm_insert_batch(self, batch):
+        """ Insert a list of regex groups by creating a token object each """
+        model = self.token_model
+        self.session.bulk_save_objects([model(groups) for groups in batch])
+
+    def store_insert_batch(self, batch):
+        """ Add a list of column values of the token model to the columnar
+        token store """
+        append = self.store.append
+        for row in batch:
+            append(row)
+
+    def store_raw_insert_batch(self, batch):
+        """ Add a list of bytes groups of RawParser to the token store """
+        append = self.store.append_raw
+        for groups in batch:
+            append(groups)
+
+    def sorter_insert_batch(self, batch):
+        """ Add the ip address, time, url and size of a list of column
+        values of the token model to the token sorter """
+        columns = self.token_model.COLUMNS
+        ip, date_time, url, size = [
+            columns.index(column.key)
+            for column in token_columns(self.file_type)]
+        add = self.sorter.add
+        for row in batch:
+            add(row[ip], row[date_time], row[url], stored_size(row[size]))
+
+    def core_insert_batch(self, batch):
+        """
+        Insert a list of column values of the token model using a single
+        Core executemany. No ORM object is created.
+        """
+        if not batch:
+            return
+        model = self.token_model
+        columns = model.COLUMNS
+        self.session.connection().execute(
+            model.__table__.insert(),
+            [dict(zip(columns, row)) for row in batch])
+
+    def tokens(self, stats):
+        """
+        Yields (line index, groups, None) for every line of the file that
+        could be tokenized. The column values are left to the caller.
+        """
+        parse = line_parser(self.file_type)
+        if self.start_offset >= self.end_offset:
+            return
+        raw_file, stream = open_log(self.path)
+        with raw_file, stream:
+            if not self.compressed:
+                raw_file.seek(self.start_offset)
+            try:
+                for i, raw in enumerate(stream):
+                    if self.compressed:
+                        # Progress is measured on the compressed bytes
+                        self.bytes_read = raw_file.tell()
+                    elif self.bytes_read >= self.bytes_total:
+                        break
+                    else:
+                        self.bytes_read += len(raw)
+                    stats.rows_in += 1
+                    line = decode_line(raw)
+                    groups = parse(line)
+                    if groups is None:
+                        logging.error(
+                            "Couldn't tokenize the following line\n" + line)
+                        continue
+                    yield i, groups, None
+            except (EOFError, lzma.LZMAError, OSError) as e:
+                # Raised by the decompressors for truncated or corrupt
+                # archives
+                raise IOError("Couldn't read %s: %s" % (self.path, e))
+
+    def mapped_tokens(self, stats):
+        """
+        Same as tokens() for uncompressed files, but the file is memory
+        mapped and the groups are latin-1 bytes
+        """
+        if self.start_offset >= self.end_offset:
+            return
+        with MappedLog(self.path, self.start_offset, self.end_offset) as log:
+            parse = RawParser(self.file_type, log.buffer)
+            for i, (start, end, next_line) in enumerate(log.lines()):
+                self.bytes_read = next_line - self.start_offset
+                stats.rows_in += 1
+                groups = parse(start, end)
+                if groups is None:
+                    logging.error("Couldn't tokenize the following line\n" +
+                                  decode_line(log.buffer[start:next_line]))
+                    continue
+                yield i, groups, None
+
+    def parallel_tokens(self, stats, with_groups=True, with_values=True):
+        """
+        Same as tokens() but the file is split into newline aligned byte
+        ranges which are tokenized by a pool of worker processes. The results
+        are yielded in file order.
+        :param with_groups: Yield the groups, None instead if False
+        :param with_values: Yield the column values computed by the workers,
+                            None instead if False
+        """
+        chunks = chunk_offsets(
+            self.path, self.workers * settings.CHUNKS_PER_WORKER,
+            self.start_offset, self.end_offset)
+        args = [(self.path, self.file_type, start, end, with_groups,
+                 with_values) for start, end in chunks]
+        logging.info("Tokenizing %d chunks using %d processes"
+                     % (len(chunks), self.workers))
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            results = pool.imap(tokenize_chunk, args)
+            for (start, end), (lines_read, tokens) in zip(chunks, results):
+                self.bytes_read += end - start
+                for i, groups, row in tokens:
+                    yield stats.rows_in + i, groups, row
+                stats.rows_in += lines_read
+        finally:
+            pool.close()
+            pool.join()
+
+
+class Filter(LogFile):
+    """ Filters data in the database according to ignore criteria"""
+
+    def __init__(self, file_path, ignore_list, store=None, bulk_load=None,
+                 profile=None, criteria=None):
+        """
+        :param profile:     Name of a filter profile to save the ignore
+                            criteria to instead of deleting the ignored
+                            tokens
+        :param criteria:    Ignore criteria, those of ignore_criteria() if
+                            None
+        """
+        super(Filter, self).__init__(file_path)
+        self.ignore_list = ignore_list
+        # Optional TokenStore filtered instead of the database
+        self.store = store
+        self.profile = profile
+        self.criteria = criteria
+        # Deleting rows from 8 indexes costs more than building them again
+        if bulk_load is None:
+            bulk_load = settings.BULK_LOAD
+        self.bulk_load = bulk_load
+
+    def run(self):
+        """
+        Removes unnecessary entries from the log file based on the list of
+        file formats in items list
+        :return: Stats of the filtering
+        """
+        stats = Stats("filter")
+        ignore_list, criteria = filter_rules(self.file_type, self.ignore_list,
+                                             self.criteria)
+        logging.info("File type to remove: %s" % str(ignore_list))
+        model = self.token_model
+
+        if self.store is not None:
+            stats.rows_in = len(self.store)
+            self.store.filter(ignore_list, criteria)
+            stats.rows_out = len(self.store)
+            return stats.stop()
+
+        stats.rows_in = self.session.query(model).count()
+        ignored = ignored_tokens(self.file_type, ignore_list, criteria)
+        if self.profile is not None:
+            save_filter_profile(self.session, self.profile, self.file_type,
+                                ignore_list, criteria)
+            self.session.commit()
+            stats.rows_out = self.session.query(model).filter(
+                not_(ignored)).count()
+            return stats.stop()
+
+        bulk_load = None
+        if self.bulk_load:
+            bulk_load = BulkLoad(self.session, [model.__table__])
+            bulk_load.start()
+        try:
+            self.session.query(model).filter(ignored).delete(
+                synchronize_session='fetch')
+            if bulk_load is not None:
+                bulk_load.create_indexes()
+            self.session.commit()
+        except Exception:
+            if bulk_load is not None:
+                bulk_load.abort()
+            raise
+        if bulk_load is not None:
+            bulk_load.restore_pragmas()
+        stats.rows_out = self.session.query(model).count()
+        return stats.stop()
+
+
+def token_columns(file_type):
+    """ Columns of the token model read by the sessionizer: ip address,
+    time, url and size of the response """
+    model = TOKEN_MODELS[file_type]
+    if file_type == settings.SQUID:
+        return [model.ip_address, model.date_time, model.url,
+                model.bytes_delivered]
+    return [model.ip_address, model.date_time, model.resource_requested,
+            model.size_of_object]
+
+
+def filter_rules(file_type, ignore_list, criteria=None):
+    """
+    Ignore criteria applied by Filter.
+    :param ignore_list: File extensions to ignore
+    :param criteria:    Ignore criteria, those of ignore_criteria() if None
+    :return:            Tuple (ignore list, criteria)
+    """
+    # Strip whitespaces from every element of the ignore_list
+    return ([x.strip(' ') for x in ignore_list],
+            criteria or ignore_criteria(file_type))
+
+
+def rule_columns(rules):
+    """ Columns of FilterProfile and SessionizerState storing the
+    (ignore list, criteria) rules, all None if rules is None """
+    if rules is None:
+        return dict(ignore_list=None, methods=None, status_code=None,
+                    size_of_object=None)
+    ignore_list, criteria = rules
+    return dict(ignore_list=",".join(ignore_list),
+                methods=",".join(criteria['method']),
+                status_code=criteria['status_code'],
+                size_of_object=criteria['size_of_object'])
+
+
+def ignored_tokens(file_type, ignore_list, criteria):
+    """ Condition on the token table matching the tokens removed by the
+    filtering step """
+    model = TOKEN_MODELS[file_type]
+    return or_(model.status_code != criteria['status_code'],
+               ~model.method.in_(criteria['method']),
+               model.request_ext.in_(ignore_list),
+               token_columns(file_type)[3] <= criteria['size_of_object'])
+
+
+def save_filter_profile(session, name, file_type, ignore_list, criteria):
+    """
+    Create or replace a filter profile of the token table. The incremental
+    sessions of a profile whose criteria changed are created again by the
+    next run.
+    """
+    profile = FilterProfile(
+        name=name, token_table=TOKEN_MODELS[file_type].__tablename__,
+        **rule_columns((ignore_list, criteria)))
+    old = session.query(FilterProfile).get(name)
+    if old is not None and (old.token_table, old.rules()) != (
+            profile.token_table, profile.rules()):
+        logging.info("Filter profile %s changed" % name)
+        session.query(SessionizerState).filter_by(
+            filter_profile=name).delete()
+    session.merge(profile)
+    logging.info("Filter profile %s saved" % name)
+
+
+def load_filter_profile(session, name, file_type):
+    """
+    Ignore criteria of a filter profile.
+    :return:            Tuple (ignore list, criteria)
+    :raise ValueError:  if the token table of the log format has no profile
+                        of this name
+    """
+    profile = session.query(FilterProfile).get(name)
+    if profile is None or \
+            profile.token_table != TOKEN_MODELS[file_type].__tablename__:
+        raise ValueError("No filter profile named %s for the tokens of this "
+                         "log format" % name)
+    return profile.rules()
+
+
+def session_order(model):
+    """ Order of the tokens read by the sessionizer: ip address, time and
+    insertion order. The session index of the token tables is in this
+    order. """
+    return [model.ip_address, model.date_time, model.token_id]
+
+
+def stored_size(size):
+    """ Response size as read back from the database: the integer affinity
+    of the size column converts digit strings, "-" stays text """
+    if isinstance(size, str) and size.isdigit():
+        return int(size)
+    return size
+
+
+def ip_partitions(ip_counts, number_of_partitions):
+    """
+    Split ip addresses into contiguous ranges with about the same number of
+    tokens.
+    :param ip_counts:               List of (ip address, number of tokens)
+                                    ordered by ip address
+    :param number_of_partitions:    Number of ranges to create
+    :return:                        List of (first ip address, last ip
+                                    address, number of ip addresses)
+    """
+    total = sum(count for _, count in ip_counts)
+    partitions = []
+    first = 0
+    tokens = 0
+    for i, (ip, count) in enumerate(ip_counts):
+        tokens += count
+        if tokens * number_of_partitions >= total * (len(partitions) + 1) \
+                or i == len(ip_counts) - 1:
+            partitions.append((ip_counts[first][0], ip, i + 1 - first))
+            first = i + 1
+    return partitions
+
+
+# Database engine of a sessionizer worker process
+partition_engine = None
+
+
+def init_partition_worker(database):
+    """ Connect a sessionizer worker process to the database """
+    global partition_engine
+    partition_engine = create_engine("sqlite:///" + database)
+
+
+def sessionize_partition(args):
+    """
+    Sessionize the tokens of a range of ip addresses. Used by the worker
+    processes of Sessionizer.
+    :param args:    Tuple (file type, first ip address, last ip address,
+                    session timer, (ignore list, criteria) of the filter
+                    profile or None)
+    :return:        Tuple (number of tokens read, list of sessions as
+                    returned by split_sessions())
+    """
+    file_type, first_ip, last_ip, session_timer, profile_rules = args
+    model = TOKEN_MODELS[file_type]
+    query = select(token_columns(file_type)).where(and_(
+        model.ip_address.between(first_ip, last_ip),
+        *profile_filter(file_type, profile_rules))).order_by(
+        *session_order(model))
+    rows = partition_engine.execute(query).fetchall()
+    return len(rows), list(split_sessions(rows, session_timer))
+
+
+def profile_filter(file_type, profile_rules):
+    """
+    Conditions on the token table selecting the tokens kept by a filter
+    profile.
+    :param profile_rules:   (ignore list, criteria) of the profile, None to
+                            select every token
+    :return:                List of conditions, empty for every token
+    """
+    if profile_rules is None:
+        return []
+    return [not_(ignored_tokens(file_type, *profile_rules))]
+
+
+def journal_mode(mode=None):
+    """ Set the journal mode of the database, returns the mode in use """
+    pragma = "PRAGMA journal_mode" + ("=" + mode if mode else "")
+    return settings.engine.execute(pragma).scalar()
+
+
+def set_pragmas(pragmas):
+    """
+    Set pragmas of the database connection. The journal mode can only be
+    changed outside of a transaction.
+    :param pragmas: Sequence of (name, value)
+    :return:        List of (name, previous value)
+    """
+    previous = []
+    for name, value in pragmas:
+        previous.append((name, settings.engine.execute(
+            "PRAGMA %s" % name).scalar()))
+        settings.engine.execute("PRAGMA %s = %s" % (name, value))
+    return previous
+
+
+class BulkLoad(object):
+    """
+    Loads tables with SQLite tuned for bulk inserts. The pragmas of
+    settings.BULK_LOAD_PRAGMAS are set and the secondary indexes of the
+    tables are dropped, so rows are only appended while loading. The indexes
+    are then built in a single pass each, in the transaction of the load.
+
+    SQLite commits the DROP INDEX statements right away, as pysqlite only
+    opens a transaction for the inserts. A load which fails calls abort()
+    to roll it back and build the dropped indexes again.
+    """
+
+    def __init__(self, session, tables, drop_indexes=True, pragmas=None):
+        """
+        :param session:         Database session loading the tables
+        :param tables:          List of Table objects to load
+        :param drop_indexes:    Drop the secondary indexes during the load.
+                                Not worth it when only a few rows are added
+                                to a large table.
+        :param pragmas:         Pragmas set during the load,
+                                settings.BULK_LOAD_PRAGMAS if None
+        """
+        super(BulkLoad, self).__init__()
+        self.session = session
+        if pragmas is None:
+            pragmas = settings.BULK_LOAD_PRAGMAS
+        self.pragmas = pragmas
+        self.indexes = []
+        if drop_indexes:
+            self.indexes = [index for table in tables
+                            for index in table.indexes]
+        self.previous_pragmas = []
+        # Seconds spent building the indexes
+        self.index_time = 0.0
+
+    def start(self):
+        """ Set the pragmas and drop the indexes. Called before the load
+        writes anything. """
+        self.previous_pragmas = set_pragmas(self.pragmas)
+        for index in self.indexes:
+            index.drop(bind=self.session.connection())
+        logging.info("Bulk load started, %d indexes dropped"
+                     % len(self.indexes))
+
+    def create_indexes(self):
+        """ Build the dropped indexes, before the load is committed """
+        start_time = time.time()
+        for index in self.indexes:
+            index.create(bind=self.session.connection())
+        self.index_time = time.time() - start_time
+        logging.info("%d indexes built in %.2f secs"
+                     % (len(self.indexes), self.index_time))
+
+    def restore_pragmas(self):
+        """ Set the pragmas back, once the load is committed """
+        set_pragmas(self.previous_pragmas)
+
+    def abort(self):
+        """ Roll back a failed load, build the dropped indexes which don't
+        exist anymore and set the pragmas back """
+        self.session.rollback()
+        existing = set(name for name, in self.session.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"))
+        missing = [index for index in self.indexes
+                   if index.name not in existing]
+        for index in missing:
+            index.create(bind=self.session.connection())
+        self.session.commit()
+        self.restore_pragmas()
+        logging.info("Bulk load rolled back, %d indexes built again"
+                     % len(missing))
+
+
+class SessionInserter(object):
+    """
+    Writes sessions to the session_master and association tables with Core
+    executemany statements. The sessions get their ids here instead of from
+    the database, so their association rows can be written right away and
+    no ORM object or relationship is involved. The Session and Uurl models
+    are only used to read the sessions.
+    """
+
+    def __init__(self, session, last_id=0, click_paths=False):
+        """
+        :param session:     Database session whose transaction is used
+        :param last_id:     Largest session id in session_master
+        :param click_paths: Store the click path of every session in
+                            session_master instead of association rows
+        """
+        super(SessionInserter, self).__init__()
+        self.session = session
+        self.last_id = last_id
+        self.click_paths = click_paths
+        # Rows written, url ids stored and seconds spent writing them
+        self.sessions = 0
+        self.urls = 0
+        self.elapsed = 0.0
+
+    def insert(self, sessions, url_id):
+        """
+        Insert a batch of sessions.
+        :param sessions:    List of sessions as returned by split_sessions()
+        :param url_id:      Callable returning the id of a url
+        :return:            Id of the first session of the batch, the others
+                            follow in order
+        """
+        first_id = self.last_id + 1
+        if not sessions:
+            return first_id
+        start_time = time.time()
+        rows = []
+        associations = []
+        # Urls are numbered here, in the order they were first requested
+        for session_id, (ip, start, end, urls, clicks, size) in enumerate(
+                sessions, first_id):
+            click_path = None
+            if self.click_paths:
+                click_ids = [url_id(url) for url in clicks]
+                click_path = clickpath.encode(click_ids)
+                self.urls += len(click_ids)
+            else:
+                associations.extend(
+                    {"uurl_id": url_id(url), "session_id": session_id}
+                    for url in urls)
+            rows.append({"id": session_id, "ip": ip,
+                         "session_time": end - start, "start_time": start,
+                         "end_time": end, "page_count": len(clicks),
+                         "url_count": len(urls), "total_bytes": size,
+                         "first_url_id": url_id(urls[0]),
+                         "last_url_id": url_id(clicks[-1]),
+                         "click_path": click_path})
+        self.session.execute(Session.__table__.insert(), rows)
+        if associations:
+            self.session.execute(association_table.insert(), associations)
+        self.last_id += len(sessions)
+        self.sessions += len(sessions)
+        self.urls += len(associations)
+        self.elapsed += time.time() - start_time
+        return first_id
+
+    @property
+    def throughput(self):
+        """ Sessions inserted per second """
+        return self.sessions / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return ("session inserts: %d sessions, %d urls, %.2f secs "
+                "(%.0f sessions/sec)" % (self.sessions, self.urls,
+                                         self.elapsed, self.throughput))
+
+
+class Sessionizer(LogFile):
+    """ Performs sessionization of the data in the database """
+
+    def __init__(self, file_path, session_timer, store=None,
+                 url_memory=None, workers=None, incremental=False,
+                 url_storage=None, sorter=None, bulk_load=None,
+                 profile=None, filter_rules=None):
+        super(Sessionizer, self).__init__(file_path)
+        self.session_timer = timedelta(minutes=session_timer)
+        logging.info("Session timer: %s" % str(self.session_timer))
+        # Optional TokenStore sessionized instead of the database. The
+        # sessions are then kept in self.results instead of session_master.
+        self.store = store
+        self.results = []
+        # Code in the store of every url id of the results, in id order
+        self.url_codes = []
+        # Ids of the urls, inserted into the uurl table once all sessions
+        # are created
+        if url_memory is None:
+            url_memory = settings.URL_MEMORY_BUDGET
+        self.url_memory = url_memory
+        self.urls = None
+        # SessionInserter writing the sessions of the last run
+        self.inserter = None
+        self.workers = workers or settings.SESSIONIZER_WORKERS
+        # Only sessionize the tokens inserted since the last incremental run
+        self.incremental = incremental
+        # Largest token id sessionized by this run
+        self.last_token_id = None
+        # Association rows or a click path per session
+        self.url_storage = url_storage or settings.SESSION_URL_STORAGE
+        if self.url_storage not in (settings.URLS_ASSOCIATION,
+                                    settings.URLS_CLICK_PATH):
+            raise ValueError("Unknown session url storage: %s"
+                             % self.url_storage)
+        self.click_paths = self.url_storage == settings.URLS_CLICK_PATH
+        # Optional TokenSorter filled by the Tokenizer, sessionized instead
+        # of the token table
+        self.sorter = sorter
+        if bulk_load is None:
+            bulk_load = settings.BULK_LOAD
+        self.bulk_load = bulk_load
+        # Name of the FilterProfile whose tokens are sessionized, every
+        # token of the table if None
+        self.profile = profile
+        # (ignore list, criteria) of the profile and the conditions
+        # selecting its tokens, set by load_profile()
+        self.profile_rules = None
+        self.profile_filter = []
+        # (ignore list, criteria) of the Filter which deleted the ignored
+        # tokens. Incremental runs create all sessions again when they
+        # change, as the tokens of existing sessions may have been deleted.
+        self.filter_rules = filter_rules
+        # Sessions extended and ip addresses sessionized again by the last
+        # incremental run
+        self.extended_count = 0
+        self.rebuilt_count = 0
+
+    def load_profile(self):
+        """ Read the ignore criteria of the filter profile
+        :raise ValueError: if the profile doesn't exist """
+        if self.profile is not None:
+            self.profile_rules = load_filter_profile(
+                self.session, self.profile, self.file_type)
+        self.profile_filter = profile_filter(self.file_type,
+                                             self.profile_rules)
+
+    def run(self, on_total=None, on_progress=None):
+        """
+        Create sessions from the tokens in the database. The token table is
+        read once, ordered by ip address and time, and only the session
+        being built is kept in memory. Finished sessions are inserted in
+        batches of settings.SESSION_BATCH_SIZE.
+        :param on_total:    Optional callable invoked with the number of
+                            distinct ip addresses before sessionization starts
+        :param on_progress: Optional callable invoked with the index of every
+                            ip address once its sessions are created
+        :return:            Stats of the sessionization
+        """
+        if self.store is not None:
+            return self.run_store()
+        self.load_profile()
+        if self.incremental:
+            state = self.load_state()
+            if state is not None:
+                return self.run_incremental(state, on_total, on_progress)
+        stats = Stats("sessionize")
+        self.last_token_id = self.max_token_id()
+        self.init_tables()
+        Token_type = self.token_model
+
+        if on_total is not None and self.sorter is None:
+            on_total(self.session.query(
+                func.count(distinct(Token_type.ip_address))).filter(
+                *self.profile_filter).scalar())
+
+        bulk_load = None
+        if self.bulk_load:
+            bulk_load = BulkLoad(self.session, [
+                Session.__table__, association_table, Uurl.__table__])
+            bulk_load.start()
+        self.urls = UrlInterner(self.url_memory)
+        self.inserter = SessionInserter(self.session,
+                                        click_paths=self.click_paths)
+        parallel = self.workers > 1 and self.sorter is None
+        if self.sorter is not None:
+            sessions = split_sessions(self.sorted_tokens(stats),
+                                      self.session_timer, on_progress)
+        elif parallel:
+            sessions = self.parallel_sessions(stats, on_progress)
+            # Lets the workers read the tokens while sessions are written.
+            # A bulk load has switched to WAL already and sets the journal
+            # mode back itself.
+            original_journal_mode = journal_mode()
+            journal_mode("wal")
+        else:
+            sessions = split_sessions(self.ordered_tokens(stats),
+                                      self.session_timer, on_progress)
+        try:
+            batch = []
+            for session in sessions:
+                batch.append(session)
+                if len(batch) >= settings.SESSION_BATCH_SIZE:
+                    self.inserter.insert(batch, self.urls.intern)
+                    stats.rows_out += len(batch)
+                    batch = []
+            self.inserter.insert(batch, self.urls.intern)
+            stats.rows_out += len(batch)
+            logging.info("All sessions created")
+            logging.info(str(self.inserter))
+            self.insert_urls()
+            if bulk_load is not None:
+                bulk_load.create_indexes()
+            if self.incremental:
+                self.save_state()
+            self.session.commit()
+        except Exception:
+            # Ends the query reading the tokens, whose statement keeps the
+            # connection in a transaction
+            sessions.close()
+            if bulk_load is not None:
+                bulk_load.abort()
+            else:
+                self.session.rollback()
+            raise
+        finally:
+            self.urls.close()
+            if self.sorter is not None:
+                self.sorter.close()
+            if parallel and original_journal_mode != "wal":
+                journal_mode(original_journal_mode)
+        if bulk_load is not None:
+            bulk_load.restore_pragmas()
+        return stats.stop()
+
+    def ordered_tokens(self, stats):
+        """
+        Yields (ip address, date time, url, size) of every token ordered by
+        ip address and time. Tokens with the same time stay in insertion
+        order.
+        """
+        Token_type = self.token_model
+        query = self.session.query(*token_columns(self.file_type)).filter(
+            *self.profile_filter).order_by(*session_order(Token_type))
+        for row in query.yield_per(settings.SESSION_BATCH_SIZE):
+            stats.rows_in += 1
+            yield row
+
+    def sorted_tokens(self, stats):
+        """ Same as ordered_tokens() for the tokens of the sorter """
+        for token in self.sorter.sorted_tokens():
+            stats.rows_in += 1
+            yield token
+
+    def parallel_sessions(self, stats, on_progress=None):
+        """
+        Same sessions as split_sessions() over ordered_tokens(), created by
+        a pool of worker processes. The ip addresses are split into ranges,
+        the sessions of every range are yielded in order so that sessions
+        and urls get the same ids as in a single process.
+        """
+        Token_type = self.token_model
+        ip_counts = self.session.query(
+            Token_type.ip_address, func.count()).filter(
+            *self.profile_filter).group_by(Token_type.ip_address).order_by(
+            Token_type.ip_address).all()
+        tokens = sum(count for _, count in ip_counts)
+        partitions = ip_partitions(ip_counts, max(
+            self.workers * settings.CHUNKS_PER_WORKER,
+            -(-tokens // settings.SESSION_PARTITION_SIZE)))
+        args = [(self.file_type, first_ip, last_ip, self.session_timer,
+                 self.profile_rules) for first_ip, last_ip, _ in partitions]
+        logging.info("Sessionizing %d ip address ranges using %d processes"
+                     % (len(partitions), self.workers))
+        pool = multiprocessing.Pool(self.workers, init_partition_worker,
+                                    (settings.DATABASE_NAME,))
+        try:
+            ip_index = 0
+            results = pool.imap(sessionize_partition, args)
+            for (_, _, ip_count), (tokens_read, sessions) in zip(
+                    partitions, results):
+                stats.rows_in += tokens_read
+                for session in sessions:
+                    yield session
+                ip_index += ip_count
+                if on_progress is not None:
+                    on_progress(ip_index - 1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def insert_urls(self):
+        """ Insert all interned urls into the uurl table """
+        insert = Uurl.__table__.insert()
+        batch = []
+        for url_id, url in self.urls.items():
+            batch.append({"id": url_id, "url": url})
+            if len(batch) >= settings.SESSION_BATCH_SIZE:
+                self.session.execute(insert, batch)
+                batch = []
+        if batch:
+            self.session.execute(insert, batch)
+        logging.info("%d urls inserted" % len(self.urls))
+
+    def max_token_id(self):
+        """ Largest token id in the token table, 0 if it is empty """
+        return self.session.query(
+            func.max(self.token_model.token_id)).scalar() or 0
+
+    def load_state(self):
+        """
+        State of the last incremental run.
+        :return: SessionizerState, None if the sessions have to be created
+                 again from all tokens
+        """
+        state = self.session.query(SessionizerState).first()
+        if state is None:
+            logging.info("No incremental sessionization state, creating all "
+                         "sessions")
+            return None
+        if (state.token_table != self.token_model.__tablename__ or
+                state.session_timer != self.session_timer.total_seconds() or
+                state.url_storage != self.url_storage or
+                state.filter_profile != self.profile):
+            logging.info("Log format, session timer, url storage or filter "
+                         "profile changed since the last run, creating all "
+                         "sessions again")
+            return None
+        if any(getattr(state, name) != value for name, value in
+               rule_columns(self.filter_rules).items()):
+            logging.info("Ignore criteria changed since the last run, "
+                         "creating all sessions again")
+            return None
+        # SQLite only gives a new token the id of a sessionized one when the
+        # tokens with the largest ids have been deleted
+        if self.max_token_id() < state.last_token_id:
+            logging.info("Tokens deleted since the last run, creating all "
+                         "sessions again")
+            return None
+        return state
+
+    def save_state(self):
+        """ Store the last session of every ip address and the last token
+        sessionized, once all sessions have been created """
+        # SQLite takes end_time from the row holding MAX(id), which is the
+        # last session of the ip address
+        self.session.execute(
+            SessionWatermark.__table__.insert().from_select(
+                ["ip", "last_time", "session_id"],
+                select([Session.ip, Session.end_time,
+                        func.max(Session.id)]).group_by(Session.ip)))
+        self.session.add(SessionizerState(
+            token_table=self.token_model.__tablename__,
+            session_timer=int(self.session_timer.total_seconds()),
+            url_storage=self.url_storage,
+            filter_profile=self.profile,
+            last_token_id=self.last_token_id,
+            **rule_columns(self.filter_rules)))
+
+    def run_incremental(self, state, on_total=None, on_progress=None):
+        """
+        Sessionize the tokens inserted since the last incremental run. Only
+        the ip addresses with new tokens are touched: their last session is
+        extended or closed and new sessions are created after it.
+        :param state:   SessionizerState of the last run
+        :return:        Stats of the sessionization, rows_out is the number
+                        of sessions created
+        """
+        stats = Stats("sessionize")
+        Token_type = self.token_model
+        self.last_token_id = self.max_token_id()
+        new_tokens = and_(Token_type.token_id.between(
+            state.last_token_id + 1, self.last_token_id),
+            *self.profile_filter)
+        logging.info("Sessionizing tokens %d to %d" % (
+            state.last_token_id + 1, self.last_token_id))
+        if on_total is not None:
+            on_total(self.session.query(
+                func.count(distinct(Token_type.ip_address))).filter(
+                new_tokens).scalar())
+        self.inserter = SessionInserter(
+            self.session, self.session.query(func.max(Session.id)).scalar() or
+            0, click_paths=self.click_paths)
+        self.url_count = self.session.query(func.max(Uurl.id)).scalar() or 0
+        self.extended_count = self.rebuilt_count = 0
+
+        query = select(token_columns(self.file_type)).where(
+            new_tokens).order_by(*session_order(Token_type))
+        batch = []
+        batch_tokens = 0
+        ip_index = -1
+        for ip, rows in groupby(self.session.execute(query), itemgetter(0)):
+            tokens = [tuple(row[1:]) for row in rows]
+            stats.rows_in += len(tokens)
+            batch.append((ip, tokens))
+            batch_tokens += len(tokens)
+            ip_index += 1
+            if len(batch) >= settings.SQL_IN_SIZE or \
+                    batch_tokens >= settings.SESSION_BATCH_SIZE:
+                stats.rows_out += self.merge_sessions(batch)
+                batch = []
+                batch_tokens = 0
+                if on_progress is not None:
+                    on_progress(ip_index)
+        stats.rows_out += self.merge_sessions(batch)
+        if on_progress is not None and ip_index >= 0:
+            on_progress(ip_index)
+
+        state.last_token_id = self.last_token_id
+        self.session.commit()
+        logging.info("%d sessions created, %d extended, %d ip addresses "
+                     "sessionized again" % (stats.rows_out,
+                                            self.extended_count,
+                                            self.rebuilt_count))
+        logging.info(str(self.inserter))
+        return stats.stop()
+
+    def merge_sessions(self, batch):
+        """
+        Add the new tokens of a batch of ip addresses to their sessions.
+        New tokens which are not older than the last session of their ip
+        address come after it in the order of a full sessionization, so the
+        last session is extended by those within session_timer of its start
+        and the others are split into new sessions. An ip address with a
+        token older than its last session is sessionized again from all its
+        tokens.
+        :param batch:   List of (ip address, list of (time, url, size))
+                        ordered by ip address and time
+        :return:        Number of sessions created
+        """
+        if not batch:
+            return 0
+        watermarks = dict(
+            (row.ip, row) for row in self.session.execute(
+                select([SessionWatermark.__table__]).where(
+                    SessionWatermark.ip.in_([ip for ip, _ in batch]))))
+        last_sessions = [mark.session_id for mark in watermarks.values()]
+        starts = dict(self.session.execute(
+            select([Session.id, Session.start_time]).where(
+                Session.id.in_(last_sessions))).fetchall())
+
+        sessions = []
+        # (session id, ip address, start time, tokens) of extended sessions
+        extended = []
+        rebuilt = []
+        for ip, tokens in batch:
+            mark = watermarks.get(ip)
+            count = 0
+            if mark is not None:
+                if tokens[0][0] < mark.last_time:
+                    rebuilt.append(ip)
+                    continue
+                start = starts[mark.session_id]
+                while count < len(tokens) and \
+                        tokens[count][0] - start <= self.session_timer:
+                    count += 1
+                if count:
+                    extended.append((mark.session_id, ip, start,
+                                     tokens[:count]))
+            sessions.extend(split_sessions(
+                ((ip,) + token for token in tokens[count:]),
+                self.session_timer))
+        if rebuilt:
+            sessions.extend(self.rebuild_sessions(rebuilt))
+            self.rebuilt_count += len(rebuilt)
+
+        # Urls an extended session already has were in the uurl table, so
+        # new urls get their ids in the same order as in a full run
+        url_ids = self.url_ids(
+            [url for _, _, _, tokens in extended for _, url, _ in tokens] +
+            [url for session in sessions for url in session[3]])
+        extended_ids = [session_id for session_id, _, _, _ in extended]
+        # Url ids an extended session has, and its click path
+        seen = {}
+        click_paths = {}
+        if self.click_paths:
+            for session_id, click_path in self.session.execute(
+                    select([Session.id, Session.click_path]).where(
+                        Session.id.in_(extended_ids))):
+                click_paths[session_id] = click_path
+                seen[session_id] = set(clickpath.decode(click_path))
+        else:
+            for session_id, url_id in self.session.execute(
+                    select([association_table.c.session_id,
+                            association_table.c.uurl_id]).where(
+                        association_table.c.session_id.in_(extended_ids))):
+                seen.setdefault(session_id, set()).add(url_id)
+
+        updates = []
+        associations = []
+        for session_id, _, start, tokens in extended:
+            session_seen = seen.get(session_id, set())
+            click_ids = [url_ids[url] for _, url, _ in tokens]
+            # Only the urls an extended session doesn't have yet are added
+            new_ids = clickpath.distinct(
+                url_id for url_id in click_ids if url_id not in session_seen)
+            update = {"session_id": session_id, "end": tokens[-1][0],
+                      "length": tokens[-1][0] - start, "pages": len(tokens),
+                      "urls": len(new_ids), "size": total_size(tokens),
+                      "last_url_id": click_ids[-1]}
+            if self.click_paths:
+                update["click_path"] = click_paths[session_id] + \
+                    clickpath.encode(click_ids)
+            else:
+                associations.extend(
+                    {"uurl_id": url_id, "session_id": session_id}
+                    for url_id in new_ids)
+            updates.append(update)
+        if updates:
+            values = dict(
+                end_time=bindparam("end"), session_time=bindparam("length"),
+                page_count=Session.page_count + bindparam("pages"),
+                url_count=Session.url_count + bindparam("urls"),
+                total_bytes=Session.total_bytes + bindparam("size"),
+                last_url_id=bindparam("last_url_id"))
+            if self.click_paths:
+                values["click_path"] = bindparam("click_path")
+            self.session.execute(
+                Session.__table__.update().where(
+                    Session.id == bindparam("session_id")).values(**values),
+                updates)
+            self.extended_count += len(updates)
+        if associations:
+            self.session.execute(association_table.insert(), associations)
+        first_id = self.inserter.insert(sessions, url_ids.__getitem__)
+
+        # The sessions of an ip address are created in time order, so the
+        # last one of it is its new watermark
+        marks = {}
+        for session_id, ip, _, tokens in extended:
+            marks[ip] = {"ip": ip, "last_time": tokens[-1][0],
+                         "session_id": session_id}
+        for session_id, session in enumerate(sessions, first_id):
+            marks[session[0]] = {"ip": session[0], "last_time": session[2],
+                                 "session_id": session_id}
+        self.session.execute(
+            SessionWatermark.__table__.insert().prefix_with("OR REPLACE"),
+            list(marks.values()))
+        return len(sessions)
+
+    def rebuild_sessions(self, ips):
+        """
+        Delete the sessions of ip addresses and create them again from all
+        their tokens.
+        :param ips: List of ip addresses
+        :return:    List of sessions as returned by split_sessions()
+        """
+        Token_type = self.token_model
+        self.session.execute(association_table.delete().where(
+            association_table.c.session_id.in_(
+                select([Session.id]).where(Session.ip.in_(ips)))))
+        self.session.execute(
+            Session.__table__.delete().where(Session.ip.in_(ips)))
+        query = select(token_columns(self.file_type)).where(and_(
+            Token_type.ip_address.in_(ips),
+            Token_type.token_id <= self.last_token_id,
+            *self.profile_filter)).order_by(*session_order(Token_type))
+        return list(split_sessions(self.session.execute(query),
+                                   self.session_timer))
+
+    def url_ids(self, urls):
+        """
+        Ids of urls. Urls which are not in the uurl table yet are inserted.
+        :param urls:    List of urls, new urls get their ids in this order
+        :return:        Dictionary of url ids
+        """
+        ids = {}
+        distinct_urls = list(set(urls))
+        for i in range(0, len(distinct_urls), settings.SQL_IN_SIZE):
+            ids.update(self.session.execute(
+                select([Uurl.url, Uurl.id]).where(Uurl.url.in_(
+                    distinct_urls[i:i + settings.SQL_IN_SIZE]))).fetchall())
+        new_urls = []
+        for url in urls:
+            if url not in ids:
+                self.url_count += 1
+                ids[url] = self.url_count
+                new_urls.append({"id": self.url_count, "url": url})
+        if new_urls:
+            self.session.execute(Uurl.__table__.insert(), new_urls)
+        return ids
+
+    def run_store(self):
+        """
+        Create sessions from the tokens in the columnar store. Sessions and
+        url ids are numbered in the same order as in the database.
+        :return: Stats of the sessionization
+        """
+        stats = Stats("sessionize")
+        stats.rows_in = len(self.store)
+        url_ids = {}
+        timer = int(self.session_timer.total_seconds())
+        for ip, start, end, urls in self.store.sessions(timer):
+            ids = [url_ids.setdefault(url, len(url_ids) + 1) for url in urls]
+            self.results.append((len(self.results) + 1, ip,
+                                 timedelta(seconds=end - start), ids))
+        self.url_codes = list(url_ids)
+        stats.rows_out = len(self.results)
+        return stats.stop()
+
+    def init_tables(self):
+        """ Drop sessions, url and association tables and create new tables.
+        This is done to clear all the previous sessions.
+        """
+
+        settings.Base.metadata.tables['association'].drop(bind=settings.engine)
+        settings.Base.metadata.tables[
+            'session_master'].drop(bind=settings.engine)
+        settings.Base.metadata.tables['uurl'].drop(bind=settings.engine)
+        # The state of the incremental runs belongs to the dropped sessions
+        for table in (SessionWatermark.__table__, SessionizerState.__table__):
+            table.drop(bind=settings.engine, checkfirst=True)
+
+        settings.Base.metadata.tables[
+            'session_master'].create(bind=settings.engine)
+        settings.Base.metadata.tables['uurl'].create(bind=settings.engine)
+        settings.Base.metadata.tables['association'].create(
+            bind=settings.engine)
+        for table in (SessionWatermark.__table__, SessionizerState.__table__):
+            table.create(bind=settings.engine)
+
+        logging.info("Sessionization Tables created")
+
+
+class SessionSweep(Sessionizer):
+    """
+    Sessionizes the tokens in the database with several session timers in
+    a single pass. The sessions are not stored in the database, they can be
+    written to a CSV file per timer.
+    """
+
+    def __init__(self, file_path, session_timers, out_dir=None,
+                 url_memory=None, profile=None):
+        """
+        :param session_timers:  Session times in minutes
+        :param out_dir:         Optional directory receiving urls.csv and a
+                                sessions_<minutes>.csv file per timer
+        :param profile:         Optional name of the filter profile to
+                                sessionize
+        """
+        super(SessionSweep, self).__init__(file_path, max(session_timers),
+                                           url_memory=url_memory,
+                                           profile=profile)
+        self.minutes = list(session_timers)
+        self.session_timers = [timedelta(minutes=m) for m in self.minutes]
+        self.out_dir = out_dir
+        self.timer_stats = [SweepStats(t) for t in self.session_timers]
+
+    def run(self, on_total=None, on_progress=None):
+        """
+        :return: Stats of the sweep. The numbers and lengths of the sessions
+                 of every timer are in self.timer_stats.
+        """
+        stats = Stats("sweep")
+        self.load_profile()
+        writers = []
+        if self.out_dir is not None:
+            writers = [SessionWriter(os.path.join(
+                self.out_dir, "sessions_%s.csv" % m)) for m in self.minutes]
+        # Urls are numbered in the order they are first requested, which
+        # doesn't depend on the session timer
+        self.urls = UrlInterner(self.url_memory)
+        session_ids = [0] * len(self.session_timers)
+        try:
+            for index, (ip, start, end, urls) in sweep_sessions(
+                    self.ordered_tokens(stats), self.session_timers):
+                url_ids = [self.urls.intern(url) for url in urls]
+                self.timer_stats[index].add(end - start, len(url_ids))
+                session_ids[index] += 1
+                if writers:
+                    writers[index].write(session_ids[index], ip, end - start,
+                                         url_ids)
+            stats.rows_out = sum(session_ids)
+            if self.out_dir is not None:
+                with open(os.path.join(self.out_dir, "urls.csv"), "w",
+                          newline="") as out:
+                    writer = csv.writer(out)
+                    writer.writerow(["ID", "URL"])
+                    writer.writerows(self.urls.items())
+        finally:
+            for writer in writers:
+                writer.close()
+            self.urls.close()
+        settings.Session.remove()
+        return stats.stop()
+
+
+def split_sessions(tokens, session_timer, on_ip=None):
+    """
+    Group tokens into sessions. The first token of an ip address starts a
+    session, which then lasts until a token is more than session_timer
+    after its start.
+    :param tokens:          Iterable of (ip address, time, url, size) ordered
+                            by ip address and time
+    :param session_timer:   Maximum session time
+    :param on_ip:           Optional callable invoked with the index of every
+                            ip address once its last session is complete
+    :return:                Generator of (ip address, start time, end time,
+                            urls, clicks, total size). Urls are unique
+                            within a session and in the order they were
+                            first requested, clicks is the url of every
+                            request in order.
+    """
+    ip = start = end = urls = seen = clicks = None
+    size_total = 0
+    ip_index = 0
+    for token_ip, date_time, url, size in tokens:
+        if token_ip != ip or date_time - start > session_timer:
+            if ip is not None:
+                yield ip, start, end, urls, clicks, size_total
+                if token_ip != ip:
+                    if on_ip is not None:
+                        on_ip(ip_index)
+                    ip_index += 1
+            ip = token_ip
+            start = date_time
+            urls = []
+            seen = set()
+            clicks = []
+            size_total = 0
+        end = date_time
+        # The "-" of Apache logs is stored as text
+        if isinstance(size, int):
+            size_total += size
+        clicks.append(url)
+        if url not in seen:
+            seen.add(url)
+            urls.append(url)
+    if ip is not None:
+        yield ip, start, end, urls, clicks, size_total
+        if on_ip is not None:
+            on_ip(ip_index)
+
+
+def total_size(tokens):
+    """ Total size of a list of (time, url, size) tokens, as summed by
+    split_sessions() """
+    return sum(size for _, _, size in tokens if isinstance(size, int))
+
+
+def sweep_sessions(tokens, session_timers):
+    """
+    split_sessions() for several session timers in a single pass over the
+    tokens.
+    :param tokens:          Iterable of (ip address, time, url, size) ordered
+                            by ip address and time
+    :param session_timers:  List of maximum session times
+    :return:                Generator of (index of the session timer, (ip
+                            address, start time, end time, urls))
+    """
+    # Session being built for every timer as [start, end, urls, seen urls]
+    sessions = [None] * len(session_timers)
+    ip = None
+    for token_ip, date_time, url, _ in tokens:
+        if token_ip != ip:
+            if ip is not None:
+                for index, session in enumerate(sessions):
+                    yield index, (ip, session[0], session[1], session[2])
+            ip = token_ip
+            sessions = [None] * len(session_timers)
+        for index, session_timer in enumerate(session_timers):
+            session = sessions[index]
+            if session is None or date_time - session[0] > session_timer:
+                if session is not None:
+                    yield index, (ip, session[0], session[1], session[2])
+                session = sessions[index] = [date_time, date_time, [], set()]
+            session[1] = date_time
+            if url not in session[3]:
+                session[3].add(url)
+                session[2].append(url)
+    if ip is not None:
+        for index, session in enumerate(sessions):
+            yield index, (ip, session[0], session[1], session[2])
+
+
+class SweepStats(object):
+    """ Number of sessions and their length for one session timer """
+
+    def __init__(self, session_timer):
+        super(SweepStats, self).__init__()
+        self.session_timer = session_timer
+        # Duration of every session in seconds
+        self.durations = array('q')
+        self.urls = 0
+
+    def add(self, session_time, url_count):
+        self.durations.append(int(session_time.total_seconds()))
+        self.urls += url_count
+
+    @staticmethod
+    def percentile(durations, percent):
+        """ Duration below which percent of the sorted durations fall """
+        if not durations:
+            return timedelta(0)
+        index = min(len(durations) * percent // 100, len(durations) - 1)
+        return timedelta(seconds=durations[index])
+
+    def __str__(self):
+        durations = sorted(self.durations)
+        count = len(durations)
+        return ("timeout {0}: {1} sessions, duration median {2}, 90% {3}, "
+                "99% {4}, max {5}, {6:.2f} urls per session".format(
+                    self.session_timer, count,
+                    self.percentile(durations, 50),
+                    self.percentile(durations, 90),
+                    self.percentile(durations, 99),
+                    self.percentile(durations, 100),
+                    self.urls / count if count else 0))
+
+
+# Columns of the session CSV files
+SESSION_HEADER = ["ID", "IP Address", "Session Time", "URL IDs"]
+CLICK_PATH_HEADER = ["ID", "IP Address", "Session Time", "Click Path"]
+
+
+class SessionWriter(object):
+    """ CSV file of sessions """
+
+    def __init__(self, path, header=SESSION_HEADER):
+        super(SessionWriter, self).__init__()
+        self.path = path
+        self.file = open(path, "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(header)
+        self.count = 0
+
+    def write(self, session_id, ip, session_time, url_ids):
+        self.writer.writerow([session_id, ip, str(session_time),
+                              " ".join(str(u) for u in url_ids)])
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+        logging.info("%d sessions written to %s" % (self.count, self.path))
+
+
+def write_sessions(path, rows, header=SESSION_HEADER):
+    """
+    Write sessions to a CSV file.
+    :param path:    Output file path
+    :param rows:    Iterable of (id, ip address, session time, url ids)
+    :param header:  Column names
+    :return:        Number of sessions written
+    """
+    writer = SessionWriter(path, header)
+    try:
+        for row in rows:
+            writer.write(*row)
+    finally:
+        writer.close()
+    return writer.count
+
+
+def session_rows(session=None):
+    """
+    Yields (id, ip address, session time, url ids) of every session ordered
+    by id. Reads the sessions and the association table with one query
+    each instead of loading the session_urls of every session, the
+    url_count of a session tells how many association rows are its own.
+    The urls of sessions stored with a click path are taken from it.
+    :param session: Database session. A new one is created if None
+    """
+    session = session or settings.Session()
+    # Association rows of a session are in the order its urls were first
+    # requested, i.e. in rowid order
+    url_ids = (row[0] for row in session.execute(
+        select([association_table.c.uurl_id]).order_by(
+            association_table.c.session_id, text("association.rowid"))))
+    for session_id, ip, session_time, url_count, click_path in \
+            session.execute(select([
+                Session.id, Session.ip, Session.session_time,
+                Session.url_count, Session.click_path]).order_by(Session.id)):
+        if click_path is not None:
+            yield session_id, ip, session_time, clickpath.distinct(
+                clickpath.decode(click_path))
+        else:
+            yield session_id, ip, session_time, list(
+                islice(url_ids, url_count))
+
+
+def click_path_rows(session=None):
+    """
+    Yields (id, ip address, session time, click path) of every session
+    ordered by id. The click path is the url id of every request in order.
+    :param session: Database session. A new one is created if None
+    """
+    session = session or settings.Session()
+    for session_id, ip, session_time, click_path in session.execute(
+            select([Session.id, Session.ip, Session.session_time,
+                    Session.click_path]).order_by(Session.id)):
+        if click_path is None:
+            raise ValueError("Session %d has no click path, the sessions "
+                             "must be stored with the %s url storage"
+                             % (session_id, settings.URLS_CLICK_PATH))
+        yield session_id, ip, session_time, clickpath.decode(click_path)
+
+
+def export_sessions(path, session=None):
+    """
+    Write all sessions in the database to a CSV file.
+    :param path:    Output file path
+    :param session: Database session. A new one is created if None
+    :return:        Number of sessions written
+    """
+    return write_sessions(path, session_rows(session))
+
+
+def export_click_paths(path, session=None):
+    """
+    Write the click path of every session in the database to a CSV file.
+    :param path:    Output file path
+    :param session: Database session. A new one is created if None
+    :return:        Number of sessions written
+    """
+    return write_sessions(path, click_path_rows(session), CLICK_PATH_HEADER)
@@ -0,0 +1,131 @@
+"""
+Query plans of the queries YAST runs on the token and session tables.
+
+Usage:
+    python src/queryplan.py
+    python src/queryplan.py --format squid
+
+The tables are created in settings.DATABASE_NAME if they don't exist and
+EXPLAIN QUERY PLAN of every query is printed. A query is flagged when SQLite
+scans a table without an index or sorts in a temporary B-tree to answer it,
+unless the query is expected to, and the exit status is then 1.
+"""
+
+import sys
+import argparse
+from sqlalchemy import select, func, distinct, and_, text
+from models import Session, Uurl, SessionWatermark, association_table
+import settings
+import pipeline
+
+
+def token_queries(file_type):
+    """
+    Queries on the token table of a log format.
+    :return: List of (name, statement, steps the plan is expected to have
+             among those returned by slow_steps())
+    """
+    model = pipeline.TOKEN_MODELS[file_type]
+    columns = pipeline.token_columns(file_type)
+    order = pipeline.session_order(model)
+    ignored = pipeline.ignored_tokens(
+        file_type, [""], pipeline.ignore_criteria(file_type))
+    profile = pipeline.profile_filter(
+        file_type, ([""], pipeline.ignore_criteria(file_type)))
+    return [
+        ("sessionize", select(columns).order_by(*order), ()),
+        ("sessionize ip range", select(columns).where(
+            model.ip_address.between("", "")).order_by(*order), ()),
+        ("ip address counts", select([
+            model.ip_address, func.count()]).group_by(
+            model.ip_address).order_by(model.ip_address), ()),
+        ("distinct ip addresses", select([
+            func.count(distinct(model.ip_address))]), ()),
+        ("sessionize again", select(columns).where(
+            model.ip_address.in_(["", ""])).where(
+            model.token_id <= 0).order_by(*order), ()),
+        # Only the new tokens are sorted, the range of ids is searched
+        ("new tokens", select(columns).where(
+            model.token_id.between(0, 0)).order_by(*order),
+         ("TEMP B-TREE",)),
+        ("filter", select([model.token_id]).where(ignored), ()),
+        # No index can search the disjunction of the ignore criteria
+        ("filter delete", model.__table__.delete().where(ignored),
+         ("SCAN %s" % model.__tablename__,)),
+        # The tokens of a filter profile are read from the session index
+        ("sessionize profile", select(columns).where(and_(
+            *profile)).order_by(*order), ()),
+        ("profile ip address counts", select([
+            model.ip_address, func.count()]).where(and_(*profile)).group_by(
+            model.ip_address).order_by(model.ip_address), ()),
+        ("profile ip range", select(columns).where(and_(
+            model.ip_address.between("", ""), *profile)).order_by(*order),
+         ()),
+    ]
+
+
+def session_queries():
+    """ Queries on the session tables, as returned by token_queries() """
+    return [
+        ("session urls", select([association_table.c.uurl_id]).order_by(
+            association_table.c.session_id, text("association.rowid")),
+         ()),
+        # Every session is read, in primary key order
+        ("sessions", select([Session.id, Session.ip, Session.session_time,
+                             Session.url_count]).order_by(Session.id),
+         ("SCAN session_master",)),
+        ("last sessions", select([
+            Session.ip, Session.end_time, func.max(Session.id)]).group_by(
+            Session.ip), ()),
+        ("watermarks", select([SessionWatermark.__table__]).where(
+            SessionWatermark.ip.in_(["", ""])), ()),
+        ("url ids", select([Uurl.url, Uurl.id]).where(
+            Uurl.url.in_(["", ""])), ()),
+        ("extended session urls", select([
+            association_table.c.session_id,
+            association_table.c.uurl_id]).where(
+            association_table.c.session_id.in_([0, 0])), ()),
+    ]
+
+
+def query_plan(statement):
+    """ Lines of EXPLAIN QUERY PLAN of a statement """
+    compiled = statement.compile(dialect=settings.engine.dialect)
+    # Parameter values don't change the plan
+    parameters = [None] * len(compiled.positiontup)
+    return [row[-1] for row in settings.engine.execute(
+        "EXPLAIN QUERY PLAN " + str(compiled), *parameters)]
+
+
+def slow_steps(plan):
+    """ Steps of a plan reading a whole table or sorting rows """
+    return [step for step in plan if "TEMP B-TREE" in step or
+            (step.startswith("SCAN") and "INDEX" not in step)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="queryplan", description="Query plans of the YAST queries")
+    parser.add_argument("--format", choices=sorted(settings.LOG_FORMATS),
+                        default="common", help="Log format of the token "
+                        "table")
+    args = parser.parse_args(argv)
+    pipeline.init_database(drop=False)
+
+    regressions = 0
+    for name, statement, expected in token_queries(
+            settings.LOG_FORMATS[args.format]) + session_queries():
+        plan = query_plan(statement)
+        flagged = [step for step in slow_steps(plan)
+                   if not any(allowed in step for allowed in expected)]
+        print("%s%s" % (name, " (unexpected table scan or sort)"
+                        if flagged else ""))
+        for step in plan:
+            print("    " + step)
+        if flagged:
+            regressions += 1
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
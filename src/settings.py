@@ -1,9 +1,11 @@
 from sqlalchemy import create_engine, orm
 from sqlalchemy.pool import StaticPool
 from sqlalchemy.ext.declarative import declarative_base
+import os
 import tempfile
 
-DATABASE_NAME = tempfile.gettempdir() + "/yast.db"
+DATABASE_NAME = os.environ.get(
+    "YAST_DATABASE", tempfile.gettempdir() + "/yast.db")
 # Format of the datetime string in the log file
 DATETIME_FORMAT = '%d/%b/%Y:%H:%M:%S'
 # Create in-memory database with support for concurrent access by threads
@@ -17,6 +19,78 @@ session = Session()
 Base = declarative_base()
 
 RESULT_SIGNAL_SIZE = 1000
+# Number of tokens inserted into the database at a time
+TOKEN_BATCH_SIZE = 10000
+# Number of sessions inserted into the database at a time
+SESSION_BATCH_SIZE = 10000
+# Number of processes used for sessionization
+SESSIONIZER_WORKERS = 1
+# Maximum number of tokens sessionized by a worker process at a time. The
+# ip addresses are split into at least CHUNKS_PER_WORKER ranges per process.
+SESSION_PARTITION_SIZE = 500000
+# Estimated bytes of memory the distinct urls may use while sessionizing.
+# Urls beyond the budget are moved to a temporary file. None means no limit.
+URL_MEMORY_BUDGET = 256 * 1024 * 1024
+# Sessionize the in-memory token store with NumPy array operations instead
+# of a loop over the tokens, when NumPy is installed
+VECTORIZED_SESSIONS = True
+# How the urls of a session are stored: a row per distinct url in the
+# association table, or the url id of every request in order, packed into
+# the click_path column of session_master
+URLS_ASSOCIATION = "association"
+URLS_CLICK_PATH = "click_path"
+SESSION_URL_STORAGE = URLS_ASSOCIATION
+# Where the tokens are kept between tokenization and sessionization: the
+# SQLite database, or Arrow record batches with dictionary encoded strings,
+# which can be written to Parquet files. The Arrow backend needs pyarrow.
+STORAGE_SQLITE = "sqlite"
+STORAGE_ARROW = "arrow"
+STORAGE_BACKEND = STORAGE_SQLITE
+# Load tokens and sessions with SQLite tuned for bulk inserts: the pragmas
+# below are set for the load and the secondary indexes of the loaded tables
+# are built once it is done instead of being updated row by row
+BULK_LOAD = False
+BULK_LOAD_PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    # Negative sizes are in KiB: 256 MiB of page cache
+    ("cache_size", -262144),
+    ("mmap_size", 1024 * 1024 * 1024),
+    ("temp_store", "MEMORY"),
+)
+# Largest number of values in a single IN (...) clause, below the limit of
+# 999 bound parameters of older SQLite versions
+SQL_IN_SIZE = 500
+# Insert tokens with SQLAlchemy Core executemany instead of creating an ORM
+# object for every line
+TOKENIZER_CORE_INSERT = True
+# Parse every Apache Common and Combined line with the hand written parser in
+# parsers.py before the regex. It is about twice as slow as the regex on
+# ordinary lines.
+FAST_APACHE_PARSER = False
+# Tokenize uncompressed logs into the in-memory TokenStore by matching the
+# memory mapped file with bytes regexes. Only the stored fields are decoded.
+MAPPED_READER = True
+# Number of bytes at the start of a log file used to detect log rotation
+HEAD_DIGEST_SIZE = 1024
+# Keep the tokens of every log tokenized into the database in a cache
+# directory, and copy them back instead of parsing the log again as long as
+# its path, size, modification time and first and last bytes are the same.
+# Off by default as the cache writes up to TOKEN_CACHE_BUDGET bytes to
+# TOKEN_CACHE_DIR, ~/.cache/yast unless YAST_CACHE_DIR is set.
+TOKEN_CACHE = False
+TOKEN_CACHE_DIR = os.environ.get(
+    "YAST_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "yast"))
+# Bytes the cached tokens may use on disk. The least recently used logs are
+# deleted beyond it.
+TOKEN_CACHE_BUDGET = 4 * 1024 * 1024 * 1024
+# Number of bytes at the start and at the end of a log in its fingerprint
+TOKEN_CACHE_DIGEST_SIZE = 1024 * 1024
+# Number of processes used for tokenization
+TOKENIZER_WORKERS = 1
+# Byte ranges created per tokenizer process. More ranges than processes keep
+# all of them busy when some parts of the file are slower to parse.
+CHUNKS_PER_WORKER = 4
 
 APACHE_COMMON = 0
 # Used while printing output
@@ -80,6 +154,13 @@ squid_ignore_criteria = {
     'size_of_object': 0
 }
 
+# Log format names accepted by the command line interface
+LOG_FORMATS = {
+    'common': APACHE_COMMON,
+    'combined': APACHE_COMBINED,
+    'squid': SQUID,
+}
+
 URL_OUTPUT_FORMAT = "{:>5}\t{:<}"
 URL_OUTPUT_HEADING = URL_OUTPUT_FORMAT.format("URL_ID", "URL")
 
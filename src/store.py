@@ -0,0 +1,367 @@
+"""
+Columnar in-memory token store.
+
+Instead of keeping one Python object per token, every field is stored in a
+typed array. Timestamps are kept as int64 epoch seconds, strings (ip address,
+url, method and extension) are dictionary encoded and stored as int32 codes.
+Filtering and sessionization work directly on the arrays, so the tokens never
+need to be written to SQLite.
+
+Tokens read from a memory mapped log are appended from the bytes groups of
+the regex. Strings are then only decoded the first time a dictionary sees
+them, and timestamps are parsed once per distinct value.
+
+NumPy is used for sorting and sessionization when it is installed, otherwise
+the standard library is used.
+"""
+
+import re
+import datetime
+from array import array
+import settings
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Stored in place of size_of_object when the log contains "-". SQLite compares
+# the text "-" as greater than any integer, so such tokens are never removed
+# by the size criterion.
+SIZE_MISSING = -1
+
+# Position of (ip address, date time, method, url, extension, status code,
+# size) in the column values returned by the token models
+STORE_FIELDS = {
+    settings.APACHE_COMMON: (0, 3, 5, 6, 7, 9, 10),
+    settings.APACHE_COMBINED: (0, 3, 5, 6, 7, 9, 10),
+    settings.SQUID: (2, 0, 5, 6, 10, 3, 4),
+}
+
+# Regex group of (ip address, date time, method, url, status code, size)
+GROUP_FIELDS = {
+    settings.APACHE_COMMON: (0, 3, 5, 6, 8, 9),
+    settings.APACHE_COMBINED: (0, 3, 5, 6, 8, 9),
+    settings.SQUID: (2, 0, 5, 6, 3, 4),
+}
+
+
+# Apache timestamp in settings.DATETIME_FORMAT, split into the day and the
+# time of day
+APACHE_TIME_RE = re.compile(
+    br"(\d\d/[A-Za-z]{3}/\d{4}):([01]\d|2[0-3]):([0-5]\d):([0-5]\d)\Z")
+APACHE_DAY_FORMAT = settings.DATETIME_FORMAT.rsplit(":%H", 1)[0]
+
+
+def to_epoch(date_time):
+    """ Convert a naive datetime into epoch seconds """
+    return int((date_time - EPOCH).total_seconds())
+
+
+class Dictionary(object):
+    """ Dictionary encoding of a string column """
+
+    def __init__(self):
+        super(Dictionary, self).__init__()
+        self.codes = {}
+        self.values = []
+        # Codes of the latin-1 encoded values
+        self.raw_codes = {}
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        return code
+
+    def encode_raw(self, value):
+        """ encode() a latin-1 bytes value, decoded only when first seen """
+        code = self.raw_codes.get(value)
+        if code is None:
+            code = self.encode(value.decode("latin-1"))
+            self.raw_codes[value] = code
+        return code
+
+    def __getitem__(self, code):
+        return self.values[code]
+
+    def __len__(self):
+        return len(self.values)
+
+
+class TokenStore(object):
+    """ Tokens of a log file stored column by column """
+
+    def __init__(self, file_type):
+        super(TokenStore, self).__init__()
+        self.file_type = file_type
+        self.fields = STORE_FIELDS[file_type]
+        self.group_fields = GROUP_FIELDS[file_type]
+        # Last timestamp converted by append_raw(). Log lines are written in
+        # time order, so most lines repeat the timestamp of the previous one.
+        self.last_time = (None, None)
+        # Epoch seconds of the days seen in Apache timestamps
+        self.days = {}
+        self.ips = Dictionary()
+        self.urls = Dictionary()
+        self.methods = Dictionary()
+        self.extensions = Dictionary()
+        self._init_columns()
+
+    def _init_columns(self):
+        self.ip_address = array('i')
+        self.date_time = array('q')
+        self.method = array('i')
+        self.url = array('i')
+        self.request_ext = array('i')
+        self.status_code = array('h')
+        self.size = array('q')
+
+    def columns(self):
+        return (self.ip_address, self.date_time, self.method, self.url,
+                self.request_ext, self.status_code, self.size)
+
+    def __len__(self):
+        return len(self.date_time)
+
+    def append(self, values):
+        """
+        Add a token
+        :param values: Column values as returned by the token model's
+                       values() method
+        """
+        ip, date_time, method, url, ext, status, size = (
+            values[i] for i in self.fields)
+        self.ip_address.append(self.ips.encode(ip))
+        self.date_time.append(to_epoch(date_time))
+        self.method.append(self.methods.encode(method))
+        self.url.append(self.urls.encode(url))
+        self.request_ext.append(self.extensions.encode(ext))
+        self.status_code.append(int(status))
+        self.size.append(SIZE_MISSING if size == "-" else int(size))
+
+    def append_raw(self, groups):
+        """
+        Add a token from the bytes groups of parsers.RawParser. Gives the
+        same result as append() with the values of the decoded groups.
+        :param groups: Regex groups of the line as latin-1 bytes
+        """
+        ip, date_time, method, url, status, size = (
+            groups[i] for i in self.group_fields)
+        squid = self.file_type == settings.SQUID
+        # Same url and extension as computed by the token models
+        if url or squid:
+            url = url.split(b"?")[0]
+            ext = url.split(b".")[-1]
+        else:
+            url = ext = b""
+        if squid:
+            status = status.split(b"/")[-1]
+        if date_time != self.last_time[0]:
+            self.last_time = (date_time, self.raw_epoch(date_time))
+        self.ip_address.append(self.ips.encode_raw(ip))
+        self.date_time.append(self.last_time[1])
+        self.method.append(self.methods.encode_raw(method))
+        self.url.append(self.urls.encode_raw(url))
+        self.request_ext.append(self.extensions.encode_raw(ext))
+        self.status_code.append(int(status))
+        self.size.append(SIZE_MISSING if size == b"-" else int(size))
+
+    def raw_epoch(self, date_time):
+        """
+        Epoch seconds of a bytes timestamp, as converted by the token models.
+        strptime() is only called once per day for Apache timestamps.
+        """
+        if self.file_type == settings.SQUID:
+            return to_epoch(
+                datetime.datetime.fromtimestamp(int(float(date_time))))
+        item = APACHE_TIME_RE.match(date_time)
+        if item is None:
+            return to_epoch(datetime.datetime.strptime(
+                date_time.decode("latin-1"), settings.DATETIME_FORMAT))
+        day, hours, minutes, seconds = item.groups()
+        epoch = self.days.get(day)
+        if epoch is None:
+            epoch = self.days[day] = to_epoch(datetime.datetime.strptime(
+                day.decode("latin-1"), APACHE_DAY_FORMAT))
+        return epoch + int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+    def filter(self, ignore_list, criteria):
+        """
+        Remove tokens matching the ignore criteria, the same way
+        FilteringThread deletes them from the database.
+        :param ignore_list: File extensions to remove
+        :param criteria:    apache_ignore_criteria or squid_ignore_criteria
+        :return:            Number of tokens removed
+        """
+        methods = set(self.methods.codes[m] for m in criteria['method']
+                      if m in self.methods.codes)
+        extensions = set(self.extensions.codes[e] for e in ignore_list
+                         if e in self.extensions.codes)
+        status_code = criteria['status_code']
+        min_size = criteria['size_of_object']
+
+        old = self.columns()
+        self._init_columns()
+        new = self.columns()
+        for i in range(len(old[0])):
+            size = old[6][i]
+            if (old[5][i] != status_code or old[2][i] not in methods or
+                    old[4][i] in extensions or
+                    (size != SIZE_MISSING and size <= min_size)):
+                continue
+            for src, dst in zip(old, new):
+                dst.append(src[i])
+        return len(old[0]) - len(self)
+
+    def code_arrays(self):
+        """ NumPy arrays of the ip address codes, times and url codes of the
+        tokens, sharing the memory of the columns """
+        return (numpy.frombuffer(self.ip_address, dtype=numpy.int32),
+                numpy.frombuffer(self.date_time, dtype=numpy.int64),
+                numpy.frombuffer(self.url, dtype=numpy.int32))
+
+    def sorted_positions(self):
+        """
+        Positions of the tokens ordered by ip address and time. Tokens with
+        the same ip address and time keep their original order.
+        """
+        ip_rank = [0] * len(self.ips)
+        for rank, code in enumerate(
+                sorted(range(len(self.ips)), key=self.ips.__getitem__)):
+            ip_rank[code] = rank
+        if numpy is not None:
+            ips, times, _ = self.code_arrays()
+            ranks = numpy.array(ip_rank, dtype=numpy.int32)[ips]
+            # lexsort is stable and sorts by the last key first
+            return numpy.lexsort((times, ranks))
+        return sorted(range(len(self)), key=lambda i: (
+            ip_rank[self.ip_address[i]], self.date_time[i]))
+
+    def sessions(self, session_timer, vectorized=None):
+        """
+        Sessionize the tokens with the same rules as SessionThread.
+        :param session_timer:   Maximum session time in seconds
+        :param vectorized:      Use session_arrays() instead of a loop over
+                                the tokens. Defaults to
+                                settings.VECTORIZED_SESSIONS if NumPy is
+                                installed.
+        :return:                Generator of (ip address, start time, end time,
+                                list of url codes) ordered by ip address and
+                                start time. Urls are unique within a session
+                                and in the order they were first requested.
+        """
+        if vectorized is None:
+            vectorized = settings.VECTORIZED_SESSIONS and numpy is not None
+        if vectorized:
+            ips, starts, ends, url_offsets, urls = self.session_arrays(
+                session_timer)
+            names = self.ips.values
+            urls = urls.tolist()
+            url_offsets = url_offsets.tolist()
+            for ip, start, end, low, high in zip(
+                    ips.tolist(), starts.tolist(), ends.tolist(),
+                    url_offsets, url_offsets[1:]):
+                yield names[ip], start, end, urls[low:high]
+            return
+
+        ip = start = end = urls = seen = None
+        for pos in self.sorted_positions():
+            time = self.date_time[pos]
+            if self.ip_address[pos] != ip or time - start > session_timer:
+                if ip is not None:
+                    yield self.ips[ip], start, end, urls
+                ip = self.ip_address[pos]
+                start = time
+                urls = []
+                seen = set()
+            end = time
+            url = self.url[pos]
+            if url not in seen:
+                seen.add(url)
+                urls.append(url)
+        if ip is not None:
+            yield self.ips[ip], start, end, urls
+
+    def session_arrays(self, session_timer):
+        """
+        Sessionize the tokens with NumPy array operations. Gives the same
+        sessions as the loop of sessions().
+        :param session_timer:   Maximum session time in seconds
+        :return:                Tuple of arrays (ip address codes, start
+                                times, end times, url offsets, url codes).
+                                The urls of session i are
+                                url_codes[url_offsets[i]:url_offsets[i + 1]].
+        """
+        positions = self.sorted_positions()
+        ips, times, urls = (column[positions]
+                            for column in self.code_arrays())
+
+        first = session_starts(ips, times, session_timer)
+        # Session of every token
+        session = numpy.cumsum(first) - 1
+        starts = numpy.flatnonzero(first)
+        ends = numpy.append(starts[1:], len(times)) - 1 if len(starts) \
+            else starts
+
+        # First request of every url within its session, in request order
+        key = session * max(len(self.urls), 1) + urls
+        order = numpy.argsort(key, kind="stable")
+        sorted_key = key[order]
+        unique = numpy.ones(len(order), dtype=bool)
+        unique[1:] = sorted_key[1:] != sorted_key[:-1]
+        requests = numpy.sort(order[unique])
+        url_offsets = numpy.searchsorted(session[requests],
+                                         numpy.arange(len(starts) + 1))
+        return (ips[starts], times[starts], times[ends], url_offsets,
+                urls[requests])
+
+
+def session_starts(ips, times, session_timer):
+    """
+    Find the first token of every session with array operations.
+
+    A session lasts until a token is more than session_timer after its
+    first token, so where a session starts depends on where the previous
+    one started, and differences between consecutive tokens can't be used.
+    Instead every token gets the position of the first token after its
+    window with a binary search, and the sessions of all ip addresses are
+    followed through these positions together, one session per step.
+    :param ips:             Ip address of every token, equal ip addresses
+                            next to each other
+    :param times:           Epoch seconds of every token, in time order
+                            within an ip address
+    :param session_timer:   Maximum session time in seconds
+    :return:                Boolean array, True for the first token of a
+                            session
+    """
+    count = len(times)
+    first = numpy.zeros(count, dtype=bool)
+    if count == 0:
+        return first
+    new_ip = numpy.ones(count, dtype=bool)
+    new_ip[1:] = ips[1:] != ips[:-1]
+    # Tokens ordered by (ip address, time) as a single increasing key. An ip
+    # address is spaced more than a window from the next one, so no window
+    # reaches into the next ip address.
+    low = int(times.min())
+    spacing = int(times.max()) - low + session_timer + 1
+    ip_index = numpy.cumsum(new_ip) - 1
+    if int(ip_index[-1]) * spacing >= 2 ** 62:
+        raise OverflowError("Time range too large to sessionize with NumPy")
+    key = ip_index * spacing + (times - low)
+    window_end = numpy.searchsorted(key, key + session_timer, side="right")
+
+    starts = numpy.flatnonzero(new_ip)
+    while len(starts):
+        first[starts] = True
+        starts = window_end[starts]
+        # The window of the last session of an ip address ends at the first
+        # token of the next one, which is already marked
+        starts = starts[starts < count]
+        starts = starts[~first[starts]]
+    return first
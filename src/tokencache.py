@@ -0,0 +1,177 @@
+"""
+Persistent cache of tokenized logs.
+
+Once a log is tokenized, its token table is copied into a SQLite file of its
+own in the cache directory. The next run on the same log copies the tokens
+back instead of parsing the log again. A log is identified by its path,
+size, modification time and a digest of its first and last bytes, so a log
+which changed in any of these is tokenized again.
+
+index.db in the cache directory lists the cached logs and when they were
+last used. When the cached files exceed the disk budget, the least recently
+used are deleted.
+"""
+
+import os
+import time
+import uuid
+import hashlib
+import sqlite3
+import logging
+from sqlalchemy.schema import CreateTable
+import settings
+
+
+def fingerprint(path):
+    """
+    Identity of a log file.
+    :return: Tuple (absolute path, size, modification time in nanoseconds,
+             SHA1 of the first and last settings.TOKEN_CACHE_DIGEST_SIZE
+             bytes)
+    """
+    stat = os.stat(path)
+    length = settings.TOKEN_CACHE_DIGEST_SIZE
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        digest.update(f.read(length))
+        if stat.st_size > length:
+            f.seek(max(stat.st_size - length, length))
+            digest.update(f.read())
+    return (os.path.abspath(path), stat.st_size, stat.st_mtime_ns,
+            digest.hexdigest())
+
+
+class TokenCache(object):
+    """ Token tables of logs kept between runs, evicted least recently used
+    first """
+
+    def __init__(self, directory=None, budget=None):
+        """
+        :param directory:   Cache directory, settings.TOKEN_CACHE_DIR if None
+        :param budget:      Bytes the cached token tables may use on disk,
+                            settings.TOKEN_CACHE_BUDGET if None
+        """
+        super(TokenCache, self).__init__()
+        self.directory = directory or settings.TOKEN_CACHE_DIR
+        self.budget = budget if budget is not None else \
+            settings.TOKEN_CACHE_BUDGET
+        os.makedirs(self.directory, exist_ok=True)
+        self.index = sqlite3.connect(os.path.join(self.directory,
+                                                  "index.db"))
+        self.index.execute(
+            "CREATE TABLE IF NOT EXISTS logs (path TEXT PRIMARY KEY, "
+            "size INTEGER, mtime_ns INTEGER, digest TEXT, file_type INTEGER, "
+            "file_name TEXT, bytes INTEGER, tokens INTEGER, last_used REAL)")
+        self.index.commit()
+
+    def lookup(self, path, file_type):
+        """
+        Cached token table of a log.
+        :return: Path of the cache file, None if the log isn't cached or
+                 changed since
+        """
+        key = fingerprint(path)
+        row = self.index.execute(
+            "SELECT size, mtime_ns, digest, file_type, file_name FROM logs "
+            "WHERE path = ?", key[:1]).fetchone()
+        if row is None:
+            return None
+        cache_file = os.path.join(self.directory, row[4])
+        if tuple(row[:3]) != key[1:] or row[3] != file_type or \
+                not os.path.exists(cache_file):
+            logging.info("Cached tokens of %s are stale" % path)
+            self.remove(key[0])
+            return None
+        self.index.execute("UPDATE logs SET last_used = ? WHERE path = ?",
+                           (time.time(), key[0]))
+        self.index.commit()
+        return cache_file
+
+    def load(self, cache_file, table):
+        """
+        Copy the cached tokens into the token table of the database.
+        :param cache_file:  Path returned by lookup()
+        :param table:       Table object of the token model
+        :return:            Number of tokens copied
+        """
+        settings.engine.execute("ATTACH DATABASE ? AS token_cache",
+                                cache_file)
+        try:
+            count = settings.engine.execute(
+                'INSERT INTO main."{0}" SELECT * FROM token_cache."{0}"'
+                .format(table.name)).rowcount
+        finally:
+            settings.engine.execute("DETACH DATABASE token_cache")
+        logging.info("%d tokens loaded from %s" % (count, cache_file))
+        return count
+
+    def store(self, path, file_type, table):
+        """
+        Copy the token table of the database into the cache, then evict
+        logs until the cache fits into the budget.
+        :param path:        Log file the tokens were read from
+        :param file_type:   Log format of the tokens
+        :param table:       Table object of the token model
+        """
+        key = fingerprint(path)
+        self.remove(key[0])
+        file_name = uuid.uuid4().hex + ".db"
+        cache_file = os.path.join(self.directory, file_name)
+        # Same columns and types as the database, no secondary index
+        connection = sqlite3.connect(cache_file)
+        connection.execute(str(CreateTable(table).compile(
+            dialect=settings.engine.dialect)))
+        connection.close()
+        settings.engine.execute("ATTACH DATABASE ? AS token_cache",
+                                cache_file)
+        try:
+            count = settings.engine.execute(
+                'INSERT INTO token_cache."{0}" SELECT * FROM main."{0}"'
+                .format(table.name)).rowcount
+        finally:
+            settings.engine.execute("DETACH DATABASE token_cache")
+        size = os.path.getsize(cache_file)
+        if size > self.budget:
+            logging.info("Tokens of %s don't fit into the cache budget"
+                         % path)
+            os.remove(cache_file)
+            return
+        self.index.execute(
+            "INSERT INTO logs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            key + (file_type, file_name, size, count, time.time()))
+        self.index.commit()
+        logging.info("%d tokens of %s cached in %s" % (count, path,
+                                                       cache_file))
+        self.evict()
+
+    def remove(self, path):
+        """ Delete the cached tokens of a log, given its absolute path """
+        row = self.index.execute("SELECT file_name FROM logs WHERE path = ?",
+                                 (path,)).fetchone()
+        if row is None:
+            return
+        cache_file = os.path.join(self.directory, row[0])
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+        self.index.execute("DELETE FROM logs WHERE path = ?", (path,))
+        self.index.commit()
+
+    def size(self):
+        """ Bytes used by the cached token tables """
+        return self.index.execute(
+            "SELECT COALESCE(SUM(bytes), 0) FROM logs").fetchone()[0]
+
+    def evict(self):
+        """ Delete the least recently used logs until the cache fits into
+        the budget """
+        total = self.size()
+        for path, size in self.index.execute(
+                "SELECT path, bytes FROM logs ORDER BY last_used").fetchall():
+            if total <= self.budget:
+                break
+            logging.info("Evicting the cached tokens of %s" % path)
+            self.remove(path)
+            total -= size
+
+    def close(self):
+        self.index.close()
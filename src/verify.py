@@ -0,0 +1,99 @@
+"""
+Helpers shared by the benchmarks and the tests: generated log lines and
+snapshots of the results of the pipeline which can be compared between two
+runs, independently of the ids the runs gave to their rows.
+"""
+
+import random
+from sqlalchemy import select, text
+import settings
+import clickpath
+from models import Session, Uurl, association_table
+
+
+# Characters inserted at random positions of generated lines to exercise the
+# corner cases of the parsers
+SPECIAL_CHARS = ' \t\x0b\x1c\xa0\x85"[]-_/.:+?\xe9\xb2\x00\r\n'
+
+
+def generate_apache_lines(count, combined, seed=0):
+    """
+    Random Apache log lines. About a quarter of the lines are mutated by
+    inserting, removing or replacing characters.
+    """
+    rnd = random.Random(seed)
+    users = ["-", "frank", "user_1", "a-b", "", "\xe9t\xe9", '"quoted"']
+    requests = ['GET /index.html HTTP/1.1', 'POST /a/b.php?x=1 HTTP/1.0',
+                'GET / HTTP/1.1', 'HEAD /x"y HTTP/1.1', 'GET  HTTP/1.1',
+                'GET /img.png', 'OPTIONS * HTTP/2.0']
+    agents = ['"Mozilla/5.0 (X11; Linux x86_64)"', '"-"', '""',
+              '"a \\"quoted\\" agent"', '"x" "y"', '"tab\there"']
+    for _ in range(count):
+        line = '{0}.{1}.{2}.{3} {4} {5} [{6:02d}/Mar/2017:{7:02d}:{8:02d}:' \
+            '{9:02d} {10}] "{11}" {12} {13}'.format(
+                rnd.randint(1, 255), rnd.randint(0, 255), rnd.randint(0, 255),
+                rnd.randint(0, 255), rnd.choice(["-", "ident"]),
+                rnd.choice(users), rnd.randint(1, 28), rnd.randint(0, 23),
+                rnd.randint(0, 59), rnd.randint(0, 59),
+                rnd.choice(["+0530", "-0700"]), rnd.choice(requests),
+                rnd.choice([200, 304, 404, 500]),
+                rnd.choice([rnd.randint(0, 99999), "-"]))
+        if combined:
+            line += " {0} {1}".format(rnd.choice(agents), rnd.choice(agents))
+        if rnd.random() < 0.25:
+            position = rnd.randint(0, len(line))
+            operation = rnd.randint(0, 2)
+            if operation == 0:
+                line = line[:position] + rnd.choice(SPECIAL_CHARS) + \
+                    line[position:]
+            elif operation == 1:
+                line = line[:position] + line[position + 1:]
+            else:
+                line = line[:position] + rnd.choice(SPECIAL_CHARS) + \
+                    line[position + 1:]
+        yield line + "\n"
+
+
+def table_contents(model):
+    """ All rows of a token table, used to compare insert paths """
+    return settings.engine.execute(
+        model.__table__.select().order_by(model.token_id)).fetchall()
+
+
+def store_contents(store):
+    """ Columns and dictionaries of a TokenStore, used to compare readers """
+    return ([c.tobytes() for c in store.columns()],
+            [d.values for d in (store.ips, store.urls, store.methods,
+                                store.extensions)])
+
+
+def session_contents():
+    """ Sessions in the database, independent of the ids of the sessions and
+    urls. The click path is None for sessions stored with association
+    rows. """
+    urls = {}
+    for session_id, url in settings.engine.execute(
+            select([association_table.c.session_id, Uurl.url]).where(
+                association_table.c.uurl_id == Uurl.id).order_by(
+                text("association.rowid"))):
+        urls.setdefault(session_id, []).append(url)
+    url_names = dict(settings.engine.execute(
+        select([Uurl.id, Uurl.url])).fetchall())
+    contents = []
+    for session_id, ip, start, end, session_time, pages, url_count, \
+            total_bytes, first_url_id, last_url_id, click_path in \
+            settings.engine.execute(select([
+                Session.id, Session.ip, Session.start_time, Session.end_time,
+                Session.session_time, Session.page_count, Session.url_count,
+                Session.total_bytes, Session.first_url_id,
+                Session.last_url_id, Session.click_path])):
+        clicks = None
+        session_urls = urls.get(session_id, [])
+        if click_path is not None:
+            clicks = [url_names[u] for u in clickpath.decode(click_path)]
+            session_urls = [url_names[u] for u in clickpath.distinct(
+                clickpath.decode(click_path))]
+        contents.append((ip, start, end, session_time, session_urls, pages,
+                         url_count, total_bytes, url_names.get(first_url_id),
+                         url_names.get(last_url_id), clicks))
+    return sorted(contents)
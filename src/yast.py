@@ -1,135 +1,51 @@
 # /usr/bin/python3
 
-import re
-from datetime import timedelta
-from models import TokenCommon, TokenCombined, TokenSquid, Uurl, \
-    Session, get_or_create
+from models import TokenCommon, TokenCombined, TokenSquid, Uurl, Session
+from pipeline import Tokenizer, Filter, Sessionizer, session_rows
 import settings
-from sqlalchemy import or_
 from PyQt4 import QtCore
 import logging
 
 
-class LogFile(object):
-    """ Represents the input log file """
-
-    def __init__(self, file_path):
-        super(LogFile, self).__init__()
-
-        self.path = file_path
-        try:
-            self.file = open(file_path, "r", encoding="latin-1")
-        except (OSError, IOError):
-            raise
-        self.file_type = self.get_file_type()
-        self.session = settings.Session()
-
-    def get_file_type(self):
-        """
-        Returns log file type.
-        :return: File type. Possible values APACHE_COMMON and SQUID
-        """
-        # Save original position
-        orig = self.file.tell()
-        line = self.file.readline()
-        regex_squid = re.compile(settings.SQUID_LOG_RE)
-        regex_common = re.compile(settings.APACHE_COMMON_LOG_RE)
-        regex_combined = re.compile(settings.APACHE_COMBINED_LOG_RE)
-        if regex_squid.match(line):
-            # Move cursor back to original
-            self.file.seek(orig)
-            logging.info("File type SQUID detected")
-            return settings.SQUID
-        elif regex_common.match(line):
-            self.file.seek(orig)
-            logging.info("File type APACHE COMMON detected")
-            return settings.APACHE_COMMON
-        elif regex_combined.match(line):
-            self.file.seek(orig)
-            logging.info("File type APACHE COMBINED detected")
-            return settings.APACHE_COMBINED
-        else:
-            raise ValueError("Unrecognized file format.\nWe currently support "
-                             "only Apache Web Server Log file and Squid Proxy "
-                             "Server Log file.")
-
-
-class TokenizationThread(LogFile, QtCore.QThread):
-    """docstring for TokenizationThread"""
+class TokenizationThread(QtCore.QThread):
+    """ Qt wrapper around pipeline.Tokenizer """
     total_count_signal = QtCore.pyqtSignal(int)
     update_progress_signal = QtCore.pyqtSignal(int, str)
 
     def __init__(self, file_path, f_type):
-        super(TokenizationThread, self).__init__(file_path)
-        if self.file_type != f_type:
-            logging.error("Incorrect file type. Detected type: %d, selected "
-                          "type: %d" % (self.file_type, f_type))
-            raise TypeError
-        self.number_of_lines = self._count_lines()
-        self.one_percentage = self.number_of_lines // 100
-
-    def _count_lines(self):
-        count = sum(1 for _ in self.file)
-        # Move file pointer to the start of the file
-        self.file.seek(0, 0)
-        return count
+        super(TokenizationThread, self).__init__()
+        self.tokenizer = Tokenizer(file_path, f_type)
+        self.file_type = self.tokenizer.file_type
+        # Progress is reported in kilobytes of the file consumed so that
+        # multi-GB files fit into the int signals
+        self.total_kb = max(-(-self.tokenizer.bytes_total // 1024), 1)
+        self.stats = None
 
     def run(self):
         """
         Break the log file into tokens and insert them into the database
         """
-        # Send number of lines to the GUI
-        self.total_count_signal.emit(self.number_of_lines)
-        logging.info("Total number of lines in file %d" % self.number_of_lines)
-
-        self.result_string = ""
-        self.token_array = []
-        if self.file_type == settings.APACHE_COMMON:
-            regex = re.compile(settings.APACHE_COMMON_LOG_RE)
-            # Arg 2 should be list
-            self.result_string = settings.APACHE_COMMON_HEADING
-            for i, line in enumerate(self.file):
-                item = regex.match(line)
-                if not item:
-                    logging.error(
-                        "Couldn't tokenize the following line\n" + line)
-                    continue
-                token_object = TokenCommon(item.groups())
-                self.token_array.append(token_object)
-                self.send_result_signal(i, item.groups())
-
-        elif self.file_type == settings.APACHE_COMBINED:
-            regex = re.compile(settings.APACHE_COMBINED_LOG_RE)
-            self.result_string = settings.APACHE_COMBINED_HEADING
-            for i, line in enumerate(self.file):
-                item = regex.match(line)
-                if not item:
-                    logging.error(
-                        "Couldn't tokenize the following line\n" + line)
-                    continue
-                token_object = TokenCombined(item.groups())
-                self.token_array.append(token_object)
-                self.send_result_signal(i, item.groups())
+        # Send size of the file to the GUI
+        self.total_count_signal.emit(self.total_kb)
 
-        elif self.file_type == settings.SQUID:
-            regex = re.compile(settings.SQUID_LOG_RE)
+        if self.file_type == settings.SQUID:
             self.result_string = settings.SQUID_HEADING
-            for i, line in enumerate(self.file):
-                item = regex.match(line)
-                if not item:
-                    logging.error(
-                        "Couldn't tokenize the following line\n" + line)
-                    continue
-                token_object = TokenSquid(item.groups())
-                self.token_array.append(token_object)
-                self.send_result_signal(i, item.groups())
-
+        else:
+            self.result_string = settings.APACHE_COMMON_HEADING
+        try:
+            self.stats = self.tokenizer.run(
+                on_token=self.send_result_signal,
+                on_progress=self.send_progress_signal)
+        except (OSError, IOError) as e:
+            logging.exception("Failed to tokenize %s" % self.tokenizer.path)
+            self.update_progress_signal.emit(
+                self.total_kb - 1, "Unable to read file: " + str(e))
+            return
+        if self.tokenizer.from_cache:
+            self.result_string = "%d tokens loaded from the token cache" \
+                % self.stats.rows_out
         self.update_progress_signal.emit(
-            self.number_of_lines - 1, self.result_string)
-        self.session.bulk_save_objects(self.token_array)
-        self.session.commit()
-        logging.info("All tokens inserted into database")
-        settings.Session.remove()
+            self.total_kb - 1, self.result_string)
 
     def send_result_signal(self, i, token_group=None):
         """
@@ -158,75 +74,34 @@ class TokenizationThread(LogFile, QtCore.QThread):
 
         self.result_string = self.result_string + "\n" + msg
 
-        # Emit signal only when "1%" work is completed
-        if not (i % self.one_percentage):
-            self.update_progress_signal.emit(i, self.result_string)
-            self.result_string = ""
-            self.session.bulk_save_objects(self.token_array)
-            self.token_array = []
+    def send_progress_signal(self, bytes_read):
+        """
+        Invoked by the tokenizer every time "1%" of the file is consumed
+        :param bytes_read: Number of bytes of the file consumed so far
+        """
+        self.update_progress_signal.emit(
+            bytes_read // 1024 - 1, self.result_string)
+        self.result_string = ""
 
 
-class FilteringThread(LogFile, QtCore.QThread):
-    """ Filters data in the database according to ignore criteria"""
+class FilteringThread(QtCore.QThread):
+    """ Qt wrapper around pipeline.Filter """
 
     total_count_signal = QtCore.pyqtSignal(int)
     update_progress_signal = QtCore.pyqtSignal(int, str)
 
     def __init__(self, file_path, ignore_list):
-        super(FilteringThread, self).__init__(file_path)
-        self.ignore_list = ignore_list
+        super(FilteringThread, self).__init__()
+        self.filter = Filter(file_path, ignore_list)
+        self.file_type = self.filter.file_type
+        self.session = self.filter.session
 
     def run(self):
         """
         Removes unnecessary entries from the log file based on the list of
         file formats in items list
         """
-        # Strip whitespaces from every element of the ignore_list
-        ignore_list = [x.strip(' ') for x in self.ignore_list]
-        logging.info("File type to remove: %s" % str(ignore_list))
-        if self.file_type == settings.APACHE_COMMON:
-            # Ignore criteria
-            status_code = settings.apache_ignore_criteria['status_code']
-            # Request method
-            method = settings.apache_ignore_criteria['method']
-            min_size = settings.apache_ignore_criteria['size_of_object']
-
-            self.session.query(TokenCommon).filter(
-                or_(TokenCommon.status_code != status_code,
-                    ~TokenCommon.method.in_(method),
-                    TokenCommon.request_ext.in_(ignore_list),
-                    TokenCommon.size_of_object <= min_size)).delete(
-                synchronize_session='fetch')
-
-        elif self.file_type == settings.APACHE_COMBINED:
-            # Ignore criteria
-            status_code = settings.apache_ignore_criteria['status_code']
-            # Request method
-            method = settings.apache_ignore_criteria['method']
-            min_size = settings.apache_ignore_criteria['size_of_object']
-
-            self.session.query(TokenCombined).filter(
-                or_(TokenCombined.status_code != status_code,
-                    ~TokenCombined.method.in_(method),
-                    TokenCombined.request_ext.in_(ignore_list),
-                    TokenCombined.size_of_object <= min_size)).delete(
-                synchronize_session='fetch')
-
-        elif self.file_type == settings.SQUID:
-            # Ignore criteria
-            status_code = settings.squid_ignore_criteria['status_code']
-            # Request method
-            method = settings.squid_ignore_criteria['method']
-            min_size = settings.squid_ignore_criteria['size_of_object']
-
-            self.session.query(TokenSquid).filter(
-                or_(TokenSquid.status_code != status_code,
-                    ~TokenSquid.method.in_(method),
-                    TokenSquid.request_ext.in_(ignore_list),
-                    TokenSquid.bytes_delivered <= min_size)).delete(
-                synchronize_session='fetch')
-
-        self.session.commit()
+        self.filter.run()
         self.send_all_data()
         settings.Session.remove()
 
@@ -299,8 +174,8 @@ class FilteringThread(LogFile, QtCore.QThread):
             self.update_progress_signal.emit(total_items - 1, result_string)
 
 
-class SessionThread(LogFile, QtCore.QThread):
-    """ The thread that performs sessionization of the data in the database """
+class SessionThread(QtCore.QThread):
+    """ Qt wrapper around pipeline.Sessionizer """
 
     total_count_signal = QtCore.pyqtSignal(int)
     update_progress_signal = QtCore.pyqtSignal(int, str)
@@ -309,124 +184,24 @@ class SessionThread(LogFile, QtCore.QThread):
     number_of_sessions_signal = QtCore.pyqtSignal(int)
 
     def __init__(self, file_path, session_timer):
-        super(SessionThread, self).__init__(file_path)
-        self.session_timer = timedelta(minutes=session_timer)
-        logging.info("Session timer: %s" % str(self.session_timer))
+        super(SessionThread, self).__init__()
+        self.sessionizer = Sessionizer(file_path, session_timer)
+        self.file_type = self.sessionizer.file_type
+        self.session = self.sessionizer.session
 
     def run(self):
-        self.init_tables()
-        Token_type = None
-
-        if self.file_type == settings.APACHE_COMMON:
-            Token_type = TokenCommon
-        elif self.file_type == settings.SQUID:
-            Token_type = TokenSquid
-        elif self.file_type == settings.APACHE_COMBINED:
-            Token_type = TokenCombined
-        # Get all distinct ip addresses
-        all_entries = self.session.query(Token_type.ip_address).order_by(
-            'ip_address').distinct().all()
-
-        self.total_count_signal.emit(len(all_entries))
-
-        # Create sessions for each IP address
-        for i, entry in enumerate(all_entries):
-
-            # Get all entries for an ip address
-            same_ip_entries = self.session.query(Token_type).filter(
-                Token_type.ip_address == entry.ip_address).order_by(
-                Token_type.date_time).all()
-
-            total_session_time = timedelta(0)
-
-            first_entry = same_ip_entries.pop(0)
-            # Add the first entry to sessions.
-            self.insert_item(first_entry, True)
-            # Last entry time is the datetime of the last entry processed
-            last_entry_time = first_entry.date_time
-
-            for e in same_ip_entries:
-                # Calculate new session time
-                s_time = e.date_time - last_entry_time
-                # If new session time is greater than threshold
-                if s_time + total_session_time > self.session_timer:
-                    # Create new session
-                    self.insert_item(e, True)
-                    total_session_time = timedelta(0)
-                # If new session time is not greater than threshold
-                else:
-                    total_session_time = s_time + total_session_time
-                    self.insert_item(e, False, total_session_time)
-                last_entry_time = e.date_time
-            self.update_progress_signal.emit(i, None)
-            # Generating sessions completed
-            self.step_completed_signal.emit(1)
-        logging.info("All sessions created. Sending result to the GUI")
-        self.session.commit()
+        self.sessionizer.run(on_total=self.total_count_signal.emit,
+                             on_progress=self.ip_completed)
+        logging.info("Sending result to the GUI")
         self.send_results()
         settings.Session.remove()
 
-    def init_tables(self):
-        """ Drop sessions and url tables and create new tables.
-        This is done to clear all the previous sessions.
+    def ip_completed(self, i):
+        """ Invoked by the sessionizer once all sessions of an ip are created
         """
-
-        settings.Base.metadata.tables[
-            'session_master'].drop(bind=settings.engine)
-        settings.Base.metadata.tables['uurl'].drop(bind=settings.engine)
-
-        settings.Base.metadata.tables[
-            'session_master'].create(bind=settings.engine)
-        settings.Base.metadata.tables['uurl'].create(bind=settings.engine)
-
-        logging.info("Sessionization Tables created")
-
-    def insert_item(self, token_object,
-                    new_session, session_time=timedelta(0)):
-        """
-        Create new session or update existing session object
-        :param token_object:    Token that has to be converted into session
-        :param new_session:     Boolean that denotes if this is a new session.
-                                A new session will be created if this value
-                                is True
-        :param session_time:    If an existing session is to be updated,
-                                session_time contains the new value of total
-                                session time
-        """
-        if self.file_type == settings.APACHE_COMMON:
-            url_obj = get_or_create(
-                self.session, Uurl, url=token_object.resource_requested)
-        elif self.file_type == settings.APACHE_COMBINED:
-            url_obj = get_or_create(
-                self.session, Uurl, url=token_object.resource_requested)
-        elif self.file_type == settings.SQUID:
-            url_obj = get_or_create(
-                self.session, Uurl, url=token_object.url)
-
-        # If this is a new session
-        if new_session:
-            # Create session object
-            session_obj = Session(
-                ip=token_object.ip_address, session_time=session_time)
-            # Set start and end time
-            session_obj.start_time = token_object.date_time
-            session_obj.end_time = token_object.date_time
-        # If new_session is False, new session may or may not be created
-        # (depending upon the session_time)
-        else:
-            # Try to get session object
-            session_obj = get_or_create(
-                self.session, Session, ip=token_object.ip_address)
-            # If the object is a new session
-            if session_obj.session_time is timedelta(0):
-                session_obj.start_time = token_object.date_time
-
-            session_obj.session_time = session_time
-            session_obj.end_time = token_object.date_time
-
-        # Add url to session
-        session_obj.session_urls.append(url_obj)
-        self.session.add(session_obj)
+        self.update_progress_signal.emit(i, None)
+        # Generating sessions completed
+        self.step_completed_signal.emit(1)
 
     def send_results(self):
         """ Send sessionized data to the GUI """
@@ -457,13 +232,16 @@ class SessionThread(LogFile, QtCore.QThread):
 
         result_string = settings.SESSION_OUTPUT_HEADING
 
-        # Send all sessions back to GUI
-        session_query = self.session.query(Session).all()
-        for s in session_query:
-            result_string = result_string + "\n" + str(s)
-            if not ((last_id + s.id - 1) % settings.RESULT_SIGNAL_SIZE):
+        # Send all sessions back to GUI. Their urls are read with a single
+        # query instead of loading session_urls for every session.
+        for session_id, ip, session_time, url_ids in session_rows(
+                self.session):
+            result_string = result_string + "\n" + \
+                settings.SESSION_OUTPUT_FORMAT.format(
+                    session_id, ip, str(session_time), str(url_ids))
+            if not ((last_id + session_id - 1) % settings.RESULT_SIGNAL_SIZE):
                 self.update_progress_signal.emit(
-                    last_id + s.id - 1, result_string)
+                    last_id + session_id - 1, result_string)
                 result_string = ""
         self.update_progress_signal.emit(total_records - 1, result_string)
         logging.info("All sessions sent to the GUI")
@@ -4,6 +4,7 @@ import sys
 import atexit
 import logging
 import settings
+import pipeline
 from yast import TokenizationThread, FilteringThread, SessionThread
 
 
@@ -134,7 +135,7 @@ class YastGui(QtGui.QMainWindow):
 
         self.ui.progressBar.setValue(0)
         self.ui.records_processed_value_label.setText("0/0")
-        self.ui.records_processed_label.setText("Records processed")
+        self.ui.records_processed_label.setText("KB processed")
         self.ui.output_plainTextEdit.setPlainText("")
 
     def tokenization_completed(self):
@@ -145,7 +146,10 @@ class YastGui(QtGui.QMainWindow):
 
         self.ui.B_Save.setEnabled(True)
         self.ui.B_Close.setEnabled(True)
-        count = self.ui.records_processed_value_label.text().split('/')[0]
+        count = self.thread.stats.rows_out if self.thread.stats else 0
+        # Progress was reported in kilobytes, filtering needs the number of
+        # tokens to compute the number of deleted entries
+        self.total_records = count
         msg = "Tokenization completed. Successfully processed {0} lines. "\
             "Total Time Taken: {1: .2f} secs. Please start clean or "\
             "sessionization.".format(count, self.timer.elapsed() / 1000)
@@ -177,12 +181,7 @@ class YastGui(QtGui.QMainWindow):
 
     def init_database(self):
         """ Create all tables """
-        # Drop all existing tables
-        settings.Base.metadata.drop_all(settings.engine)
-        # create new tables
-        settings.Base.metadata.create_all(settings.engine)
-        settings.session.commit()
-        logging.info("All tables created")
+        pipeline.init_database()
 
     def filter_handler(self):
         """ Filter handler is invoked by start cleaning button """
@@ -208,6 +207,7 @@ class YastGui(QtGui.QMainWindow):
 
         self.ui.B_Save.setEnabled(False)
         self.ui.B_Close.setEnabled(False)
+        self.ui.records_processed_label.setText("Records processed")
         msg = "Log Filtering in progress. Please wait..."
         self.ui.status_lineEdit.setText(msg)
         self.ui.output_plainTextEdit.setPlainText("")
@@ -258,6 +258,7 @@ class YastGui(QtGui.QMainWindow):
 
         self.ui.B_Save.setEnabled(False)
         self.ui.B_Close.setEnabled(False)
+        self.ui.records_processed_label.setText("Records processed")
         msg = "Sessionization in progress. Please wait..."
         self.ui.status_lineEdit.setText(msg)
         self.ui.output_plainTextEdit.setPlainText("")
@@ -0,0 +1,61 @@
+import os
+import sys
+import gzip
+import random
+import tempfile
+import pytest
+
+# The database and the token cache are set up when settings is imported
+TEST_DIR = tempfile.mkdtemp(prefix="yast-tests-")
+os.environ["YAST_DATABASE"] = os.path.join(TEST_DIR, "yast.db")
+os.environ["YAST_CACHE_DIR"] = os.path.join(TEST_DIR, "cache")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import settings  # noqa: E402
+import pipeline  # noqa: E402
+
+COMBINED_LINE = ('{ip} - - [01/Mar/2017:{hour:02d}:{minute:02d}:{second:02d} '
+                 '+0530] "{method} /p{page}.{ext} HTTP/1.1" {status} {size} '
+                 '"http://ref/x" "Mozilla/5.0 (X11)"\n')
+
+
+def combined_lines(count, seed=1, ips=50, pages=200):
+    """ Combined log lines in time order with random ips, pages, methods,
+    extensions, status codes and sizes """
+    rand = random.Random(seed)
+    lines = []
+    for i in range(count):
+        seconds = i * 3
+        lines.append(COMBINED_LINE.format(
+            ip="10.0.%d.%d" % (rand.randrange(ips) // 250,
+                               rand.randrange(ips) % 250),
+            hour=seconds // 3600 % 24, minute=seconds // 60 % 60,
+            second=seconds % 60,
+            method=rand.choice(("GET", "GET", "GET", "POST", "HEAD")),
+            page=rand.randrange(pages),
+            ext=rand.choice(("html", "html", "php", "css", "png")),
+            status=rand.choice((200, 200, 200, 304, 404)),
+            size=rand.choice(("-", rand.randrange(5000)))))
+    return lines
+
+
+@pytest.fixture
+def database():
+    """ Empty database tables """
+    pipeline.init_database()
+    yield settings.session
+    settings.session.rollback()
+    settings.Session.remove()
+
+
+@pytest.fixture
+def make_log(tmp_path):
+    """ Writes log lines to a file, gzip compressed if the name ends with
+    .gz, and returns its path """
+    def make(name, lines):
+        path = str(tmp_path / name)
+        opener = gzip.open if name.endswith(".gz") else open
+        with opener(path, "wb") as f:
+            f.write("".join(lines).encode("latin-1"))
+        return path
+    return make
@@ -0,0 +1,69 @@
+import pytest
+import settings
+import pipeline
+from models import TokenCombined, Session, Uurl, association_table
+from conftest import combined_lines
+
+
+def index_names(*tables):
+    return set(index.name for table in tables for index in table.indexes)
+
+
+def database_indexes():
+    return set(name for name, in settings.engine.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND "
+        "sql IS NOT NULL"))
+
+
+def test_failed_token_load_keeps_indexes(database, make_log, monkeypatch):
+    monkeypatch.setattr(settings, "TOKEN_BATCH_SIZE", 100)
+    path = make_log("access.log.gz", combined_lines(5000))
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:len(data) // 2])
+    tokenizer = pipeline.Tokenizer(path, bulk_load=True, cache=False)
+    with pytest.raises(IOError):
+        tokenizer.run()
+    assert index_names(TokenCombined.__table__) <= database_indexes()
+    assert database.query(TokenCombined).count() == 0
+
+
+def test_failed_session_load_keeps_indexes(database, make_log, monkeypatch):
+    path = make_log("access.log", combined_lines(2000))
+    pipeline.Tokenizer(path, cache=False).run()
+    monkeypatch.setattr(settings, "SESSION_BATCH_SIZE", 10)
+    insert = pipeline.SessionInserter.insert
+    calls = []
+
+    def failing_insert(self, sessions, intern):
+        calls.append(len(sessions))
+        if len(calls) == 3:
+            raise RuntimeError("load failed")
+        return insert(self, sessions, intern)
+    monkeypatch.setattr(pipeline.SessionInserter, "insert", failing_insert)
+    with pytest.raises(RuntimeError):
+        pipeline.Sessionizer(path, 5, bulk_load=True).run()
+    assert index_names(Session.__table__, association_table,
+                       Uurl.__table__) <= database_indexes()
+    assert database.query(Session).count() == 0
+
+
+def test_failed_parallel_load_rolls_back(database, make_log, monkeypatch):
+    path = make_log("access.log", combined_lines(2000))
+    pipeline.Tokenizer(path, cache=False).run()
+    journal_mode = pipeline.journal_mode()
+    monkeypatch.setattr(settings, "SESSION_BATCH_SIZE", 10)
+    insert = pipeline.SessionInserter.insert
+    calls = []
+
+    def failing_insert(self, sessions, intern):
+        calls.append(len(sessions))
+        if len(calls) == 3:
+            raise RuntimeError("load failed")
+        return insert(self, sessions, intern)
+    monkeypatch.setattr(pipeline.SessionInserter, "insert", failing_insert)
+    with pytest.raises(RuntimeError):
+        pipeline.Sessionizer(path, 5, workers=2).run()
+    assert pipeline.journal_mode() == journal_mode
+    assert database.query(Session).count() == 0
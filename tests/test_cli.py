@@ -0,0 +1,22 @@
+import cli
+from conftest import combined_lines
+
+
+def test_profile_without_tokens(database, make_log, tmp_path, capsys):
+    path = make_log("access.log", combined_lines(100))
+    assert cli.main(["--log", str(tmp_path / "yast.log"), "profile", path,
+                     "--profile", "pages", "--ignore", "css"]) == 1
+    error = capsys.readouterr().err
+    assert "No tokens" in error
+    assert "run %s --profile pages" % path in error
+
+
+def test_profile_after_run(database, make_log, tmp_path, capsys):
+    path = make_log("access.log", combined_lines(1000))
+    out = str(tmp_path / "sessions.csv")
+    assert cli.main(["--log", str(tmp_path / "yast.log"), "run", path,
+                     "--ignore", "css", "--profile", "pages"]) == 0
+    assert cli.main(["--log", str(tmp_path / "yast.log"), "profile", path,
+                     "--profile", "no_images", "--ignore", "css,png",
+                     "--out", out]) == 0
+    assert "sessions written to %s" % out in capsys.readouterr().out
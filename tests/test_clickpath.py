@@ -0,0 +1,51 @@
+import random
+import pytest
+from sqlalchemy import select, func
+import settings
+import pipeline
+import clickpath
+from models import Session, TokenCombined
+from conftest import combined_lines
+
+
+def test_encode_decode_round_trip():
+    rand = random.Random(0)
+    # Both sides of every byte boundary of the varints
+    url_ids = [0, 1, 127, 128, 255, 16383, 16384, 2 ** 21 - 1, 2 ** 21,
+               2 ** 31 - 1, 2 ** 40]
+    url_ids += [rand.randrange(2 ** rand.randrange(1, 32))
+                for _ in range(10000)]
+    blob = clickpath.encode(url_ids)
+    assert clickpath.decode(blob) == url_ids
+    assert len(clickpath.encode(range(128))) == 128
+    assert clickpath.decode(b"") == []
+    # Concatenated blobs decode to the concatenated ids
+    assert clickpath.decode(
+        blob + clickpath.encode([5, 300])) == url_ids + [5, 300]
+    with pytest.raises(ValueError):
+        clickpath.decode(clickpath.encode([300])[:1])
+
+
+def test_distinct():
+    assert clickpath.distinct([3, 1, 3, 2, 1, 4]) == [3, 1, 2, 4]
+
+
+def test_click_paths_match_association(database, make_log):
+    path = make_log("access.log", combined_lines(3000))
+    pipeline.Tokenizer(path, cache=False).run()
+    pipeline.Sessionizer(path, 5,
+                         url_storage=settings.URLS_ASSOCIATION).run()
+    association = list(pipeline.session_rows())
+    assert len(association) > 100
+
+    pipeline.Sessionizer(path, 5, url_storage=settings.URLS_CLICK_PATH).run()
+    assert list(pipeline.session_rows()) == association
+    clicks = 0
+    for pages, last_url_id, click_path in settings.engine.execute(select([
+            Session.page_count, Session.last_url_id, Session.click_path])):
+        click_ids = clickpath.decode(click_path)
+        assert len(click_ids) == pages
+        assert click_ids[-1] == last_url_id
+        clicks += len(click_ids)
+    assert clicks == settings.engine.execute(
+        select([func.count()]).select_from(TokenCombined)).scalar()
@@ -0,0 +1,79 @@
+import os
+import random
+import datetime
+import tracemalloc
+import pipeline
+from extsort import TokenSorter, MERGE_FAN_IN
+from verify import session_contents
+from conftest import combined_lines
+
+
+def random_tokens(count, seed=0):
+    """ (ip address, time, url, size) tokens with many equal ips and
+    times """
+    rand = random.Random(seed)
+    start = datetime.datetime(2017, 3, 1)
+    return [("10.0.%d.%d" % (rand.randrange(4), rand.randrange(250)),
+             start + datetime.timedelta(seconds=rand.randrange(3600)),
+             "/p%d.html" % rand.randrange(500), rand.randrange(5000))
+            for _ in range(count)]
+
+
+def sorted_tokens(tokens, memory_budget):
+    sorter = TokenSorter(memory_budget)
+    for token in tokens:
+        sorter.add(*token)
+    try:
+        return list(sorter.sorted_tokens()), sorter.run_count
+    finally:
+        sorter.close()
+
+
+def test_external_sort_matches_in_memory_sort():
+    tokens = random_tokens(40000)
+    expected, runs = sorted_tokens(tokens, None)
+    assert runs == 0
+    # Tokens with the same ip address and time keep the order they were
+    # added in
+    assert expected == sorted(tokens, key=lambda token: token[:2])
+    result, runs = sorted_tokens(tokens, 64 * 1024)
+    # The runs are merged in more than one pass
+    assert runs > MERGE_FAN_IN
+    assert result == expected
+
+
+def test_external_sort_memory():
+    tokens = random_tokens(20000)
+    peaks = []
+    for memory_budget in (None, 32 * 1024):
+        sorter = TokenSorter(memory_budget)
+        tracemalloc.start()
+        for token in tokens:
+            sorter.add(*token)
+        count = sum(1 for _ in sorter.sorted_tokens())
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        sorter.close()
+        assert count == len(tokens)
+    in_memory, external = peaks
+    assert external * 4 < in_memory
+
+
+def test_sessions_over_budget(database, make_log):
+    path = make_log("access.log", combined_lines(20000, ips=500))
+    pipeline.Tokenizer(path, cache=False).run()
+    pipeline.Sessionizer(path, 5).run()
+    reference = session_contents()
+
+    pipeline.init_database()
+    # The log is several times larger than the budget
+    memory_budget = os.path.getsize(path) // 8
+    sorter = TokenSorter(memory_budget)
+    try:
+        tokenize = pipeline.Tokenizer(path, sorter=sorter).run()
+        stats = pipeline.Sessionizer(path, 5, sorter=sorter).run()
+        assert sorter.run_count > 8
+    finally:
+        sorter.close()
+    assert tokenize.rows_out == stats.rows_in == 20000
+    assert session_contents() == reference
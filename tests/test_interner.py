@@ -0,0 +1,45 @@
+import random
+import logging
+import pipeline
+from interner import UrlInterner
+from verify import session_contents
+from conftest import combined_lines
+
+
+def interned(urls, memory_budget):
+    interner = UrlInterner(memory_budget)
+    try:
+        ids = [interner.intern(url) for url in urls]
+        return ids, list(interner.items()), interner.spilled is not None
+    finally:
+        interner.close()
+
+
+def test_spilled_urls_keep_their_ids():
+    rand = random.Random(0)
+    urls = ["/p%d.html" % rand.randrange(3000) for _ in range(20000)]
+    expected, items, spilled = interned(urls, None)
+    assert not spilled
+    # Ids are given in the order the urls are first seen
+    first_seen = list(dict.fromkeys(urls))
+    assert items == list(enumerate(first_seen, 1))
+
+    # The budget is exceeded many times while the urls are interned
+    result, spilled_items, spilled = interned(urls, 16 * 1024)
+    assert spilled
+    assert result == expected
+    assert spilled_items == items
+
+
+def test_sessions_over_url_budget(database, make_log, caplog):
+    path = make_log("access.log", combined_lines(5000, pages=2000))
+    pipeline.Tokenizer(path, cache=False).run()
+    pipeline.Sessionizer(path, 5).run()
+    reference = session_contents()
+
+    pipeline.init_database()
+    pipeline.Tokenizer(path, cache=False).run()
+    with caplog.at_level(logging.INFO):
+        pipeline.Sessionizer(path, 5, url_memory=16 * 1024).run()
+    assert "Url memory budget exceeded" in caplog.text
+    assert session_contents() == reference
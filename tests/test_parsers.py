@@ -0,0 +1,41 @@
+import time
+import pytest
+import settings
+import parsers
+from verify import generate_apache_lines
+
+APACHE_FORMATS = [settings.APACHE_COMMON, settings.APACHE_COMBINED]
+
+
+@pytest.mark.parametrize("file_type", APACHE_FORMATS)
+@pytest.mark.parametrize("fast", [False, True])
+def test_parser_matches_regex(file_type, fast):
+    """ Differential test against the regex on lines with random
+    mutations """
+    regex_parse = parsers.regex_parser(file_type)
+    parse = parsers.line_parser(file_type, fast=fast)
+    lines = list(generate_apache_lines(
+        20000, file_type == settings.APACHE_COMBINED, seed=file_type))
+    mismatches = [line for line in lines if parse(line) != regex_parse(line)]
+    assert mismatches == []
+    # The corpus exercises both outcomes
+    assert 0 < sum(1 for line in lines if regex_parse(line)) < len(lines)
+
+
+def test_hand_parser_handles_ordinary_lines():
+    fast_parse = parsers.FAST_PARSERS[settings.APACHE_COMBINED]
+    line = '10.0.0.8 - - [01/Mar/2017:00:00:04 +0530] "GET /p32.html ' \
+        'HTTP/1.1" 200 - "http://ref/x" "Mozilla/5.0 (X11) \\"q\\""\n'
+    assert fast_parse(line) == parsers.regex_parser(
+        settings.APACHE_COMBINED)(line)
+
+
+@pytest.mark.parametrize("fast", [False, True])
+def test_combined_tail_without_closing_quote(fast):
+    """ The regex backtracks over every '" "' of such a tail """
+    line = '127.0.0.1 - - [01/Mar/2017:00:00:00 +0530] "GET / HTTP/1.1" ' \
+        '200 1 "' + '" "' * 20000 + '-\n'
+    parse = parsers.line_parser(settings.APACHE_COMBINED, fast=fast)
+    start = time.time()
+    assert parse(line) is None
+    assert time.time() - start < 1
@@ -0,0 +1,30 @@
+import pytest
+from sqlalchemy import select
+import settings
+import pipeline
+import queryplan
+from models import TokenCommon, TokenCombined, TokenSquid
+
+
+@pytest.mark.parametrize("model", [TokenCommon, TokenCombined, TokenSquid])
+def test_filter_plans(database, model):
+    file_type = next(f_type for f_type, token_model in
+                     pipeline.TOKEN_MODELS.items() if token_model is model)
+    table = model.__tablename__
+    ignored = pipeline.ignored_tokens(file_type, ["css"],
+                                      pipeline.ignore_criteria(file_type))
+    # The disjunction of the ignore criteria can't be searched in an index,
+    # the DELETE of Filter scans the table and only the session index is
+    # updated for every deleted token
+    assert queryplan.query_plan(model.__table__.delete().where(ignored)) == [
+        "SCAN %s" % table]
+    assert "ix_%s_filter" % table not in [
+        index.name for index in model.__table__.indexes]
+    assert queryplan.query_plan(
+        select([model.token_id]).where(ignored)) == [
+        "SCAN %s USING COVERING INDEX ix_%s_session" % (table, table)]
+
+
+@pytest.mark.parametrize("log_format", sorted(settings.LOG_FORMATS))
+def test_no_unexpected_scans(database, log_format, capsys):
+    assert queryplan.main(["--format", log_format]) == 0
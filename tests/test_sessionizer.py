@@ -0,0 +1,78 @@
+import pytest
+import settings
+import pipeline
+from verify import session_contents
+from conftest import combined_lines
+
+
+@pytest.mark.parametrize("url_storage", [settings.URLS_ASSOCIATION,
+                                         settings.URLS_CLICK_PATH])
+def test_incremental_matches_full_rebuild(database, make_log, url_storage):
+    lines = combined_lines(4000)
+    # A few lines of the last step are older than the last session of their
+    # ip address, which is then sessionized again
+    lines[3500:3520] = lines[100:120]
+    path = make_log("access.log", [])
+    extended = rebuilt = 0
+    for start in range(0, len(lines), 1000):
+        with open(path, "a", encoding="latin-1") as log:
+            log.writelines(lines[start:start + 1000])
+        pipeline.Tokenizer(path, incremental=True).run()
+        sessionizer = pipeline.Sessionizer(path, 5, incremental=True,
+                                           url_storage=url_storage)
+        sessionizer.run()
+        extended += sessionizer.extended_count
+        rebuilt += sessionizer.rebuilt_count
+    incremental = session_contents()
+    assert extended > 0 and rebuilt > 0
+
+    pipeline.Sessionizer(path, 5, url_storage=url_storage).run()
+    assert session_contents() == incremental
+    assert len(incremental) > 100
+
+
+def worker_sessions(path, workers):
+    pipeline.init_database()
+    pipeline.Tokenizer(path, cache=False).run()
+    pipeline.Sessionizer(path, 5, workers=workers).run()
+    return session_contents()
+
+
+@pytest.mark.parametrize("lines", [
+    # One ip address has more tokens than a whole range
+    [("10.9.9.9" + line[line.index(" "):]) if i % 3 else line
+     for i, line in enumerate(combined_lines(3000))],
+    # More workers than ip addresses
+    combined_lines(1000, ips=2),
+], ids=["large ip", "few ips"])
+def test_parallel_matches_single_process(database, make_log, lines):
+    path = make_log("access.log", lines)
+    single = worker_sessions(path, 1)
+    assert worker_sessions(path, 3) == single
+    assert len(single) > 10
+    # The journal mode is set back once the workers are done
+    assert pipeline.journal_mode() != "wal"
+
+
+def test_incremental_ignore_list_changed(database, make_log):
+    lines = combined_lines(4000)
+    path = make_log("access.log", [])
+    for start, ignore_list in ((0, ["css"]), (2000, ["css", "php"])):
+        with open(path, "a", encoding="latin-1") as log:
+            log.writelines(lines[start:start + 2000])
+        pipeline.Tokenizer(path, incremental=True).run()
+        filtering = pipeline.Filter(path, ignore_list)
+        filtering.run()
+        sessionizer = pipeline.Sessionizer(
+            path, 5, incremental=True, filter_rules=pipeline.filter_rules(
+                filtering.file_type, ignore_list))
+        sessionizer.run()
+    # The second Filter deleted sessionized tokens, so the sessions are all
+    # created again
+    assert sessionizer.extended_count == sessionizer.rebuilt_count == 0
+    incremental = session_contents()
+    assert not any(url.endswith(".php") for url, in settings.engine.execute(
+        "SELECT url FROM uurl"))
+
+    pipeline.Sessionizer(path, 5).run()
+    assert session_contents() == incremental
@@ -0,0 +1,61 @@
+import random
+import pytest
+import settings
+from store import TokenStore
+
+pytest.importorskip("numpy")
+
+TIMER = 300
+
+
+def token_store(tokens):
+    """ Store of (ip address, epoch seconds, url) tokens """
+    store = TokenStore(settings.APACHE_COMMON)
+    for ip, time, url in tokens:
+        store.ip_address.append(store.ips.encode(ip))
+        store.date_time.append(time)
+        store.url.append(store.urls.encode(url))
+    return store
+
+
+def both_sessions(store):
+    loop = list(store.sessions(TIMER, vectorized=False))
+    assert list(store.sessions(TIMER, vectorized=True)) == loop
+    return loop
+
+
+def test_vectorized_empty_store():
+    assert both_sessions(token_store([])) == []
+
+
+def test_vectorized_single_ip():
+    rand = random.Random(0)
+    time = 1488326400
+    tokens = []
+    for _ in range(5000):
+        time += rand.choice((1, 7, 60, 200, TIMER, 1000))
+        tokens.append(("10.0.0.1", time, "/p%d.html" % rand.randrange(50)))
+    sessions = both_sessions(token_store(tokens))
+    assert 100 < len(sessions) < len(tokens)
+
+
+def test_vectorized_gaps_equal_to_timer():
+    # A token exactly session_timer after the start of its session still
+    # belongs to it
+    tokens = [(ip, 1488326400 + i * TIMER, "/p%d.html" % i)
+              for ip in ("10.0.0.1", "10.0.0.2") for i in range(5)]
+    store = token_store(tokens)
+    sessions = [(ip, end - start, len(urls))
+                for ip, start, end, urls in both_sessions(store)]
+    assert sessions == [(ip, duration, urls) for ip in ("10.0.0.1", "10.0.0.2")
+                        for duration, urls in ((TIMER, 2), (TIMER, 2),
+                                               (0, 1))]
+
+
+def test_vectorized_many_ips():
+    rand = random.Random(1)
+    tokens = sorted((("10.0.0.%d" % rand.randrange(40),
+                      1488326400 + rand.randrange(20000),
+                      "/p%d.html" % rand.randrange(100))
+                     for _ in range(10000)), key=lambda token: token[1])
+    both_sessions(token_store(tokens))
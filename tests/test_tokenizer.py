@@ -0,0 +1,106 @@
+import pytest
+from sqlalchemy import select
+import settings
+import pipeline
+from models import TokenCombined
+from verify import table_contents
+from conftest import combined_lines
+
+
+def token_count(session):
+    return session.query(TokenCombined).count()
+
+
+def test_tokenize_gzip(database, make_log):
+    path = make_log("access.log.gz", combined_lines(1000))
+    stats = pipeline.Tokenizer(path, cache=False).run()
+    assert stats.rows_in == stats.rows_out == 1000
+    assert token_count(database) == 1000
+
+
+def test_truncated_gzip(database, make_log):
+    path = make_log("access.log.gz", combined_lines(20000))
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:len(data) // 2])
+    tokenizer = pipeline.Tokenizer(path, cache=False)
+    with pytest.raises(IOError) as e:
+        tokenizer.run()
+    assert path in str(e.value)
+    # The tokens read before the end of the archive are rolled back
+    assert token_count(database) == 0
+
+
+def test_incremental_unchanged_gzip(database, make_log):
+    path = make_log("access.log.gz", combined_lines(100))
+    pipeline.Tokenizer(path, incremental=True).run()
+    stats = pipeline.Tokenizer(path, incremental=True).run()
+    assert stats.rows_in == 0
+    assert token_count(database) == 100
+
+
+def test_incremental_changed_gzip(database, make_log):
+    path = make_log("access.log.gz", combined_lines(100))
+    pipeline.Tokenizer(path, incremental=True).run()
+    make_log("access.log.gz", combined_lines(150))
+    with pytest.raises(ValueError):
+        pipeline.Tokenizer(path, incremental=True)
+    assert token_count(database) == 100
+
+
+def test_token_cache_is_opt_in(database, make_log, tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setattr(settings, "TOKEN_CACHE_DIR", str(cache_dir))
+    path = make_log("access.log", combined_lines(100))
+    pipeline.Tokenizer(path).run()
+    assert not cache_dir.exists()
+
+    pipeline.init_database()
+    pipeline.Tokenizer(path, cache=True).run()
+    pipeline.init_database()
+    tokenizer = pipeline.Tokenizer(path, cache=True)
+    tokenizer.run()
+    assert tokenizer.from_cache
+    assert token_count(database) == 100
+
+
+def test_core_insert_matches_orm(database, make_log):
+    path = make_log("access.log", combined_lines(1000))
+    contents = []
+    for core_insert in (False, True):
+        pipeline.init_database()
+        tokenizer = pipeline.Tokenizer(path, core_insert=core_insert)
+        tokenizer.run()
+        contents.append(table_contents(tokenizer.token_model))
+    assert len(contents[0]) == 1000
+    assert contents[0] == contents[1]
+
+
+def token_rows(model):
+    """ Token rows without their ids, which differ when lines are dropped
+    while tokenizing """
+    columns = [c for c in model.__table__.columns if c.key != "token_id"]
+    return settings.engine.execute(
+        select(columns).order_by(model.token_id)).fetchall()
+
+
+@pytest.mark.parametrize("common", [False, True])
+def test_filter_early_matches_filter(database, make_log, common):
+    lines = combined_lines(2000)
+    if common:
+        lines = [line.split(' "http')[0] + "\n" for line in lines]
+    path = make_log("access.log", lines)
+    ignore = ["css", "png"]
+    tokenizer = pipeline.Tokenizer(path)
+    assert tokenizer.file_type == (settings.APACHE_COMMON if common else
+                                   settings.APACHE_COMBINED)
+    tokenizer.run()
+    pipeline.Filter(path, ignore).run()
+    two_steps = token_rows(tokenizer.token_model)
+
+    pipeline.init_database()
+    tokenizer = pipeline.Tokenizer(path, ignore_list=ignore)
+    stats = tokenizer.run()
+    assert stats.rows_out == len(two_steps) < 2000
+    assert token_rows(tokenizer.token_model) == two_steps